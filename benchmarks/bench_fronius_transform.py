@@ -0,0 +1,96 @@
+import os
+import sys
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.api_fronius import FroniusExtractor
+from src.schema_registry import SchemaRegistry
+
+
+CHANNELS = ['EnergyExported', 'PowerReal_PAC_Sum', 'VoltageA', 'VoltageB', 'VoltageC',
+            'CurrentA', 'CurrentB', 'CurrentC', 'VoltageDC1', 'CurrentDC1',
+            'VoltageDC2', 'CurrentDC2', 'Temperature', 'Frequency']
+
+
+def synthetic_histdata(n_records:int, seed:int = 0) -> list:
+    rnd = random.Random(seed)
+    start = datetime(2023, 1, 1)
+    data = []
+    for i in range(n_records):
+        # Some records miss channels, like real histdata does at night
+        channels = [{'channelName': c, 'channelType': 'x', 'unit': 'x', 'value': rnd.random() * 100}
+                    for c in CHANNELS if rnd.random() > 0.05]
+        data.append({'logDateTime': (start + timedelta(minutes=5 * i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                     'logDuration': 300,
+                     'channels': channels})
+    return data
+
+
+def legacy_transform_device_data(data:list) -> pd.DataFrame:
+    # Per-record implementation replaced by FroniusExtractor.transform_device_data
+    df_result = pd.DataFrame()
+    for i in range(len(data)):
+        date_time = data[i]['logDateTime'].replace('T', ' ').replace('Z', '')
+        long_dur = data[i]['logDuration']
+        df_channels = pd.DataFrame(data[i]['channels'])
+        df_channels_t = df_channels[['channelName', 'value']].T
+        df_channels_t = df_channels_t.drop('channelName')\
+                                     .reset_index(drop=True)\
+                                     .rename_axis(None, axis=1)
+        df_channels_t.columns = df_channels['channelName']
+        df_channels_t['datetime'] = date_time
+        if 'EnergyExported' in df_channels_t.columns:
+            df_channels_t['total_active_power'] = df_channels_t['EnergyExported'] * 3600 / long_dur
+        else:
+            df_channels_t['total_active_power'] = None
+        if i == 0:
+            df_result = df_channels_t
+        else:
+            res_cols = set(df_result.columns)
+            chn_cols = set(df_channels_t.columns)
+            diff_cols = list(res_cols.difference(chn_cols)) + \
+                        list(chn_cols.difference(res_cols))
+            for c in diff_cols:
+                if c not in df_channels_t.columns:
+                    df_channels_t[c] = None
+                elif c not in df_result.columns:
+                    df_result[c] = None
+            df_channels_t = df_channels_t[df_result.columns]
+            df_result = pd.concat([df_result, df_channels_t])
+    df_result.reset_index(drop=True, inplace=True)
+    return df_result
+
+
+def timed(func, *args, repeat:int = 1) -> tuple:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = synthetic_histdata(args.records)
+    # A fresh schema registry, so columns known from earlier runs don't leak in
+    schemas = SchemaRegistry(state_file=os.path.join(tempfile.mkdtemp(), 'schemas.json'))
+    extractor = FroniusExtractor({'API_KEY': None, 'API_VALUE': None}, schemas=schemas)
+
+    t_new, df_new = timed(extractor.transform_device_data, data, repeat=args.repeat)
+    t_old, df_old = timed(legacy_transform_device_data, data)
+
+    assert list(df_new.columns) == list(df_old.columns), 'Output columns differ'
+    assert len(df_new) == len(df_old), 'Output rows differ'
+    print(f'records={args.records} legacy={t_old:.3f}s vectorized={t_new:.3f}s speedup={t_old / t_new:.1f}x')
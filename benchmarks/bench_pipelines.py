@@ -0,0 +1,340 @@
+import json
+import logging
+import os
+import sys
+import platform
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qsl
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_fronius_transform import synthetic_histdata
+from src.api_solared import SolarEdgeExtractor
+from src.api_fronius import FroniusExtractor
+from src.api_huaweii import HuaweiiExtractor
+from src.api_metomatics import MeteoExtractor
+from src.api_aws import AWS3Extractor
+from src.governor import RequestGovernor
+from src.http_session import set_transport
+from src.local_s3 import LocalS3Client
+from src.metrics import metrics
+from src.replay import Cassette, StubAdapter, StubServer
+from src.scheduler import IngestionScheduler, IngestionTask, split_windows
+from src.schema_registry import SchemaRegistry
+from src.watermarks import WatermarkStore, parse_data_folder
+from src.window_planner import WindowPlanner
+from src.pipeline_common import store_weather_window
+from src.pipeline_solaredge import store_solaredge_window
+from src.pipeline_fronius import store_fronius_window
+from src.pipeline_huaweii import store_huaweii_window, huaweii_grid_windows, pack_huaweii_plants
+
+
+START = datetime(2024, 3, 1)
+STEP = timedelta(minutes=5)
+PHASE = {'acCurrent': 4.1, 'acVoltage': 231.0, 'acFrequency': 50.0, 'apparentPower': 950.0,
+         'activePower': 940.0, 'reactivePower': 12.0, 'cosPhi': 1.0}
+
+
+def _steps(start_time:datetime, end_time:datetime) -> list:
+    times = []
+    while start_time < end_time:
+        times.append(start_time)
+        start_time += STEP
+    return times
+
+
+def synthetic_vendor(method:str, url:str, body:bytes) -> tuple:
+    # Answers every call the store_* pipelines make with plausible payloads,
+    # one record every 5 minutes per device
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    path = parts.path
+    headers = {'Content-Type': 'application/json'}
+    if parts.netloc == 'monitoringapi.solaredge.com' and path.endswith('/data'):
+        times = _steps(datetime.strptime(query['startTime'], '%Y-%m-%d %H:%M:%S'),
+                       datetime.strptime(query['endTime'], '%Y-%m-%d %H:%M:%S'))
+        telemetries = [{'date': t.strftime('%Y-%m-%d %H:%M:%S'), 'totalActivePower': 2800.0 + i % 7,
+                        'dcVoltage': 610.0, 'powerLimit': 100.0, 'totalEnergy': 1.0e6 + i, 'temperature': 41.5,
+                        'inverterMode': 'MPPT', 'operationMode': 0,
+                        'L1Data': PHASE, 'L2Data': PHASE, 'L3Data': PHASE} for i, t in enumerate(times)]
+        data = {'data': {'count': len(telemetries), 'telemetries': telemetries}}
+    elif parts.netloc == 'api.solarweb.com' and path.endswith('/histdata'):
+        start_time = datetime.strptime(query['from'], '%Y-%m-%dT%H:%M:%S')
+        end_time = datetime.strptime(query['to'], '%Y-%m-%dT%H:%M:%S')
+        histdata = synthetic_histdata(len(_steps(start_time, end_time)), seed=start_time.toordinal())
+        data = {'data': histdata}
+    elif parts.netloc.endswith('fusionsolar.huawei.com') and path.endswith('/login'):
+        headers['xsrf-token'] = 'bench-token'
+        data = {'success': True, 'failCode': 0}
+    elif parts.netloc.endswith('fusionsolar.huawei.com') and path.endswith('/getDevHistoryKpi'):
+        request = json.loads(body)
+        times = range(request['startTime'], request['endTime'], int(STEP.total_seconds() * 1000))
+        data = {'success': True, 'failCode': 0,
+                'data': [{'devId': int(dev), 'sn': f'SN{dev}', 'collectTime': t,
+                          'dataItemMap': {'active_power': 3.1, 'efficiency': 98.2, 'temperature': 40.1,
+                                          'mppt_1_cap': 1200.5, 'pv1_u': 600.2, 'pv1_i': 5.1,
+                                          'a_u': 230.4, 'a_i': 4.4, 'elec_freq': 50.0, 'day_cap': 12.5}}
+                         for dev in request['devIds'].split(',') for t in times]}
+    elif parts.netloc == 'www.meteosource.com' and path.endswith('/time_machine'):
+        day = datetime.strptime(query['date'], '%Y-%m-%d')
+        data = {'data': [{'date': (day + timedelta(hours=h)).strftime('%Y-%m-%dT%H:%M:%S'),
+                          'weather': 'sunny', 'icon': 2, 'summary': 'Sunny', 'temperature': 12.0 + h / 4,
+                          'wind': {'speed': 2.1, 'angle': 200, 'dir': 'SSW'}, 'cloud_cover': {'total': 3},
+                          'pressure': 1012, 'precipitation': {'total': 0, 'type': 'none'}} for h in range(24)]}
+    else:
+        return None
+    return 200, headers, json.dumps(data).encode('utf-8')
+
+
+class Bench(object):
+    def __init__(self,
+                 server:StubServer,
+                 layout:str = 'wide',
+                 output_format:str = 'csv') -> None:
+        # Every pipeline run gets its own local bucket, planner and schemas
+        self.server = server
+        self.layout = layout
+        self.output_format = output_format
+        self.tmp = tempfile.mkdtemp(prefix='bench_')
+
+    def fresh(self) -> dict:
+        run_dir = tempfile.mkdtemp(dir=self.tmp)
+        client = LocalS3Client(os.path.join(run_dir, 's3'))
+        watermarks = WatermarkStore(None, None,
+                                    cache_file=os.path.join(run_dir, 'watermarks.json'),
+                                    client_factory=lambda: client)
+        return {'aws_s3': AWS3Extractor(None, None, watermarks=watermarks, client=client, layout=self.layout,
+                                        output_format=self.output_format),
+                's3_dir': os.path.join(run_dir, 's3'),
+                'planner': WindowPlanner(state_file=os.path.join(run_dir, 'windows.json')),
+                'schemas': SchemaRegistry(state_file=os.path.join(run_dir, 'schemas.json'))}
+
+    def meteo(self) -> MeteoExtractor:
+        return MeteoExtractor({'API_KEY': None}, governor=RequestGovernor('meteosource'))
+
+
+def timed(func, repeat:int = 1) -> tuple:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_transforms(bench:Bench, days:int, repeat:int) -> list:
+    end_time = START + timedelta(days=days)
+    schemas = bench.fresh()['schemas']
+    solaredge = SolarEdgeExtractor({'SITE_ID': 1, 'API_KEY': None}, governor=RequestGovernor('solaredge'))
+    fronius = FroniusExtractor({'API_KEY': None, 'API_VALUE': None}, schemas=schemas, governor=RequestGovernor('fronius'))
+    huaweii = HuaweiiExtractor({'USER': None, 'PASSWORD': None}, schemas=schemas, governor=RequestGovernor('huaweii'))
+    meteo = bench.meteo()
+    histdata = synthetic_histdata(days * 288)
+    devices = [str(1000 + i) for i in range(10)]
+    cases = {'transform_device_data': lambda: fronius.transform_device_data(histdata),
+             'get_inverter_data_as_df': lambda: solaredge.get_inverter_data_as_df('SE-1', START, end_time),
+             'get_device_data_as_df': lambda: huaweii.get_device_data_as_df(devices,
+                                                                            int(START.timestamp() * 1000),
+                                                                            int(end_time.timestamp() * 1000)),
+             'get_wheather_data': lambda: meteo.get_wheather_data(START, end_time, lon='3.6W', lat='37.1N')}
+    results = []
+    for name, case in cases.items():
+        seconds, df = timed(case, repeat=repeat)
+        results.append({'benchmark': name, 'kind': 'transform', 'days': days,
+                        'seconds': round(seconds, 4), 'rows': len(df), 'columns': len(df.columns),
+                        'memory_bytes': int(df.memory_usage(deep=True).sum())})
+    for extractor in (solaredge, fronius, huaweii, meteo):
+        extractor.close()
+    return results
+
+
+def solaredge_tasks(state:dict, fleet:int, days:int) -> list:
+    tasks = []
+    meteo = state['meteo']
+    for i in range(fleet):
+        site = f'site{i}'
+        extractor = SolarEdgeExtractor({'SITE_ID': i, 'API_KEY': None}, governor=RequestGovernor('solaredge'))
+        state['extractors'].append(extractor)
+        df_site_details = extractor.site_details_to_df({'id': i, 'name': site, 'accountId': 1, 'peakPower': 10.0,
+                                                        'installationDate': '2020-01-01', 'type': 'Optimizers & Inverters',
+                                                        'location': {'country': 'Spain', 'city': 'Granada', 'timeZone': 'Europe/Madrid'},
+                                                        'primaryModule': {'manufacturerName': 'X', 'modelName': 'Y', 'maximumPower': 400.0}})
+        df_components = pd.DataFrame([{'component_id': f'SE-{i}', 'component_name': 'Inverter 1', 'site_id': i}])
+        end_time = START + timedelta(days=days)
+        for window_start, window_end in split_windows(START, end_time, timedelta(days=7)):
+            if window_start >= end_time:
+                continue
+            window_end = min(window_end, end_time)
+            tasks.append(IngestionTask('solaredge', site, f'SE-{i}', window_start, window_end, store_solaredge_window,
+                                       folder=f'SolarEdge/{site.upper()}/PlantData',
+                                       solaredge_extr=extractor,
+                                       aws_s3=state['aws_s3'],
+                                       df_site_details=df_site_details,
+                                       df_components=df_components,
+                                       planner=state['planner']))
+            tasks.append(IngestionTask('solaredge', site, None, window_start, window_end, store_weather_window,
+                                       folder=f'SolarEdge/{site.upper()}/WeatherData',
+                                       meteo_extractor=meteo,
+                                       aws_s3=state['aws_s3'],
+                                       lon='3.6W',
+                                       lat='37.1N'))
+    return tasks
+
+
+def fronius_tasks(state:dict, fleet:int, days:int) -> list:
+    extractor = FroniusExtractor({'API_KEY': None, 'API_VALUE': None},
+                                 schemas=state['schemas'],
+                                 governor=RequestGovernor('fronius'))
+    state['extractors'].append(extractor)
+    tasks = []
+    for i in range(fleet):
+        site, pv, device = f'pv{i}', f'pv-{i}', f'dev-{i}'
+        df_pvs_details = pd.DataFrame([{'pvSystemId': pv, 'name': site, 'address_city': 'Granada',
+                                        'timeZone': 'Europe/Madrid', 'peakPower': 10.0}])
+        df_dev_details = pd.DataFrame([{'deviceId': device, 'deviceName': 'Symo',
+                                        'deviceType': 'Inverter', 'nominalAcPower': 10000}])
+        tasks.append(IngestionTask('fronius', site, device, START, START + timedelta(days=days), store_fronius_window,
+                                   folder=f'Fronius/{site}/PlantData',
+                                   pv_system_id=pv,
+                                   fronius_ext=extractor,
+                                   meteo_extractor=state['meteo'],
+                                   aws_s3=state['aws_s3'],
+                                   df_pvs_details=df_pvs_details,
+                                   df_dev_details=df_dev_details,
+                                   coordinates={site: {'lon': '3.6W', 'lat': '37.1N'}},
+                                   city='Granada',
+                                   timezone='Europe/Madrid',
+                                   planner=state['planner']))
+    return tasks
+
+
+def huaweii_tasks(state:dict, fleet:int, days:int) -> list:
+    extractor = HuaweiiExtractor({'USER': None, 'PASSWORD': None},
+                                 schemas=state['schemas'],
+                                 governor=RequestGovernor('huaweii'))
+    state['extractors'].append(extractor)
+    plants = []
+    for i in range(fleet):
+        site = f'plant{i}'
+        df = pd.DataFrame([{'devId': 2000 + i, 'devName': f'INV-{i}', 'plantCode': f'NE={i}',
+                            'plantName': site, 'capacity': 10.0}])
+        plants.append({'site': site, 'folder': f'Huaweii/{site.upper()}/PlantData',
+                       'devices': [str(2000 + i)], 'df': df, 'lon': '3.6W', 'lat': '37.1N'})
+    # History is rounded up to whole 3-day grid windows
+    tasks = []
+    for window_start, window_end in huaweii_grid_windows(START, START + timedelta(days=-(-days // 3) * 3)):
+        for group in pack_huaweii_plants(plants):
+            tasks.append(IngestionTask('huaweii', ','.join([p['site'] for p in group]), None, window_start, window_end,
+                                       store_huaweii_window,
+                                       plants=group,
+                                       folders=[p['folder'] for p in group],
+                                       extractor=extractor,
+                                       meteo_extractor=state['meteo'],
+                                       aws_s3=state['aws_s3'],
+                                       planner=state['planner']))
+    return tasks
+
+
+PIPELINES = {'solaredge': solaredge_tasks,
+             'fronius': fronius_tasks,
+             'huaweii': huaweii_tasks}
+
+
+def schema_conflicts(s3_dir:str) -> list:
+    # Columns stored with different types by partitions of the same dataset
+    import pyarrow.parquet as pq
+    types = {}
+    conflicts = []
+    for root, _, names in os.walk(s3_dir):
+        for name in names:
+            if not name.endswith('.parquet'):
+                continue
+            path = os.path.join(root, name)
+            dataset = parse_data_folder(os.path.relpath(path, s3_dir))
+            for field in pq.read_schema(path):
+                known = types.setdefault((dataset, field.name), field.type)
+                if known != field.type:
+                    conflicts.append(f'{dataset}:{field.name} {known} vs {field.type}')
+    return conflicts
+
+
+def bench_pipeline(bench:Bench, vendor:str, fleet:int, days:int) -> dict:
+    state = bench.fresh()
+    state['meteo'] = bench.meteo()
+    state['extractors'] = [state['meteo']]
+    tasks = PIPELINES[vendor](state, fleet, days)
+    requests_before = bench.server.requests
+    metrics().reset()
+    t0 = time.perf_counter()
+    with IngestionScheduler() as scheduler:
+        failed = scheduler.run(tasks)
+    seconds = time.perf_counter() - t0
+    for extractor in state['extractors']:
+        extractor.close()
+    stats = state['aws_s3'].upload_stats()
+    conflicts = schema_conflicts(state['s3_dir']) if bench.output_format == 'parquet' else []
+    for conflict in conflicts:
+        logging.error(f'Parquet schema conflict in {conflict}')
+    # Seconds spent in each stage, summed over threads
+    stages = {}
+    for entry in metrics().summary()['stages']:
+        stages[entry['stage']] = round(stages.get(entry['stage'], 0) + entry['seconds'], 4)
+    return {'benchmark': f'store_{vendor}', 'kind': 'pipeline', 'layout': bench.layout, 'fleet': fleet, 'days': days,
+            'seconds': round(seconds, 4), 'tasks': len(tasks), 'failed': len(failed),
+            'requests': bench.server.requests - requests_before,
+            'uploads': stats.get('uploads'), 'bytes': stats.get('bytes'), 'schema_conflicts': len(conflicts),
+            'stages': stages}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--fleet', type=int, nargs='+', default=[1, 4, 16],
+                        help='Sites (one device each) per pipeline run')
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 7, 30],
+                        help='Days of history per run')
+    parser.add_argument('--vendors', type=str, nargs='+', default=list(PIPELINES.keys()),
+                        choices=list(PIPELINES.keys()))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Transforms report the best of this many runs')
+    parser.add_argument('--fixtures', type=str, default=None,
+                        help='Cassette directory written by extract_data.py --record, served before the synthetic payloads')
+    parser.add_argument('--layout', type=str, default='wide', choices=['wide', 'star'],
+                        help='Output layout of the pipeline runs')
+    parser.add_argument('--output_format', type=str, default='csv', choices=['csv', 'parquet'],
+                        help='File format of the pipeline runs, parquet also checks that the partitions of '
+                             'every dataset share their column types')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    cassette = Cassette(args.fixtures) if args.fixtures else None
+    with StubServer(cassette=cassette, fallback=synthetic_vendor) as server:
+        set_transport(lambda pool_size: StubAdapter(server.url, pool_size=pool_size))
+        bench = Bench(server, layout=args.layout, output_format=args.output_format)
+        results = []
+        for days in args.days:
+            results += bench_transforms(bench, days, args.repeat)
+        for vendor in args.vendors:
+            for fleet in args.fleet:
+                for days in args.days:
+                    results.append(bench_pipeline(bench, vendor, fleet, days))
+        set_transport(None)
+
+    report = {'started_at': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'pandas': pd.__version__,
+              'fixtures': args.fixtures,
+              'layout': args.layout,
+              'output_format': args.output_format,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import random
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import pandas as pd
+from pandas import json_normalize
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.api_solared import SolarEdgeExtractor
+from src.dtypes import apply_contract
+from src.governor import RequestGovernor
+from src.http_session import json_loads, orjson
+from src.timestamps import to_utc
+
+
+PHASE_FIELDS = ['acCurrent', 'acVoltage', 'acFrequency', 'apparentPower', 'activePower', 'reactivePower', 'cosPhi']
+
+
+def synthetic_telemetries(n_records:int, seed:int = 0) -> list:
+    rnd = random.Random(seed)
+    start = datetime(2023, 1, 1)
+    data = []
+    for i in range(n_records):
+        record = {'date': (start + timedelta(minutes=5 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+                  'totalActivePower': rnd.random() * 5000,
+                  'dcVoltage': rnd.random() * 700,
+                  'powerLimit': 100.0,
+                  'totalEnergy': 1.0e6 + i,
+                  'temperature': rnd.random() * 50,
+                  'inverterMode': 'MPPT',
+                  'operationMode': 0}
+        # Night records come without phase data
+        if rnd.random() > 0.1:
+            for phase in ('L1Data', 'L2Data', 'L3Data'):
+                record[phase] = {f: rnd.random() * 100 for f in PHASE_FIELDS}
+        data.append(record)
+    return data
+
+
+def legacy_inverter_data_to_df(inv_data:list) -> pd.DataFrame:
+    # json_normalize implementation replaced by flatten_telemetries
+    df_inv_data = json_normalize(data=inv_data, meta=['date'])
+    df_inv_data.columns = [c.replace('.', '_') for c in df_inv_data.columns]
+    df_inv_data.rename(columns={'date':'datetime'}, inplace=True)
+    # Timestamps are normalized the same way by both versions
+    df_inv_data['datetime'] = to_utc(df_inv_data['datetime'])
+    # ...and so is the dtype contract
+    return apply_contract(df_inv_data)
+
+
+def timed(func, *args, repeat:int = 1) -> tuple:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    content = json.dumps({'data': {'telemetries': synthetic_telemetries(args.records)}}).encode('utf-8')
+    extractor = SolarEdgeExtractor({'SITE_ID': 1, 'API_KEY': None}, governor=RequestGovernor('solaredge'))
+
+    t_json, data = timed(json.loads, content, repeat=args.repeat)
+    t_fast, _ = timed(json_loads, content, repeat=args.repeat)
+    inv_data = data['data']['telemetries']
+    t_old, df_old = timed(legacy_inverter_data_to_df, inv_data, repeat=args.repeat)
+    t_new, df_new = timed(extractor.inverter_data_to_df, inv_data, repeat=args.repeat)
+
+    # Exactly the legacy columns, in the same order
+    assert list(df_new.columns) == list(df_old.columns), (list(df_new.columns), list(df_old.columns))
+    pd.testing.assert_frame_equal(df_new, df_old)
+    print(f'records={args.records} decode json={t_json:.3f}s {"orjson" if orjson else "json"}={t_fast:.3f}s '
+          f'normalize legacy={t_old:.3f}s flattened={t_new:.3f}s speedup={(t_json + t_old) / (t_fast + t_new):.1f}x')
@@ -0,0 +1,77 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src.vendors import VENDORS
+
+
+HEAVY_MODULES = ['pandas', 'numpy', 'boto3', 'requests', 'unidecode', 'aiohttp', 'pyarrow']
+
+# Modules extract_data.py imported at startup before the vendor registry
+LEGACY_IMPORTS = ['asyncio', 'cProfile', 'unidecode', 'src.api_solared', 'src.api_fronius', 'src.api_huaweii',
+                  'src.api_metomatics', 'src.api_aws', 'src.api_async', 'src.replay', 'src.local_s3']
+
+# Modules main() imports for any vendor run, before loading the vendor
+RUN_IMPORTS = ['src.extract_data', 'src.api_aws', 'src.api_metomatics', 'src.pipeline_common']
+
+CHILD = """
+import importlib, json, sys, time
+sys.path.insert(0, {root!r})
+t0 = time.perf_counter()
+for name in {modules!r}:
+    importlib.import_module(name)
+if {vendor!r}:
+    from src.vendors import load_vendor
+    load_vendor({vendor!r})
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'imports': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def cases() -> dict:
+    cases = {'legacy (every vendor)': (LEGACY_IMPORTS, None),
+             '--status / --help': (['src.extract_data'], None)}
+    for api in VENDORS.keys():
+        cases[f'--api {api}'] = (RUN_IMPORTS, api)
+    return cases
+
+
+def time_startup(modules:list, vendor:str, cwd:str) -> dict:
+    # A fresh interpreter per sample, started away from the repository so
+    # nothing resolves from the working directory
+    code = CHILD.format(root=ROOT, modules=modules, vendor=vendor, heavy=HEAVY_MODULES)
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - t0
+    return result
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, (modules, vendor) in cases().items():
+            samples = [time_startup(modules, vendor, cwd) for _ in range(args.repeat)]
+            results.append({'case': name,
+                            'imports_seconds': round(statistics.median([s['imports'] for s in samples]), 4),
+                            'process_seconds': round(statistics.median([s['process'] for s in samples]), 4),
+                            'heavy_modules': samples[-1]['heavy']})
+
+    report = json.dumps({'python': sys.version.split()[0], 'repeat': args.repeat, 'results': results}, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    print(report)
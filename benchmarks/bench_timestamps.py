@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.timestamps import to_utc
+
+
+def synthetic_columns(n_records:int) -> dict:
+    start = datetime(2024, 3, 1)
+    steps = [start + timedelta(minutes=5 * i) for i in range(n_records)]
+    return {'solaredge': [d.strftime('%Y-%m-%d %H:%M:%S') for d in steps],
+            'fronius': [d.strftime('%Y-%m-%dT%H:%M:%SZ') for d in steps],
+            'huaweii': [int(d.timestamp() * 1000) for d in steps],
+            'meteosource': [d.strftime('%Y-%m-%dT%H:%M:%S') for d in steps]}
+
+
+# Per-row conversions replaced by src.timestamps.to_utc
+LEGACY = {'solaredge': lambda s: s.apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S')),
+          'fronius': lambda s: s.apply(lambda x: datetime.strptime(x.replace('T', ' ').replace('Z', ''), '%Y-%m-%d %H:%M:%S')),
+          'huaweii': lambda s: s.apply(lambda x: datetime.fromtimestamp(int(x) / 1000)),
+          'meteosource': lambda s: s.apply(lambda x: x.replace('T', ' '))}
+
+NORMALIZED = {'solaredge': lambda s: to_utc(s, tz='Europe/Madrid'),
+              'fronius': lambda s: to_utc(s),
+              'huaweii': lambda s: to_utc(s, unit='ms'),
+              'meteosource': lambda s: to_utc(s, tz='Europe/Madrid')}
+
+
+def timed(func, *args, repeat:int = 1) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for vendor, values in synthetic_columns(args.records).items():
+        series = pd.Series(values)
+        t_old = timed(LEGACY[vendor], series, repeat=args.repeat)
+        t_new = timed(NORMALIZED[vendor], series, repeat=args.repeat)
+        print(f'{vendor}: records={args.records} per-row={t_old:.3f}s to_utc={t_new:.3f}s speedup={t_old / t_new:.1f}x')
@@ -0,0 +1,315 @@
+import asyncio
+from datetime import datetime
+from typing import List
+import pandas as pd
+from src.http_async import AsyncHTTPExtractor
+from src.api_solared import SolarEdgeExtractor
+from src.api_fronius import FroniusExtractor
+from src.api_huaweii import HuaweiiExtractor, RELOGIN_FAIL_CODE, MAX_PLANTS_PER_CALL
+from src.api_metomatics import MeteoExtractor
+from src.timestamps import to_local
+
+
+# Each class keeps the constructor, URLs and transforms of its synchronous
+# extractor, and turns the methods that call the API into coroutines.
+
+class AsyncSolarEdgeExtractor(SolarEdgeExtractor, AsyncHTTPExtractor):
+    async def get_componet_list(self) -> dict:
+        data = await self._get_json(self.component_list_api)
+        return data['reporters']['list']
+
+    async def get_inverter_data(self,
+                                serial_number:str,
+                                start_time:datetime,
+                                end_time:datetime) -> list:
+        data = await self._get_json(self.inverter_data_url(serial_number=serial_number,
+                                                           start_time=start_time,
+                                                           end_time=end_time))
+        return data['data']['telemetries']
+
+    async def get_site_details(self) -> dict:
+        data = await self._get_json(self.site_details_api)
+        return data['details']
+
+    async def get_data_period(self) -> dict:
+        data = await self._get_json(self.data_period_api)
+        return data['dataPeriod']
+
+    async def get_site_energy(self,
+                              start_time:datetime,
+                              end_time:datetime,
+                              time_unit:str = 'DAY') -> list:
+        payload = {'startDate': datetime.strftime(to_local(start_time, self.timezone), "%Y-%m-%d"),
+                   'endDate': datetime.strftime(to_local(end_time, self.timezone), "%Y-%m-%d"),
+                   'timeUnit': time_unit,
+                   'api_key': self.api_key}
+        data = await self._get_json(self.site_energy_api, params=payload)
+        return data['energy']['values']
+
+    async def get_site_details_as_df(self) -> pd.DataFrame:
+        return self.site_details_to_df(await self.get_site_details())
+
+    async def get_inverter_data_as_df(self,
+                                      serial_number:str,
+                                      start_time:datetime,
+                                      end_time:datetime) -> pd.DataFrame:
+        inv_data = await self.get_inverter_data(serial_number=serial_number,
+                                                start_time=start_time,
+                                                end_time=end_time)
+        return self.inverter_data_to_df(inv_data)
+
+
+class AsyncFroniusExtractor(FroniusExtractor, AsyncHTTPExtractor):
+    async def get_pv_system_details(self, pv_system_id:str) -> dict:
+        return await self._get_json(self.api_list_devices + f'/{pv_system_id}', headers=self.header)
+
+    async def get_pv_system_list(self) -> dict:
+        return await self._get_json(self.api_list_pv_systems, headers=self.header)
+
+    async def get_componet_list(self, pv_system_id:str) -> dict:
+        return await self._get_json(self.api_list_devices + f'/{pv_system_id}/devices-list', headers=self.header)
+
+    async def get_pv_systems_and_components(self) -> pd.DataFrame:
+        pvs = await self.get_pv_system_list()
+        pv_ids = list(set(pvs['pvSystemIds']))
+        devs = await asyncio.gather(*[self.get_componet_list(pv_system_id=pv) for pv in pv_ids])
+        return self.components_to_df(list(zip(pv_ids, devs)))
+
+    async def get_device_details(self,
+                                 pv_system_id:str,
+                                 device_id:str) -> dict:
+        return await self._get_json(self.api_list_devices + f'/{pv_system_id}/devices/{device_id}', headers=self.header)
+
+    async def get_device_data(self,
+                              pv_system_id:str,
+                              device_id:str,
+                              start_time:datetime,
+                              end_time:datetime) -> dict:
+        data = await self._get_json(self.device_data_url(pv_system_id=pv_system_id,
+                                                         device_id=device_id,
+                                                         start_time=start_time,
+                                                         end_time=end_time),
+                                    headers=self.header)
+        return data['data']
+
+    async def get_pv_system_details_as_df(self, pv_system_id:str) -> pd.DataFrame:
+        return self.pv_system_details_to_df(await self.get_pv_system_details(pv_system_id=pv_system_id))
+
+    async def get_device_details_as_df(self,
+                                       pv_system_id:str,
+                                       device_id:str) -> pd.DataFrame:
+        return self.device_details_to_df(await self.get_device_details(pv_system_id=pv_system_id,
+                                                                       device_id=device_id))
+
+    async def get_device_data_as_df(self,
+                                    pv_system_id:str,
+                                    device_id:str,
+                                    start_time:datetime,
+                                    end_time:datetime) -> pd.DataFrame:
+        dev_data = await self.get_device_data(pv_system_id=pv_system_id,
+                                              device_id=device_id,
+                                              start_time=start_time,
+                                              end_time=end_time)
+        return self.transform_device_data(dev_data)
+
+
+class AsyncHuaweiiExtractor(HuaweiiExtractor, AsyncHTTPExtractor):
+    async def log_in(self):
+        data = {"userName":self.user,
+                "systemCode": self.password}
+        res = await self._post(self.api + 'login',
+                               headers=self.header,
+                               json=data)
+        res_data = self.decode(res)
+        if res_data['success'] == True:
+            self.token = res.headers["xsrf-token"]
+        else:
+            raise Exception(f"API response not OK: login failCode {res_data.get('failCode')}")
+
+    async def get_token(self) -> str:
+        # The lock belongs to the running event loop, it is created there
+        if getattr(self, '_async_token_lock', None) is None:
+            self._async_token_lock = asyncio.Lock()
+        async with self._async_token_lock:
+            if self.token is None:
+                await self.log_in()
+            return self.token
+
+    async def _call(self, endpoint:str, body:dict):
+        for attempt in range(2):
+            token = await self.get_token()
+            res = await self._post(self.api + endpoint,
+                                   headers={"XSRF-TOKEN": token},
+                                   json=body)
+            res_data = self.decode(res)
+            if res_data.get('success') == True:
+                return res_data.get('data')
+            if res_data.get('failCode') == RELOGIN_FAIL_CODE and attempt == 0:
+                if self.token == token:
+                    self.token = None
+                continue
+            raise Exception(f"API response not OK: {endpoint} failCode {res_data.get('failCode')}")
+
+    async def get_device_list(self, plants:list) -> list:
+        plants = list(plants)
+        chunks = [plants[i:i + MAX_PLANTS_PER_CALL] for i in range(0, len(plants), MAX_PLANTS_PER_CALL)]
+        results = await asyncio.gather(*[self._call('getDevList', {'stationCodes': ','.join(c)}) for c in chunks])
+        return [d for devices in results for d in devices]
+
+    async def get_plant_list(self) -> list:
+        data = await self._call('stations', {'pageNo': 1})
+        pages = await asyncio.gather(*[self._call('stations', {'pageNo': i + 2})
+                                       for i in range(data['pageCount'] - 1)])
+        return data['list'] + [p for page in pages for p in page['list']]
+
+    async def get_device_data(self, devices:List[str], start_time:int, end_time:int) -> dict:
+        body = {"devIds": ",".join(devices),
+                "devTypeId":1,
+                "startTime": start_time,
+                "endTime": end_time}
+        return await self._call('getDevHistoryKpi', body)
+
+    async def get_device_data_as_df(self,
+                                    devices:List[str],
+                                    start_time:int,
+                                    end_time:int) -> pd.DataFrame:
+        dev_data = await self.get_device_data(devices=devices,
+                                              start_time=start_time,
+                                              end_time=end_time)
+        return self.device_data_to_df(dev_data)
+
+
+class AsyncMeteoExtractor(MeteoExtractor, AsyncHTTPExtractor):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Per cache key [lock, coroutines holding or waiting for it], as
+        # WeatherCache.get_or_fetch does for threads
+        self._day_locks = {}
+
+    async def close(self) -> None:
+        await AsyncHTTPExtractor.close(self)
+
+    async def get_coordinates(self,
+                              place:str,
+                              timezone:str = 'Europe/Madrid') -> dict:
+        if self.places is None:
+            return await self.find_place(place=place, timezone=timezone)
+
+        entry = self.places.get(place, timezone=timezone)
+        if entry is not None:
+            return entry if entry['lat'] is not None else None
+        coordinates = await self.find_place(place=place, timezone=timezone)
+        self.places.put(place,
+                        lat=coordinates['lat'] if coordinates is not None else None,
+                        lon=coordinates['lon'] if coordinates is not None else None,
+                        timezone=timezone)
+        return coordinates
+
+    async def find_place(self,
+                         place:str,
+                         timezone:str = 'Europe/Madrid') -> dict:
+        payload = {'language' : 'en',
+                   'key': self.api_key,
+                   'text': place}
+        res = await self._get(self.flexi_base + 'find_places', params=payload)
+        data = self.decode(res)
+        for i in range(len(data)):
+            if data[i]['timezone'] == timezone:
+                return data[i]
+
+    async def get_hist_data(self,
+                            lat:str,
+                            lon:str,
+                            date:str,
+                            timezone:str = 'Europe/Madrid') -> list:
+        # Cache files are small, they are read and written on the loop
+        if self.cache is None or date >= datetime.now().strftime('%Y-%m-%d'):
+            return await self.fetch_hist_data(lat=lat, lon=lon, date=date, timezone=timezone)
+        key = self.cache.key(lat=lat, lon=lon, date=date, timezone=timezone)
+        entry = self._day_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+
+        # Sites sharing coordinates wait for the first fetch of a day and
+        # find it in the cache once they get the lock
+        try:
+            async with entry[0]:
+                data = self.cache.get(key)
+                if data is None:
+                    data = await self.fetch_hist_data(lat=lat, lon=lon, date=date, timezone=timezone)
+                    self.cache.put(key, data)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._day_locks.pop(key, None)
+        return data
+
+    async def fetch_hist_data(self,
+                              lat:str,
+                              lon:str,
+                              date:str,
+                              timezone:str = 'Europe/Madrid') -> list:
+        payload = {'lat' : lat,
+                   'lon' : lon,
+                   'date': date,
+                   'timezone': timezone,
+                   'units': 'metric',
+                   'language': 'en',
+                   'key': self.api_key}
+        res = await self._get(self.flexi_base + 'time_machine', params=payload)
+        data = self.decode(res)
+        return data['data']
+
+    async def get_wheather_data(self,
+                                start_date:datetime,
+                                end_date:datetime,
+                                timezone:str = 'Europe/Madrid',
+                                lon:str = None,
+                                lat:str = None,
+                                place:str = None,
+                                site:str = None) -> pd.DataFrame:
+
+        if ((lon == None) or (lat == None)) and (site != None) and (self.places != None):
+            coordinates = self.places.get(site, kind='site')
+            if coordinates is not None:
+                lon = coordinates['lon']
+                lat = coordinates['lat']
+
+        if (lon == None) or (lat == None):
+            try:
+                coordinates = await self.get_coordinates(place=place,
+                                                         timezone=timezone)
+                lon = coordinates['lon']
+                lat = coordinates['lat']
+            except Exception:
+                coordinates = await self.get_coordinates(place='Granada',
+                                                         timezone=timezone)
+                lon = coordinates['lon']
+                lat = coordinates['lat']
+
+        dates = self.weather_dates(start_date, end_date, timezone=timezone)
+        if len(dates) == 0:
+            return pd.DataFrame()
+        days = await asyncio.gather(*[self.get_hist_data(lat=lat, lon=lon, date=date, timezone=timezone)
+                                      for date in dates])
+        return self.weather_to_df(list(days), timezone=timezone)
+
+
+def async_extractor(extractor, pool_size:int):
+    # Async twin of a synchronous extractor, sharing its governor and caches
+    if isinstance(extractor, SolarEdgeExtractor):
+        twin = AsyncSolarEdgeExtractor(extractor.config, pool_size=pool_size, governor=extractor.governor)
+        twin.timezone = extractor.timezone
+        return twin
+    if isinstance(extractor, FroniusExtractor):
+        return AsyncFroniusExtractor(extractor.config, pool_size=pool_size, governor=extractor.governor,
+                                     schemas=extractor.schemas)
+    if isinstance(extractor, HuaweiiExtractor):
+        twin = AsyncHuaweiiExtractor(extractor.config, pool_size=pool_size, governor=extractor.governor,
+                                     schemas=extractor.schemas)
+        twin.api = extractor.api
+        twin.token = extractor.token
+        return twin
+    if isinstance(extractor, MeteoExtractor):
+        return AsyncMeteoExtractor(extractor.config, pool_size=pool_size, governor=extractor.governor,
+                                   cache=extractor.cache, places=extractor.places)
+    raise ValueError(f'No async extractor for {type(extractor).__name__}')
@@ -1,59 +1,236 @@
+import threading
 import pandas as pd
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from io import StringIO
 from datetime import datetime
+from src.watermarks import WatermarkStore, parse_data_file_name, parse_data_folder, DATA_FOLDER
+from src.s3_writers import CsvWriter, ParquetWriter, get_writer, reader_for_key
+from src.metrics import stage, add, key_labels
+from src.dimensions import DimensionStore, LAYOUTS
+from src.timestamps import parse_timestamps
 
 class AWS3Extractor (object):
     def __init__(self, 
                  aws_access_key_id:str, 
-                 aws_secret_key:str) -> None:
-        
+                 aws_secret_key:str,
+                 watermarks:WatermarkStore = None,
+                 output_format:str = 'csv',
+                 max_pool_connections:int = 10,
+                 client = None,
+                 layout:str = 'wide') -> None:
+
+        # client replaces the boto3 client, e.g. src.local_s3.LocalS3Client.
+        # With the star layout data files carry keys and measurements only, the
+        # site and device fields go to the tables of self.dimensions.
+        if layout not in LAYOUTS:
+            raise ValueError(f'Unknown output layout {layout}, expected one of {LAYOUTS}')
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_key = aws_secret_key
+        self.max_pool_connections = max_pool_connections
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                              multipart_chunksize=8 * 1024 * 1024,
+                                              max_concurrency=4)
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.writer = get_writer(output_format)
+        self.layout = layout
+        self.dimensions = DimensionStore(self) if layout == 'star' else None
+        self.watermarks = watermarks or WatermarkStore(aws_access_key_id=aws_access_key_id,
+                                                       aws_secret_key=aws_secret_key,
+                                                       client_factory=self.get_client)
+
+    def get_client(self):
+        # boto3 clients are thread-safe, one is shared by every read, listing and write
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = boto3.client('s3',
+                                                aws_access_key_id=self.aws_access_key_id,
+                                                aws_secret_access_key= self.aws_secret_key,
+                                                config=Config(max_pool_connections=self.max_pool_connections))
+        return self._client
+
+    @property
+    def client(self):
+        return self.get_client()
     
     def read_csv_from_s3(self, 
                          object_key:str,
                          bucket_name:str = 'prod-satia-raw-data') -> pd.DataFrame:
-            
-            s3_client = boto3.client('s3',
-                                     aws_access_key_id=self.aws_access_key_id,
-                                     aws_secret_access_key= self.aws_secret_key)
     
-            csv_obj = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+            csv_obj = self.client.get_object(Bucket=bucket_name, Key=object_key)
             body = csv_obj['Body']
             csv_string = body.read().decode('utf-8')
             df = pd.read_csv(StringIO(csv_string))
             return df
+
+    def read_df_from_s3(self,
+                        object_key:str,
+                        bucket_name:str = 'prod-satia-raw-data',
+                        text:bool = False) -> pd.DataFrame:
+
+        obj = self.client.get_object(Bucket=bucket_name, Key=object_key)
+        return reader_for_key(object_key).read(obj['Body'].read(), text=text)
     
 
+    def list_data_files(self,
+                        prefix:str,
+                        bucket:str = 'prod-satia-raw-data') -> list:
+
+        keys = []
+        vendor, site = key_labels(prefix)
+        with stage('s3_list', vendor=vendor, site=site):
+            paginator = self.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                keys += [obj['Key'] for obj in page.get('Contents', [])]
+        return keys
+
+    def get_max_data_date(self,
+                          object_key:str,
+                          bucket:str = 'prod-satia-raw-data') -> datetime:
+
+        # Files written in UTC give an aware datetime, older files with naive
+        # timestamps a naive one, as they were resumed before
+        df_last = self.read_df_from_s3(object_key=object_key, bucket_name=bucket)
+        if len(df_last) == 0:
+            return None
+        return parse_timestamps(df_last['datetime']).max().to_pydatetime()
+
+    def scan_last_data_date(self,
+                            folder:str,
+                            bucket:str = 'prod-satia-raw-data',
+                            device:str = None):
+        # Slow path: list the whole folder and open its newest file
+        last_date, last_file = None, None
+        files = {}
+        for key in self.list_data_files(prefix=folder, bucket=bucket):
+            start_time, file_device = parse_data_file_name(key)
+            if start_time is None or (device is not None and file_device != device):
+                continue
+            files[start_time] = key
+        if len(files) > 0:
+            last_file = files[max(files.keys())]
+            last_date = self.get_max_data_date(object_key=last_file, bucket=bucket)
+        return last_date, last_file
+
     def get_last_data_date(self,
                            folder:str,
-                           bucket:str = 'prod-satia-raw-data'):
+                           bucket:str = 'prod-satia-raw-data',
+                           device:str = None):
     
-        s3 = boto3.resource('s3',
-                            aws_access_key_id=self.aws_access_key_id,
-                            aws_secret_access_key= self.aws_secret_key)
-        
-        last_date = None
-        s3_bucket = s3.Bucket(bucket)
-        files = [f.key for f in s3_bucket.objects.filter(Prefix=folder).all()]
-        if len(files) > 0:
-            dates = [f.split('/')[-1].split('_')[2] for f in files]
-            keys = [datetime.strptime(x, '%Y-%m-%d %H:%M:%S') for x in dates]
-            files_dict = dict([(k, v) for k, v in zip(keys, files)])
-            last_file = files_dict[max(files_dict.keys())]
-            df_last = self.read_csv_from_s3(object_key = last_file)
-            df_last['datetime'] = df_last['datetime'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
-            last_date = max(df_last['datetime'])
+        vendor, site = key_labels(folder)
+        with stage('last_date', vendor=vendor, site=site):
+            last_date = self.watermarks.get(folder=folder, device=device, bucket=bucket)
+            if last_date is None:
+                last_date, last_file = self.scan_last_data_date(folder=folder,
+                                                                bucket=bucket,
+                                                                device=device)
+                if last_date is not None:
+                    self.watermarks.update(folder=folder,
+                                           device=device,
+                                           last_date=last_date,
+                                           last_key=last_file,
+                                           bucket=bucket)
         return last_date
+
+    def rebuild_watermarks(self,
+                           prefix:str,
+                           bucket:str = 'prod-satia-raw-data') -> dict:
+
+        newest = {}
+        for key in self.list_data_files(prefix=prefix, bucket=bucket):
+            folder = parse_data_folder(key)
+            if not folder.endswith(DATA_FOLDER):
+                continue
+            start_time, device = parse_data_file_name(key)
+            if start_time is None:
+                continue
+            # Huawei files carry no device, every device is resumed from the site manifest
+            for dev in set([device, None]):
+                if (folder, dev) not in newest or newest[(folder, dev)][0] < start_time:
+                    newest[(folder, dev)] = (start_time, key)
+
+        rebuilt = {}
+        for (folder, device), (_, key) in newest.items():
+            last_date = self.get_max_data_date(object_key=key, bucket=bucket)
+            if last_date is None:
+                continue
+            self.watermarks.update(folder=folder,
+                                   device=device,
+                                   last_date=last_date,
+                                   last_key=key,
+                                   bucket=bucket,
+                                   force=True)
+            rebuilt[self.watermarks.manifest_key(folder, device)] = last_date
+        return rebuilt
+    
+    def store_df_s3(self, 
+                    df:pd.DataFrame, 
+                    folder:str, 
+                    file_name:str,
+                    bucket_name:str = 'prod-satia-raw-data',
+                    device:str = None,
+                    writer = None):
+
+        writer = writer or self.writer
+        vendor, site = key_labels(folder)
+        add('rows_stored', len(df), vendor=vendor, site=site)
+        keys = writer.keys(df=df, folder=folder, file_name=file_name)
+        for key, df_part in keys:
+            writer.write(df=df_part,
+                         bucket_name=bucket_name,
+                         key=key,
+                         client=self.client,
+                         transfer_config=self.transfer_config)
+
+        if folder.endswith(DATA_FOLDER) and len(df) > 0:
+            last_date = parse_timestamps(df['datetime']).max().to_pydatetime()
+            for dev in set([device, None]):
+                self.watermarks.update(folder=folder,
+                                       device=dev,
+                                       last_date=last_date,
+                                       last_key=keys[-1][0],
+                                       bucket=bucket_name)
+    
+    def upload_stats(self) -> dict:
+        stats = getattr(self.writer, 'stats', None)
+        return stats.as_dict() if stats is not None else {}
     
     def store_csv_s3(self, 
                      df:pd.DataFrame, 
                      folder:str, 
                      file_name:str,
-                     bucket_name:str = 'prod-satia-raw-data'):
+                     bucket_name:str = 'prod-satia-raw-data',
+                     device:str = None):
          
-         df.to_csv(f"s3://{bucket_name}/{folder}/{file_name}",
-                    index=False,
-                    storage_options={"key" : self.aws_access_key_id,
-                                     "secret": self.aws_secret_key})
+         self.store_df_s3(df=df,
+                          folder=folder,
+                          file_name=file_name,
+                          bucket_name=bucket_name,
+                          device=device,
+                          writer=CsvWriter())
+
+    def migrate_csv_to_parquet(self,
+                               prefix:str,
+                               bucket:str = 'prod-satia-raw-data',
+                               delete:bool = False) -> int:
+        
+        writer = ParquetWriter()
+        migrated = 0
+        for key in self.list_data_files(prefix=prefix, bucket=bucket):
+            if not key.endswith('.csv'):
+                continue
+            df = self.read_df_from_s3(object_key=key, bucket_name=bucket)
+            folder, file_name = key.rsplit('/', 1)
+            for parquet_key, df_part in writer.keys(df=df, folder=folder, file_name=file_name):
+                writer.write(df=df_part,
+                             bucket_name=bucket,
+                             key=parquet_key,
+                             client=self.client,
+                             transfer_config=self.transfer_config)
+            if delete:
+                self.client.delete_object(Bucket=bucket, Key=key)
+            migrated += 1
+        return migrated
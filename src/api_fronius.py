@@ -1,62 +1,74 @@
 import requests
-import json
 import pandas as pd
 from pandas import json_normalize
 from datetime import datetime
+from src.http_session import HTTPExtractor, DEFAULT_POOL_SIZE
+from src.governor import RequestGovernor, get_governor
+from src.metrics import timed
+from src.schema_registry import SchemaRegistry
+from src.timestamps import to_utc, as_utc
+from src.dtypes import apply_contract
 
 
-class FroniusExtractor(object):
-    def __init__(self, config:dict):
+class FroniusExtractor(HTTPExtractor):
+    vendor = 'fronius'
+
+    def __init__(self, 
+                 config:dict, 
+                 session:requests.Session = None,
+                 pool_size:int = DEFAULT_POOL_SIZE,
+                 governor:RequestGovernor = None,
+                 schemas:SchemaRegistry = None):
+        super().__init__(session=session, pool_size=pool_size, governor=governor)
+        self.config = config
         self.api_value = config["API_VALUE"]
         self.api_key = config["API_KEY"]
+        self.governor = governor if governor is not None else get_governor('fronius', self.api_key)
+        self.schemas = schemas if schemas is not None else SchemaRegistry()
         self.header = {'AccessKeyId': self.api_key,
                        'AccessKeyValue': self.api_value}
 
-        self.api_list_pv_systems = f'https://api.solarweb.com/swqapi/pvsystems-list'
-        self.api_list_devices = f'https://api.solarweb.com/swqapi/pvsystems'
-        self.api_dev_historical = f'https://api.solarweb.com/swqapi/pvsystems'
+        self.api_list_pv_systems = 'https://api.solarweb.com/swqapi/pvsystems-list'
+        self.api_list_devices = 'https://api.solarweb.com/swqapi/pvsystems'
+        self.api_dev_historical = 'https://api.solarweb.com/swqapi/pvsystems'
 
 
-    def transform_device_data(self, data_org:dict) -> pd.DataFrame:
+    @timed('transform')
+    def transform_device_data(self,
+                              data_org:dict,
+                              device_type:str = 'inverter') -> pd.DataFrame:
         data = data_org
-        df_result = pd.DataFrame()
-
-        for i in range(len(data)):
-            date_time = data[i]['logDateTime'].replace('T', ' ').replace('Z', '')
-            long_dur = data[i]['logDuration']
-            channels = data[i]['channels']
-
-            df_channels = pd.DataFrame(channels)
-            df_channels_t = df_channels[['channelName', 'value']].T
-            df_channels_t = df_channels_t.drop('channelName')\
-                                        .reset_index(drop=True)\
-                                        .rename_axis(None, axis=1)
-            df_channels_t.columns = df_channels['channelName']
-            df_channels_t['datetime'] = date_time
-            if 'EnergyExported' in df_channels_t.columns:
-                df_channels_t['total_active_power'] = df_channels_t['EnergyExported'] * 3600 / long_dur
-            else:
-                df_channels_t['total_active_power'] = None
+        if len(data) == 0:
+            return pd.DataFrame()
 
-            #Fill missing cols
-            if i == 0:
-                df_result = df_channels_t
-            else:
-                res_cols = set(df_result.columns)
-                chn_cols = set(df_channels_t.columns)
-                diff_cols = list(res_cols.difference(chn_cols)) + \
-                            list(chn_cols.difference(res_cols))
-                for c in diff_cols:
-                    if c not in df_channels_t.columns:
-                        df_channels_t[c] = None
-                    elif c not in df_result.columns:
-                        df_result[c] = None
-                
-                df_channels_t  = df_channels_t[df_result.columns]
-                df_result = pd.concat([df_result, df_channels_t])
-
-        df_result.reset_index(drop=True, inplace=True)
-        return df_result
+        # Collect every channel straight into its column, the frame is built once
+        n_records = len(data)
+        columns = {}
+        for i in range(n_records):
+            for channel in data[i]['channels']:
+                name = channel['channelName']
+                if name not in columns:
+                    columns[name] = [None] * n_records
+                columns[name][i] = channel['value']
+
+        n_first = len(dict.fromkeys(c['channelName'] for c in data[0]['channels']))
+        date_times = [d['logDateTime'] for d in data]
+        if 'EnergyExported' in columns:
+            energy = pd.to_numeric(pd.Series(columns['EnergyExported']), errors='coerce')
+            long_dur = pd.Series([d['logDuration'] for d in data], dtype='float64')
+            total_active_power = (energy * 3600 / long_dur).to_numpy()
+        else:
+            total_active_power = [None] * n_records
+
+        # The first record's channels lead, as in the files written so far
+        names = list(columns.keys())
+        ordered = {c: columns[c] for c in names[:n_first]}
+        ordered['datetime'] = date_times
+        ordered['total_active_power'] = total_active_power
+        ordered.update({c: columns[c] for c in names[n_first:]})
+        df = self.schemas.build_frame('fronius', device_type, ordered, n_records)
+        df['datetime'] = to_utc(df['datetime'])
+        return apply_contract(df)
 
 
     def transform_list_pv_systems_details(self, data:dict) -> dict:
@@ -90,9 +102,9 @@ class FroniusExtractor(object):
     def get_pv_system_details(self, pv_system_id:str) -> dict:
         api_call = self.api_list_devices + f'/{pv_system_id}'
         try:
-            res = requests.get(api_call, headers=self.header)
+            res = self._get(api_call, headers=self.header)
             if (res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
@@ -102,9 +114,9 @@ class FroniusExtractor(object):
 
     def get_pv_system_list(self) -> pd.DataFrame:
         try:
-            res = requests.get(self.api_list_pv_systems, headers=self.header)
+            res = self._get(self.api_list_pv_systems, headers=self.header)
             if (res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
@@ -115,9 +127,9 @@ class FroniusExtractor(object):
     def get_componet_list(self, pv_system_id:str) -> pd.DataFrame:
         api_call = self.api_list_devices + f'/{pv_system_id}/devices-list'
         try:
-            res = requests.get(api_call, headers=self.header)
+            res = self._get(api_call, headers=self.header)
             if(res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
@@ -130,11 +142,13 @@ class FroniusExtractor(object):
         pvs = self.get_pv_system_list()
         for pv in set(pvs['pvSystemIds']):
             devs = self.get_componet_list(pv_system_id=pv)
-            df_dev = pd.DataFrame(devs['deviceIds'], columns=['deviceIds'])
-            df_dev['pvSystemIds'] = pv
-            components.append(df_dev)
-        
-        df_r = pd.concat(components)
+            components.append((pv, devs))
+        return self.components_to_df(components)
+
+    def components_to_df(self, components:list) -> pd.DataFrame:
+        # components holds (pv_system_id, devices-list answer) pairs
+        df_r = pd.concat([pd.DataFrame(devs['deviceIds'], columns=['deviceIds']).assign(pvSystemIds=pv)
+                          for pv, devs in components])
         df_r.drop_duplicates(inplace=True)
         return df_r
     
@@ -144,32 +158,43 @@ class FroniusExtractor(object):
                            device_id:str) -> dict:
         api_call = self.api_list_devices + f'/{pv_system_id}/devices/{device_id}'
         try:
-            res = requests.get(api_call, headers=self.header)
+            res = self._get(api_call, headers=self.header)
             if(res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
         except requests.exceptions.RequestException as e:
             raise e
 
-    def get_device_data(self,
+    def device_data_url(self,
                         pv_system_id:str,
                         device_id:str,
                         start_time:datetime,
-                        end_time:datetime) -> dict:
-    
+                        end_time:datetime) -> str:
+        # histdata takes UTC, windows are naive server local times
         time_format = "%Y-%m-%d %H:%M:%S"
-        start_time = datetime.strftime(start_time, time_format).replace(' ', 'T')
-        end_time = datetime.strftime(end_time, time_format).replace(' ', 'T')
+        start_time = datetime.strftime(as_utc(start_time), time_format).replace(' ', 'T')
+        end_time = datetime.strftime(as_utc(end_time), time_format).replace(' ', 'T')
 
         api_call = self.api_dev_historical + f'/{pv_system_id}/devices/{device_id}/histdata?'
         api_call = api_call + f"from={start_time}&to={end_time}"
+        return api_call
 
+    def get_device_data(self,
+                        pv_system_id:str,
+                        device_id:str,
+                        start_time:datetime,
+                        end_time:datetime) -> dict:
+    
+        api_call = self.device_data_url(pv_system_id=pv_system_id,
+                                        device_id=device_id,
+                                        start_time=start_time,
+                                        end_time=end_time)
         try:
-            res = requests.get(api_call, headers=self.header)
+            res = self._get(api_call, headers=self.header)
             if(res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data['data']
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
@@ -178,6 +203,9 @@ class FroniusExtractor(object):
 
     def get_pv_system_details_as_df(self, pv_system_id:str) -> pd.DataFrame:
         pv_details = self.get_pv_system_details(pv_system_id = pv_system_id)
+        return self.pv_system_details_to_df(pv_details)
+
+    def pv_system_details_to_df(self, pv_details:dict) -> pd.DataFrame:
         df_pvs_details = json_normalize(data=pv_details,
                                         meta=['pvSystemId',
                                               'name',
@@ -192,9 +220,7 @@ class FroniusExtractor(object):
                                               ['address', 'state']])
 
         df_pvs_details.columns = [c.replace('.', '_') for c in df_pvs_details.columns]
-        df_pvs_details['installationDate'] = df_pvs_details['installationDate']\
-                                             .apply(lambda x: datetime.strptime(x.replace('T', ' ').replace('Z', ''), 
-                                                                                '%Y-%m-%d %H:%M:%S'))
+        df_pvs_details['installationDate'] = to_utc(df_pvs_details['installationDate'])
         return df_pvs_details
         
 
@@ -203,7 +229,9 @@ class FroniusExtractor(object):
                                  device_id:str) -> pd.DataFrame:
         dev_details = self.get_device_details(pv_system_id = pv_system_id,
                                               device_id = device_id)
-        
+        return self.device_details_to_df(dev_details)
+
+    def device_details_to_df(self, dev_details:dict) -> pd.DataFrame:
         df_dev_details = json_normalize(data=dev_details,
                                         meta=['deviceType',
                                               'deviceId',
@@ -219,12 +247,8 @@ class FroniusExtractor(object):
                                               'deactivationDate'])
         
         df_dev_details.columns = [c.replace('.', '_') for c in df_dev_details.columns]
-        df_dev_details['activationDate'] = df_dev_details['activationDate']\
-                                             .apply(lambda x: datetime.strptime(x.replace('T', ' ').replace('Z', ''), 
-                                                                                '%Y-%m-%d %H:%M:%S') if not pd.isnull(x) else x)
-        df_dev_details['deactivationDate'] = df_dev_details['deactivationDate']\
-                                             .apply(lambda x: datetime.strptime(x.replace('T', ' ').replace('Z', ''), 
-                                                                                '%Y-%m-%d %H:%M:%S') if not pd.isnull(x) else x)
+        df_dev_details['activationDate'] = to_utc(df_dev_details['activationDate'])
+        df_dev_details['deactivationDate'] = to_utc(df_dev_details['deactivationDate'])
         
         df_dev_details = df_dev_details[df_dev_details['deviceType'] == 'Inverter']
 
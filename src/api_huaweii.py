@@ -1,44 +1,96 @@
 import requests
-import json
+import threading
 from typing import List
 import pandas as pd
-from pandas import json_normalize
-from datetime import datetime
+from src.http_session import HTTPExtractor, DEFAULT_POOL_SIZE
+from src.governor import RequestGovernor, get_governor
+from src.metrics import timed
+from src.schema_registry import SchemaRegistry
+from src.timestamps import to_utc
+from src.dtypes import apply_contract
 
-class HuaweiiExtractor(object):
-    def __init__(self, config:dict, intl:str = 'eu5'):
+
+# failCode of an expired or invalid XSRF token
+RELOGIN_FAIL_CODE = 305
+MAX_DEVICES_PER_CALL = 10
+MAX_PLANTS_PER_CALL = 100
+
+
+class HuaweiiExtractor(HTTPExtractor):
+    vendor = 'huaweii'
+
+    def __init__(self, 
+                 config:dict, 
+                 intl:str = 'eu5',
+                 session:requests.Session = None,
+                 pool_size:int = DEFAULT_POOL_SIZE,
+                 governor:RequestGovernor = None,
+                 schemas:SchemaRegistry = None):
+        super().__init__(session=session, pool_size=pool_size, governor=governor)
+        self.config = config
         self.user = config["USER"]
         self.password = config["PASSWORD"]
+        self.governor = governor if governor is not None else get_governor('huaweii', self.user)
+        self.schemas = schemas if schemas is not None else SchemaRegistry()
         self.api = f'https://{intl}.fusionsolar.huawei.com/thirdData/'
         self.header = {"Content-Type": "application/json"}
         self.token = None
+        self._token_lock = threading.Lock()
 
+    def throttled(self, res:requests.Response) -> bool:
+        # FusionSolar answers 200 with failCode 407 when calls are too frequent
+        try:
+            return self.decode(res).get('failCode') == 407
+        except (ValueError, AttributeError):
+            return False
 
     def log_in(self):
         data = {"userName":self.user,
                 "systemCode": self.password}
         try:
-            res = requests.post(self.api + 'login', 
+            res = self._post(self.api + 'login', 
                                 headers=self.header, 
                                 json=data)
-            res_data = json.loads(res.content)
+            res_data = self.decode(res)
             if res_data['success'] == True:
                 self.token = res.headers["xsrf-token"]
+            else:
+                raise Exception(f"API response not OK: login failCode {res_data.get('failCode')}")
         except requests.exceptions.RequestException as e:
             raise e
         return
 
+    def get_token(self) -> str:
+        # One token is shared by every thread, only the first caller logs in
+        with self._token_lock:
+            if self.token is None:
+                self.log_in()
+            return self.token
+
+    def _call(self, endpoint:str, body:dict):
+        # An expired token (failCode 305) is renewed once and the call repeated
+        for attempt in range(2):
+            token = self.get_token()
+            res = self._post(self.api + endpoint,
+                             headers={"XSRF-TOKEN": token},
+                             json=body)
+            res_data = self.decode(res)
+            if res_data.get('success') == True:
+                return res_data.get('data')
+            if res_data.get('failCode') == RELOGIN_FAIL_CODE and attempt == 0:
+                with self._token_lock:
+                    if self.token == token:
+                        self.token = None
+                continue
+            raise Exception(f"API response not OK: {endpoint} failCode {res_data.get('failCode')}")
+
     def get_device_list(self, plants:list) -> list:
         devices = []
         try:
-            header = {"XSRF-TOKEN": self.token}
-            body = {'stationCodes': ','.join(plants)}
-            res = requests.post(self.api + 'getDevList',
-                                headers=header,
-                                json=body)
-            res_data = json.loads(res.content)
-            if res_data['success'] == True:
-                devices =  res_data['data']
+            plants = list(plants)
+            for i in range(0, len(plants), MAX_PLANTS_PER_CALL):
+                body = {'stationCodes': ','.join(plants[i:i + MAX_PLANTS_PER_CALL])}
+                devices += self._call('getDevList', body)
         except requests.exceptions.RequestException as e:
             raise e
         return devices
@@ -46,41 +98,24 @@ class HuaweiiExtractor(object):
     def get_plant_list(self) -> list:
         plants = []
         try:
-            header = {"XSRF-TOKEN": self.token}
-            body = {'pageNo': 1}
-            res = requests.post(self.api + 'stations',
-                                headers=header,
-                                json=body)
-            res_data = json.loads(res.content)
-            if res_data['success'] == True:
-                remaining_pages = res_data['data']['pageCount'] - 1
-                plants += res_data['data']['list']
-                for i in range(remaining_pages):
-                    body = {'pageNo': i}
-                    res = requests.post(self.plant_list,
-                                        headers=header,
-                                        json=body)
-                    res_data = json.loads(res.content)
-                    plants += res_data['data']['list']
+            data = self._call('stations', {'pageNo': 1})
+            remaining_pages = data['pageCount'] - 1
+            plants += data['list']
+            for i in range(remaining_pages):
+                data = self._call('stations', {'pageNo': i + 2})
+                plants += data['list']
         except requests.exceptions.RequestException as e:
             raise e
         return plants
     
     def get_device_data(self, devices:List[str], start_time:int, end_time:int) -> dict:
+        # At most MAX_DEVICES_PER_CALL devices and 3 days per call
         try:
-            header = {"XSRF-TOKEN": self.token}
             body = {"devIds": ",".join(devices),
                     "devTypeId":1,
                     "startTime": start_time,
                     "endTime": end_time}
-                
-            res = requests.post(self.api + 'getDevHistoryKpi',
-                                headers=header,
-                                json=body)
-                
-            res_data = json.loads(res.content)
-            if res_data['success'] == True:
-                return res_data['data']
+            return self._call('getDevHistoryKpi', body)
         except requests.exceptions.RequestException as e:
             raise e
     
@@ -91,24 +126,27 @@ class HuaweiiExtractor(object):
         dev_data = self.get_device_data(devices=devices,
                                         start_time=start_time,
                                         end_time=end_time)
-        
-        meta = []
-        for i in range(len(dev_data)):
-            cols = ['devId','sn', 'collectTime'] + [f'dataItemMap__{c}' for c in dev_data[i]['dataItemMap'].keys()]
-            meta = list(set(meta).union(set(cols)))
-
-        meta = [c.split('__') for c in meta]
-        df_data_dev = json_normalize(data=dev_data,
-                                     meta=meta)
-        
-        df_data_dev.columns = [c.replace('.', '_') for c in df_data_dev.columns]
-        df_data_dev['datetime'] = df_data_dev['collectTime'].apply(lambda x: datetime.fromtimestamp(int(x)/1000))
-        
-        return df_data_dev
-    
-    
-    
-
+        return self.device_data_to_df(dev_data)
 
+    @timed('transform')
+    def device_data_to_df(self, dev_data:list) -> pd.DataFrame:
+        if not dev_data:
+            return pd.DataFrame()
 
+        # Records are flattened straight into columns, dataItemMap keys become
+        # dataItemMap_<key> like json_normalize named them
+        n_records = len(dev_data)
+        columns = {}
+        for i in range(n_records):
+            for k, v in dev_data[i].items():
+                items = {f'dataItemMap_{c}': value for c, value in v.items()} if k == 'dataItemMap' else {k: v}
+                for name, value in items.items():
+                    if name not in columns:
+                        columns[name] = [None] * n_records
+                    columns[name][i] = value
+        # Placeholder that keeps the column in its schema position
+        columns['datetime'] = [None] * n_records
 
+        df = self.schemas.build_frame('huaweii', 'inverter', columns, n_records)
+        df['datetime'] = to_utc(df['collectTime'], unit='ms')
+        return apply_contract(df)
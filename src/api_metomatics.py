@@ -1,25 +1,81 @@
 import requests
-import json
+import threading
 from pandas import json_normalize
 from datetime import datetime, timedelta
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from src.http_session import HTTPExtractor, DEFAULT_POOL_SIZE
+from src.governor import RequestGovernor, get_governor
+from src.metrics import timed, current_site, site_label
+from src.meteo_cache import WeatherCache, PlaceCache
+from src.timestamps import to_utc, to_local, as_utc
+from src.dtypes import apply_contract
 
-class MeteoExtractor(object):
-    def __init__(self, config) -> None:
+class MeteoExtractor(HTTPExtractor):
+    vendor = 'meteosource'
+
+    def __init__(self, 
+                 config, 
+                 session:requests.Session = None,
+                 pool_size:int = DEFAULT_POOL_SIZE,
+                 cache:WeatherCache = None,
+                 places:PlaceCache = None,
+                 max_workers:int = 4,
+                 rate_limit:float = None,
+                 governor:RequestGovernor = None) -> None:
+        super().__init__(session=session, pool_size=pool_size)
+        self.config = config
         self.api_key = config['API_KEY']
+        self.cache = cache
+        self.places = places
+        self.max_workers = max_workers
+        self.governor = governor if governor is not None else get_governor('meteosource', rate=rate_limit)
+        self._executor = None
+        self._executor_lock = threading.Lock()
         self.flexi_base = 'https://www.meteosource.com/api/v1/flexi/'
     
 
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='meteo')
+            return self._executor
+
+    def close(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        super().close()
+
     def get_coordinates(self, 
                         place:str, 
                         timezone:str = 'Europe/Madrid') -> dict:
-        endpoint = self.flexi_base + f'find_places'
+        if self.places is None:
+            return self.find_place(place=place, timezone=timezone)
+
+        entry = self.places.get(place, timezone=timezone)
+        if entry is not None:
+            return entry if entry['lat'] is not None else None
+        coordinates = self.find_place(place=place, timezone=timezone)
+        self.places.put(place,
+                        lat=coordinates['lat'] if coordinates is not None else None,
+                        lon=coordinates['lon'] if coordinates is not None else None,
+                        timezone=timezone)
+        return coordinates
+
+    def find_place(self, 
+                   place:str, 
+                   timezone:str = 'Europe/Madrid') -> dict:
+        endpoint = self.flexi_base + 'find_places'
         payload = {'language' : 'en',
                    'key': self.api_key,
                    'text': place}
         try:
-            res = requests.get(endpoint, params=payload)
-            data = json.loads(res.content)
+            res = self._get(endpoint, params=payload)
+            data = self.decode(res)
             for i in range(len(data)):
                 if data[i]['timezone'] == timezone:
                     return data[i]
@@ -33,7 +89,23 @@ class MeteoExtractor(object):
                       lon:str, 
                       date:str, 
                       timezone:str = 'Europe/Madrid') -> pd.DataFrame:
-        endpoint = self.flexi_base + f'time_machine'
+        if self.cache is None:
+            return self.fetch_hist_data(lat=lat, lon=lon, date=date, timezone=timezone)
+        return self.cache.get_or_fetch(lat=lat,
+                                       lon=lon,
+                                       date=date,
+                                       timezone=timezone,
+                                       fetch=lambda: self.fetch_hist_data(lat=lat, 
+                                                                          lon=lon, 
+                                                                          date=date, 
+                                                                          timezone=timezone))
+
+    def fetch_hist_data(self, 
+                        lat:str, 
+                        lon:str, 
+                        date:str, 
+                        timezone:str = 'Europe/Madrid') -> pd.DataFrame:
+        endpoint = self.flexi_base + 'time_machine'
         payload = {'lat' : lat,
                    'lon' : lon,
                    'date': date,
@@ -43,8 +115,8 @@ class MeteoExtractor(object):
                    'key': self.api_key}
 
         try:
-            res = requests.get(endpoint, params=payload)
-            data = json.loads(res.content)
+            res = self._get(endpoint, params=payload)
+            data = self.decode(res)
             return data['data']
         except requests.exceptions.RequestException as e:
             raise e
@@ -55,61 +127,71 @@ class MeteoExtractor(object):
                          timezone:str = 'Europe/Madrid',
                          lon:str = None,
                          lat:str = None,
-                         place:str = None) -> pd.DataFrame:
+                         place:str = None,
+                         site:str = None) -> pd.DataFrame:
         
+        if ((lon == None) or (lat == None)) and (site != None) and (self.places != None):
+            coordinates = self.places.get(site, kind='site')
+            if coordinates is not None:
+                lon = coordinates['lon']
+                lat = coordinates['lat']
+
         if (lon == None) or (lat == None):
             try:
                 coordinates = self.get_coordinates(place=place, 
                                                    timezone=timezone)
                 lon = coordinates['lon']
                 lat = coordinates['lat']
-            except Exception as e:
+            except Exception:
                 coordinates = self.get_coordinates(place='Granada', 
                                                    timezone=timezone)
                 lon = coordinates['lon']
                 lat = coordinates['lat']
         
-        df_w = pd.DataFrame()
-
-        while start_date <= end_date:
-            date = datetime.strftime(start_date, "%Y-%m-%d")
-            data = self.get_hist_data(lat=lat, 
-                                      lon=lon, 
-                                      date=date, 
-                                      timezone=timezone)
-            df = json_normalize(data=data,
-                        meta=['date', 
-                              'weather', 
-                              'summary', 
-                              'icon', 
-                              'temperature',
-                              'feels_like',
-                              'wind_chill',
-                              'soil_temperature',
-                              'dew_point',
-                              'surface_temperature',
-                              ['wind', 'speed'],
-                              ['wind', 'gusts'],
-                              ['wind', 'angle'],
-                              ['wind', 'dir'],
-                              ['cloud_cover', 'total'],
-                              ['cloud_cover', 'low'],
-                              ['cloud_cover', 'middle'],
-                              ['cloud_cover', 'high'],
-                              'pressure',
-                              ['precipitation', 'total'],
-                              ['precipitation', 'type'],
-                              'cape',
-                              'evaporation',
-                              'irradiance',
-                              'ozone',
-                              'humidity'])
-            df.columns = [c.replace('.', '_') for c in df.columns]
-            df_w = pd.concat([df_w, df])
-            start_date += timedelta(days=1)
-        df_w.rename(columns={'date':'datetime'}, inplace=True)
-        df_w['datetime'] = df_w['datetime'].apply(lambda x: x.replace('T', ' '))
-        return df_w
+        dates = self.weather_dates(start_date, end_date, timezone=timezone)
+        if len(dates) == 0:
+            return pd.DataFrame()
 
+        # Days are fetched concurrently, then normalized and concatenated once.
+        # The pool threads report their calls under the caller's site.
+        caller_site = current_site()
+        def fetch_day(date:str) -> list:
+            with site_label(caller_site):
+                return self.get_hist_data(lat=lat,
+                                          lon=lon,
+                                          date=date,
+                                          timezone=timezone)
+        return self.weather_to_df(list(self.executor.map(fetch_day, dates)), timezone=timezone)
 
+    def weather_dates(self,
+                      start_date:datetime,
+                      end_date:datetime,
+                      timezone:str = None) -> list:
+        # Calendar days of timezone between both bounds, inclusive. Aware
+        # bounds (UTC frame timestamps) and naive ones (server local windows)
+        # are both converted to the wall time of the site first.
+        start_day = to_local(as_utc(start_date), timezone).date()
+        end_day = to_local(as_utc(end_date), timezone).date()
+        dates = []
+        while start_day <= end_day:
+            dates.append(start_day.strftime("%Y-%m-%d"))
+            start_day += timedelta(days=1)
+        return dates
 
+    @timed('transform')
+    def weather_to_df(self,
+                      days:list,
+                      timezone:str = None) -> pd.DataFrame:
+        # days holds the hourly records of each day, in the wall time of the
+        # requested timezone
+        data = []
+        for day_data in days:
+            data += day_data
+
+        df_w = json_normalize(data=data)
+        df_w.columns = [c.replace('.', '_') for c in df_w.columns]
+        df_w.rename(columns={'date':'datetime'}, inplace=True)
+        if 'datetime' in df_w.columns:
+            df_w['datetime'] = to_utc(df_w['datetime'], tz=timezone)
+        apply_contract(df_w)
+        return df_w
@@ -1,22 +1,128 @@
 import requests
-import json
+import numpy as np
 import pandas as pd
 from pandas import json_normalize
 from datetime import datetime
+from src.http_session import HTTPExtractor, DEFAULT_POOL_SIZE
+from src.governor import RequestGovernor, get_governor
+from src.metrics import timed
+from src.timestamps import to_utc, to_local
+from src.dtypes import apply_contract
 
-class SolarEdgeExtractor(object):
-    def __init__(self, config:dict):
+
+# Fields of an inverter telemetry record, in the order the API sends them.
+# Only the fields present in a window become columns, as with json_normalize.
+TELEMETRY_FIELDS = ('date',
+                    'totalActivePower',
+                    'dcVoltage',
+                    'groundFaultResistance',
+                    'powerLimit',
+                    'totalEnergy',
+                    'temperature',
+                    'inverterMode',
+                    'operationMode',
+                    'vL1To2',
+                    'vL2To3',
+                    'vL3To1')
+TEXT_FIELDS = ('date', 'inverterMode')
+INTEGER_FIELDS = ('operationMode',)
+PHASES = ('L1Data', 'L2Data', 'L3Data')
+PHASE_FIELDS = ('acCurrent',
+                'acVoltage',
+                'acFrequency',
+                'apparentPower',
+                'activePower',
+                'reactivePower',
+                'cosPhi')
+
+
+def flatten_telemetries(records:list) -> dict:
+    # Columns of the records named and ordered like json_normalize, top-level
+    # fields first, then L1Data.acCurrent and so on. Returns None when a
+    # record holds a field outside TELEMETRY_FIELDS/PHASE_FIELDS.
+    n_records = len(records)
+    fields = set()
+    for record in records:
+        fields.update(record)
+    phase_fields = {phase: set() for phase in PHASES if phase in fields}
+    for phase, seen in phase_fields.items():
+        for record in records:
+            values = record.get(phase)
+            if isinstance(values, dict):
+                seen.update(values)
+            elif values is not None:
+                return None
+    if not fields.issubset(TELEMETRY_FIELDS + PHASES) or \
+            any([not seen.issubset(PHASE_FIELDS) for seen in phase_fields.values()]):
+        return None
+
+    # The column list of this window, built once
+    text = [name for name in TELEMETRY_FIELDS if name in fields and name in TEXT_FIELDS]
+    numeric = [name for name in TELEMETRY_FIELDS if name in fields and name not in TEXT_FIELDS]
+    phases = [(phase, [name for name in PHASE_FIELDS if name in seen]) for phase, seen in phase_fields.items()]
+    names = numeric + [f'{phase}.{name}' for phase, phase_names in phases for name in phase_names]
+
+    # Every numeric value goes into one pre-allocated float64 block, a row
+    # per record; None and missing fields become NaN
+    empty = {}
+
+    def row(record:dict) -> list:
+        values = list(map(record.get, numeric))
+        for phase, phase_names in phases:
+            values.extend(map((record.get(phase) or empty).get, phase_names))
+        return values
+
+    block = np.empty((len(names), n_records), dtype=np.float64)
+    try:
+        if n_records > 0 and len(names) > 0:
+            block.T[:] = [row(record) for record in records]
+    except (TypeError, ValueError):
+        # Text where numbers are expected
+        return None
+
+    columns = {}
+    for name in text:
+        column = columns[name] = np.empty(n_records, dtype=object)
+        column[:] = [record.get(name) for record in records]
+    for i, name in enumerate(names):
+        column = block[i]
+        # Integer fields stay integers when every record holds one, as pandas infers them
+        if name in INTEGER_FIELDS and all([isinstance(record.get(name), int) for record in records]):
+            column = column.astype(np.int64)
+        columns[name] = column
+    # json_normalize order: top-level fields as in TELEMETRY_FIELDS, then the phases
+    order = [name for name in TELEMETRY_FIELDS if name in columns] + names[len(numeric):]
+    return {name: columns[name] for name in order}
+
+
+class SolarEdgeExtractor(HTTPExtractor):
+    vendor = 'solaredge'
+
+    def __init__(self, 
+                 config:dict, 
+                 session:requests.Session = None,
+                 pool_size:int = DEFAULT_POOL_SIZE,
+                 governor:RequestGovernor = None):
+        super().__init__(session=session, pool_size=pool_size, governor=governor)
+        self.config = config
         self.site_id = config["SITE_ID"]
         self.api_key = config["API_KEY"]
+        # Telemetry and requests use the site's wall time, known once the site
+        # details are read
+        self.timezone = config.get("TIMEZONE")
+        # SolarEdge counts its daily quota per site
+        self.governor = governor if governor is not None else get_governor('solaredge', str(self.site_id))
         self.component_list_api = f'https://monitoringapi.solaredge.com/equipment/{self.site_id}/list?api_key={self.api_key}'
         self.inverter_data_api = f'https://monitoringapi.solaredge.com/equipment/{self.site_id}/'
         self.site_details_api = f'https://monitoringapi.solaredge.com/site/{self.site_id}/details?api_key={self.api_key}'
+        self.data_period_api = f'https://monitoringapi.solaredge.com/site/{self.site_id}/dataPeriod?api_key={self.api_key}'
+        self.site_energy_api = f'https://monitoringapi.solaredge.com/site/{self.site_id}/energy'
 
     def get_componet_list(self) -> dict:
         try:
-            res = requests.get(self.component_list_api)
+            res = self._get(self.component_list_api)
             if(res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data['reporters']['list']
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
@@ -24,23 +130,31 @@ class SolarEdgeExtractor(object):
             raise e
 
     
-    def get_inverter_data(self,
+    def inverter_data_url(self,
                           serial_number:str,
                           start_time:datetime,
-                          end_time:datetime) -> list:
-    
+                          end_time:datetime) -> str:
         time_format = "%Y-%m-%d %H:%M:%S"
-        start_time = datetime.strftime(start_time, time_format).replace(' ', '%20')
-        end_time = datetime.strftime(end_time, time_format).replace(' ', '%20')
+        start_time = datetime.strftime(to_local(start_time, self.timezone), time_format).replace(' ', '%20')
+        end_time = datetime.strftime(to_local(end_time, self.timezone), time_format).replace(' ', '%20')
 
         api_call = self.inverter_data_api + f'{serial_number}/data?'
         api_call = api_call + f"startTime={start_time}&endTime={end_time}"
         api_call = api_call + f"&api_key={self.api_key}"
+        return api_call
 
+    def get_inverter_data(self,
+                          serial_number:str,
+                          start_time:datetime,
+                          end_time:datetime) -> list:
+    
+        api_call = self.inverter_data_url(serial_number=serial_number,
+                                          start_time=start_time,
+                                          end_time=end_time)
         try:
-            res = requests.get(api_call)
+            res = self._get(api_call)
             if(res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data['data']['telemetries']
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
@@ -49,17 +163,49 @@ class SolarEdgeExtractor(object):
     
     def get_site_details(self) -> dict:
         try:
-            res = requests.get(self.site_details_api)
+            res = self._get(self.site_details_api)
             if(res.ok):
-                data = json.loads(res.content)
+                data = self.decode(res)
                 return data['details']
             else:
                 raise Exception(f"API response not OK: {res.status_code}")
         except requests.exceptions.RequestException as e:
             raise e
     
+    def get_data_period(self) -> dict:
+        try:
+            res = self._get(self.data_period_api)
+            if(res.ok):
+                data = self.decode(res)
+                return data['dataPeriod']
+            else:
+                raise Exception(f"API response not OK: {res.status_code}")
+        except requests.exceptions.RequestException as e:
+            raise e
+
+    def get_site_energy(self,
+                        start_time:datetime,
+                        end_time:datetime,
+                        time_unit:str = 'DAY') -> list:
+        # Daily resolution is limited to one year per request
+        payload = {'startDate': datetime.strftime(to_local(start_time, self.timezone), "%Y-%m-%d"),
+                   'endDate': datetime.strftime(to_local(end_time, self.timezone), "%Y-%m-%d"),
+                   'timeUnit': time_unit,
+                   'api_key': self.api_key}
+        try:
+            res = self._get(self.site_energy_api, params=payload)
+            if(res.ok):
+                data = self.decode(res)
+                return data['energy']['values']
+            else:
+                raise Exception(f"API response not OK: {res.status_code}")
+        except requests.exceptions.RequestException as e:
+            raise e
+    
     def get_site_details_as_df(self) -> pd.DataFrame:
-        site_details = self.get_site_details()
+        return self.site_details_to_df(self.get_site_details())
+
+    def site_details_to_df(self, site_details:dict) -> pd.DataFrame:
         df_site_details = json_normalize(data=site_details, 
                                          meta=['id', 
                                                'name',
@@ -83,6 +229,8 @@ class SolarEdgeExtractor(object):
         
         df_site_details.columns = [c.replace('.', '_') for c in df_site_details.columns]
         df_site_details.rename(columns={'name':'site_name', 'id':'site_id'}, inplace=True)
+        if 'location_timeZone' in df_site_details.columns and not pd.isnull(df_site_details.loc[0, 'location_timeZone']):
+            self.timezone = df_site_details.loc[0, 'location_timeZone']
         return df_site_details
     
     def get_inverter_data_as_df(self, 
@@ -93,38 +241,18 @@ class SolarEdgeExtractor(object):
         inv_data = self.get_inverter_data(serial_number=serial_number,
                                           start_time=start_time,
                                           end_time=end_time)
-        df_inv_data = json_normalize(data=inv_data,
-                                             meta=['date',
-                                                   'totalActivePower',
-                                                   'dcVoltage',
-                                                   'powerLimit',
-                                                   'totalEnergy',
-                                                   'temperature',
-                                                   'operationMode',
-                                                   ['L1Data', 'acCurrent'],
-                                                   ['L1Data', 'acVoltage'],
-                                                   ['L1Data', 'acFrequency'],
-                                                   ['L1Data', 'apparentPower'],
-                                                   ['L1Data', 'activePower'],
-                                                   ['L1Data', 'reactivePower'],
-                                                   ['L1Data', 'cosPhi'],
-                                                   ['L2Data', 'acCurrent'],
-                                                   ['L2Data', 'acVoltage'],
-                                                   ['L2Data', 'acFrequency'],
-                                                   ['L2Data', 'apparentPower'],
-                                                   ['L2Data', 'activePower'],
-                                                   ['L2Data', 'reactivePower'],
-                                                   ['L2Data', 'cosPhi'],
-                                                   ['L3Data', 'acCurrent'],
-                                                   ['L3Data', 'acVoltage'],
-                                                   ['L3Data', 'acFrequency'],
-                                                   ['L3Data', 'apparentPower'],
-                                                   ['L3Data', 'activePower'],
-                                                   ['L3Data', 'reactivePower'],
-                                                   ['L3Data', 'cosPhi'], ])
-                
+        return self.inverter_data_to_df(inv_data)
+
+    @timed('transform')
+    def inverter_data_to_df(self, inv_data:list) -> pd.DataFrame:
+        # Same columns as json_normalize, L1Data.acCurrent -> L1Data_acCurrent,
+        # without building a dict per record
+        columns = flatten_telemetries(inv_data)
+        df_inv_data = pd.DataFrame(columns) if columns is not None else json_normalize(data=inv_data)
         df_inv_data.columns = [c.replace('.', '_') for c in df_inv_data.columns]
         df_inv_data.rename(columns={'date':'datetime'}, inplace=True)
-        return df_inv_data
+        if 'datetime' in df_inv_data.columns:
+            df_inv_data['datetime'] = to_utc(df_inv_data['datetime'], tz=self.timezone)
+        return apply_contract(df_inv_data)
 
 
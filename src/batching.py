@@ -0,0 +1,71 @@
+import logging
+from datetime import datetime
+import pandas as pd
+from src.dtypes import concat_frames
+
+
+DEFAULT_BATCH_ROWS = 2500
+
+
+class FrameBatcher(object):
+    def __init__(self,
+                 flush,
+                 batch_rows:int = DEFAULT_BATCH_ROWS) -> None:
+        # flush(df, start_time, end_time) stores one batch. Frames are held
+        # until batch_rows rows are pending, then concatenated once, handed to
+        # flush and released, so memory stays around one batch.
+        self.flush_func = flush
+        self.batch_rows = batch_rows
+        self.columns = []
+        self._known = set()
+        self._frames = []
+        self._rows = 0
+        self._start_time = None
+        self._end_time = None
+        self.batches = 0
+        self.rows = 0
+
+    def add(self,
+            df:pd.DataFrame,
+            start_time:datetime,
+            end_time:datetime) -> None:
+        if len(df) == 0:
+            return
+        # Running union schema, columns keep the order they first appeared in
+        for c in df.columns:
+            if c not in self._known:
+                self._known.add(c)
+                self.columns.append(c)
+        self._frames.append(df)
+        self._rows += len(df)
+        if self._start_time is None:
+            self._start_time = start_time
+        self._end_time = end_time
+        if self._rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self._frames) == 0:
+            return
+        df = concat_frames(self._frames).reindex(columns=self.columns)
+        start_time, end_time = self._start_time, self._end_time
+        self._frames = []
+        self._rows = 0
+        self._start_time = None
+        self._end_time = None
+        self.flush_func(df, start_time, end_time)
+        self.batches += 1
+        self.rows += len(df)
+
+    def close(self) -> None:
+        # The last partial batch of the range
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        elif len(self._frames) > 0:
+            logging.warning(f'Dropped {self._rows} unflushed rows after {exc_type.__name__}')
@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from src.window_planner import naive, EMPTY_MARGIN
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class CheckpointJournal(object):
+    def __init__(self, db_file:str = None) -> None:
+        # Every finished (vendor, site, device, window) task is kept in a local
+        # SQLite file, so a restarted run skips what was already fetched,
+        # windows without data included
+        self.db_file = db_file or os.path.join(os.getcwd(), 'cache', 'checkpoints.db')
+        os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                                      vendor TEXT NOT NULL,
+                                      site TEXT NOT NULL,
+                                      device TEXT NOT NULL,
+                                      start_time TEXT NOT NULL,
+                                      end_time TEXT NOT NULL,
+                                      status TEXT NOT NULL,
+                                      error TEXT,
+                                      seconds REAL,
+                                      finished_at REAL NOT NULL,
+                                      PRIMARY KEY (vendor, site, device, start_time, end_time))''')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS runs (
+                                      run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                      started_at REAL NOT NULL,
+                                      planned TEXT NOT NULL)''')
+
+    def _key(self, task) -> tuple:
+        return (task.vendor,
+                str(task.site),
+                str(task.device or ''),
+                naive(task.start_time).strftime(TIME_FORMAT),
+                naive(task.end_time).strftime(TIME_FORMAT))
+
+    def is_done(self, task) -> bool:
+        # Done when finished windows of the same site and device cover the
+        # task, whatever their boundaries: a restarted run plans its windows
+        # from the resume point with the planner's current steps
+        vendor, site, device, start_time, end_time = self._key(task)
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM tasks WHERE vendor=? AND site=? AND device=? '
+                                     'AND start_time=? AND end_time=? AND status=?',
+                                     (vendor, site, device, start_time, end_time, 'done')).fetchone()
+            if row is not None or start_time >= end_time:
+                return row is not None
+            # TIME_FORMAT strings sort in time order
+            rows = self._conn.execute('SELECT start_time, end_time FROM tasks WHERE vendor=? AND site=? AND device=? '
+                                      'AND status=? AND start_time<? AND end_time>? ORDER BY start_time',
+                                      (vendor, site, device, 'done', end_time, start_time)).fetchall()
+        covered = start_time
+        for done_start, done_end in rows:
+            if done_start > covered:
+                return False
+            covered = max(covered, done_end)
+            if covered >= end_time:
+                return True
+        return False
+
+    def pending(self, tasks:list) -> tuple:
+        # (tasks still to run, tasks finished by an earlier run)
+        todo = []
+        done = []
+        for task in tasks:
+            (done if self.is_done(task) else todo).append(task)
+        return todo, done
+
+    def start_run(self, tasks:list) -> None:
+        planned = {}
+        for task in tasks:
+            planned[task.vendor] = planned.get(task.vendor, 0) + 1
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO runs (started_at, planned) VALUES (?, ?)',
+                               (time.time(), json.dumps(planned)))
+
+    def record(self,
+               task,
+               seconds:float,
+               error:Exception = None) -> None:
+        # Windows the vendor may still be filling are kept 'open', the next
+        # run fetches them again
+        if error is not None:
+            status = 'failed'
+        elif naive(task.end_time) <= datetime.now() - EMPTY_MARGIN:
+            status = 'done'
+        else:
+            status = 'open'
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               self._key(task) + (status, str(error) if error is not None else None, seconds, time.time()))
+
+    def status(self) -> dict:
+        # Progress of the latest run per vendor, with the throughput so far
+        # and the time left at that pace
+        with self._lock:
+            run = self._conn.execute('SELECT started_at, planned FROM runs ORDER BY run_id DESC LIMIT 1').fetchone()
+            if run is None:
+                return {}
+            started_at, planned = run[0], json.loads(run[1])
+            rows = self._conn.execute('SELECT vendor, status, COUNT(*), SUM(seconds) FROM tasks '
+                                      'WHERE finished_at >= ? GROUP BY vendor, status', (started_at,)).fetchall()
+            totals = self._conn.execute('SELECT vendor, COUNT(*) FROM tasks WHERE status=? GROUP BY vendor',
+                                        ('done',)).fetchall()
+
+        elapsed = max(time.time() - started_at, 1e-9)
+        status = {}
+        for vendor, n_planned in planned.items():
+            done = sum([r[2] for r in rows if r[0] == vendor and r[1] in ('done', 'open')])
+            failed = sum([r[2] for r in rows if r[0] == vendor and r[1] == 'failed'])
+            remaining = max(n_planned - done - failed, 0)
+            rate = done / elapsed
+            status[vendor] = {'planned': n_planned,
+                              'done': done,
+                              'failed': failed,
+                              'remaining': remaining,
+                              'done_all_runs': dict(totals).get(vendor, 0),
+                              'tasks_per_minute': round(rate * 60, 2),
+                              'eta': str(timedelta(seconds=int(remaining / rate))) if rate > 0 and remaining > 0 else None}
+        status['started_at'] = datetime.fromtimestamp(started_at).strftime(TIME_FORMAT)
+        return status
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
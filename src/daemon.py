@@ -0,0 +1,291 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+from src.batching import FrameBatcher
+from src.governor import RequestGovernor
+from src.metrics import add
+from src.scheduler import IngestionScheduler, IngestionTask
+from src.timestamps import as_utc, utc_now
+from src.window_planner import naive
+
+
+# Seconds between polls per vendor, and for the weather of every site.
+# SolarEdge allows 300 calls per site and day, every 15 minutes leaves room
+# for a few inverters per site.
+DEFAULT_POLL_SECONDS = {'solaredge': 900,
+                        'fronius': 60,
+                        'huaweii': 300,
+                        'weather': 3600}
+DEFAULT_FLUSH_ROWS = 500
+DEFAULT_FLUSH_SECONDS = 300
+DEFAULT_METADATA_REFRESH = timedelta(hours=6)
+
+# A stream behind its vendor catches up this many windows per poll
+MAX_WINDOWS_PER_POLL = 8
+# Each poll goes back this far before the end of the previous one, for rows
+# the vendor fills in late
+LATE_DATA = timedelta(minutes=30)
+
+
+class PollStream(object):
+    def __init__(self,
+                 vendor:str,
+                 site:str,
+                 devices:list,
+                 fetch,
+                 store,
+                 watermarks:dict,
+                 step:timedelta,
+                 device_column:str = None,
+                 governor:RequestGovernor = None,
+                 calls:int = 1,
+                 cadence:str = None,
+                 flush_rows:int = DEFAULT_FLUSH_ROWS) -> None:
+        # One polled unit of a vendor: a device, a group of devices fetched
+        # together, or the weather of a site. fetch(start_time, end_time)
+        # returns the frame of one window and store(df, start_time=, end_time=)
+        # writes a batch. watermarks hold the newest instant (UTC) kept per
+        # device, rows at or before it are dropped, so windows may overlap.
+        self.vendor = vendor
+        self.site = site
+        self.devices = devices
+        self.fetch = fetch
+        self.store = store
+        self.watermarks = {device: as_utc(last) for device, last in watermarks.items()}
+        self.step = step
+        self.device_column = device_column
+        self.governor = governor
+        self.calls = calls
+        self.cadence = cadence or vendor
+        self.batcher = FrameBatcher(self._flush, batch_rows=flush_rows)
+        self.fetched = None
+        self.pending_since = None
+        self.rows = 0
+        self._stored = dict(self.watermarks)
+
+    @property
+    def key(self) -> tuple:
+        return (self.cadence, self.vendor, self.site, tuple(self.devices))
+
+    def lag(self) -> timedelta:
+        return utc_now() - min(self.watermarks.values())
+
+    def windows(self, end_time:datetime) -> list:
+        # The newest interval, from the oldest device watermark or shortly
+        # before the previous poll, in windows of at most step
+        cursor = naive(min(self.watermarks.values()))
+        if self.fetched is not None:
+            cursor = max(cursor, self.fetched - LATE_DATA)
+        end_time = naive(end_time)
+        windows = []
+        while cursor < end_time and len(windows) < MAX_WINDOWS_PER_POLL:
+            windows.append((cursor, min(cursor + self.step, end_time)))
+            cursor = cursor + self.step
+        return windows
+
+    def _new_rows(self,
+                  df:pd.DataFrame,
+                  end_time:datetime) -> pd.DataFrame:
+        # Drops the rows already kept and moves the watermarks past the rest
+        if len(df) == 0:
+            return df
+        if self.device_column is None:
+            devices = pd.Series(self.devices[0], index=df.index, dtype=object)
+        else:
+            devices = df[self.device_column].astype(str)
+        since = pd.to_datetime(devices.map(self.watermarks), utc=True)
+        keep = (since.isna() | (df['datetime'] > since)) & (df['datetime'] <= pd.Timestamp(as_utc(end_time)))
+        df = df[keep]
+        for device, last in df['datetime'].groupby(devices[keep]).max().items():
+            self.watermarks[device] = last.to_pydatetime()
+        return df
+
+    def poll_task(self,
+                  end_time:datetime,
+                  flush_seconds:float) -> IngestionTask:
+        windows = self.windows(end_time)
+        if len(windows) == 0:
+            return None
+        return IngestionTask(self.vendor, self.site, self.devices[0] if len(self.devices) == 1 else None,
+                             windows[0][0], windows[-1][1],
+                             self.poll,
+                             governor=self.governor,
+                             cost=len(windows) * self.calls,
+                             windows=windows,
+                             flush_seconds=flush_seconds)
+
+    def poll(self,
+             site:str,
+             device:str,
+             start_time:datetime,
+             end_time:datetime,
+             windows:list,
+             flush_seconds:float) -> None:
+        for window_start, window_end in windows:
+            df = self._new_rows(self.fetch(window_start, window_end), window_end)
+            self.fetched = window_end
+            if len(df) > 0:
+                add('daemon_rows', len(df), vendor=self.vendor, site=site)
+                if self.pending_since is None:
+                    self.pending_since = time.monotonic()
+            self.batcher.add(df, window_start, window_end)
+        if self.due(time.monotonic(), flush_seconds):
+            self.batcher.flush()
+
+    def due(self,
+            now:float,
+            flush_seconds:float) -> bool:
+        return self.pending_since is not None and now - self.pending_since >= flush_seconds
+
+    def flush_task(self) -> IngestionTask:
+        return IngestionTask(self.vendor, self.site, self.devices[0] if len(self.devices) == 1 else None,
+                             naive(min(self.watermarks.values())), datetime.now(),
+                             self.flush)
+
+    def flush(self,
+              site:str = None,
+              device:str = None,
+              start_time:datetime = None,
+              end_time:datetime = None) -> None:
+        self.batcher.flush()
+
+    def _flush(self,
+               df:pd.DataFrame,
+               start_time:datetime,
+               end_time:datetime) -> None:
+        try:
+            self.store(df, start_time=start_time, end_time=end_time)
+        except Exception:
+            # The batch is dropped, its rows are fetched again by the next poll
+            self.watermarks = dict(self._stored)
+            self.fetched = None
+            self.pending_since = None
+            raise
+        self._stored = dict(self.watermarks)
+        self.pending_since = None
+        self.rows += len(df)
+
+    def resume_from(self, stream) -> None:
+        # Takes over the progress of the stream it replaces
+        self.watermarks = dict(stream.watermarks)
+        self._stored = dict(stream._stored)
+        self.fetched = stream.fetched
+
+    def close(self) -> None:
+        try:
+            self.batcher.flush()
+        except Exception as e:
+            logging.error(f'Failed storing the last {self.vendor} batch of site={self.site}, devices={self.devices}: {str(e)}')
+
+
+class PollingDaemon(object):
+    def __init__(self,
+                 scheduler:IngestionScheduler,
+                 pollers:dict,
+                 poll_seconds:dict = None,
+                 flush_seconds:float = DEFAULT_FLUSH_SECONDS,
+                 metadata_refresh:timedelta = DEFAULT_METADATA_REFRESH,
+                 on_tick = None) -> None:
+        # pollers maps each vendor to a callable returning its PollStreams.
+        # It runs at start and every metadata_refresh, new sites and devices
+        # are picked up and the others keep their watermarks and buffers.
+        # Extractors, sessions and tokens stay open for the whole run.
+        self.scheduler = scheduler
+        self.pollers = pollers
+        self.poll_seconds = dict(DEFAULT_POLL_SECONDS)
+        self.poll_seconds.update(poll_seconds or {})
+        self.flush_seconds = flush_seconds
+        self.metadata_refresh = metadata_refresh
+        self.on_tick = on_tick
+        self.streams = {}
+        self._discover_at = {}
+        self._poll_at = {}
+        self._stop = threading.Event()
+
+    def discover(self, vendor:str) -> None:
+        now = time.monotonic()
+        try:
+            streams = self.pollers[vendor]()
+        except Exception as e:
+            logging.error(f'Failed discovering {vendor} sites and devices: {str(e)}')
+            self._discover_at[vendor] = now + self.poll_seconds.get(vendor, 60)
+            return
+        self._discover_at[vendor] = now + self.metadata_refresh.total_seconds()
+
+        fresh = {s.key: s for s in streams}
+        for key, stream in list(self.streams.items()):
+            if stream.vendor == vendor and key not in fresh:
+                stream.close()
+                del self.streams[key]
+        for key, stream in fresh.items():
+            previous = self.streams.get(key)
+            if previous is not None:
+                # Pending rows are stored with the metadata they were fetched with
+                previous.close()
+                stream.resume_from(previous)
+            self.streams[key] = stream
+        logging.info(f'Polling {len(fresh)} {vendor} streams')
+
+    def tick(self) -> list:
+        now = time.monotonic()
+        for vendor in self.pollers.keys():
+            if now >= self._discover_at.get(vendor, 0):
+                self.discover(vendor)
+
+        due = set()
+        for cadence in set([s.cadence for s in self.streams.values()]):
+            if now >= self._poll_at.get(cadence, 0):
+                due.add(cadence)
+                self._poll_at[cadence] = now + self.poll_seconds.get(cadence, 60)
+
+        # A stream is polled when its cadence is due, otherwise its pending
+        # rows are stored once they are flush_seconds old
+        end_time = datetime.now()
+        tasks = []
+        for stream in self.streams.values():
+            task = stream.poll_task(end_time, self.flush_seconds) if stream.cadence in due else None
+            if task is None and stream.due(now, self.flush_seconds):
+                task = stream.flush_task()
+            if task is not None:
+                tasks.append(task)
+        failed = self.scheduler.run(tasks) if len(tasks) > 0 else []
+
+        for cadence in due:
+            polled = [s for s in self.streams.values() if s.cadence == cadence]
+            if len(polled) > 0:
+                lag = max([s.lag() for s in polled])
+                logging.info(f'Polled {len(polled)} {cadence} streams, largest lag {lag}')
+        if self.on_tick is not None:
+            self.on_tick()
+        return failed
+
+    def seconds_to_next(self) -> float:
+        # Until the next poll or time-triggered flush, at least a second
+        deadlines = list(self._poll_at.values()) + list(self._discover_at.values())
+        deadlines += [s.pending_since + self.flush_seconds for s in self.streams.values() if s.pending_since is not None]
+        if len(deadlines) == 0:
+            return 1.0
+        return max(min(deadlines) - time.monotonic(), 1.0)
+
+    def run(self, cycles:int = None) -> None:
+        # Polls until stop() is called, or for cycles ticks. Pending batches
+        # are stored on the way out.
+        ticks = 0
+        try:
+            while not self._stop.is_set():
+                self.tick()
+                ticks += 1
+                if cycles is not None and ticks >= cycles:
+                    break
+                self._stop.wait(self.seconds_to_next())
+        finally:
+            self.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def close(self) -> None:
+        for stream in self.streams.values():
+            stream.close()
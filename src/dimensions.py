@@ -0,0 +1,125 @@
+import logging
+import numbers
+import threading
+from datetime import datetime, timezone
+import pandas as pd
+from botocore.exceptions import ClientError
+from src.metrics import add
+
+
+DIMENSIONS_FOLDER = '_dimensions'
+LAYOUTS = ('wide', 'star')
+UPDATED_AT = 'updated_at'
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+def _normalize(value, like = None) -> str:
+    # Same text for a value before and after a CSV or Parquet round trip.
+    # Stored tables are read as text (CSV) or with their types (Parquet);
+    # like is the incoming value, a stored cell is compared as a number only
+    # when the incoming one is a number.
+    if isinstance(value, (list, dict)):
+        return str(value)
+    if pd.isnull(value) or (isinstance(value, str) and value == ''):
+        return ''
+    like = value if like is None else like
+    if _is_number(like):
+        try:
+            return repr(float(value))
+        except (TypeError, ValueError):
+            return str(value)
+    if isinstance(like, datetime):
+        try:
+            value = pd.Timestamp(value)
+        except (TypeError, ValueError):
+            pass
+    # CSV files hold midnight timestamps as plain dates
+    value = str(value)
+    return value[:-len(' 00:00:00')] if value.endswith(' 00:00:00') else value
+
+
+def _key(value) -> str:
+    # Table key of a row, 12345 from the API and '12345' from the file alike
+    if _is_number(value) and float(value).is_integer():
+        return str(int(value))
+    return _normalize(value)
+
+
+def same_row(stored:dict, row:dict) -> bool:
+    # Missing and null fields don't count, a table holding more columns than
+    # the row still matches it
+    columns = set([c for c, v in stored.items() if c != UPDATED_AT and _normalize(v) != ''])
+    columns.update([c for c, v in row.items() if c != UPDATED_AT and _normalize(v) != ''])
+    return all([_normalize(stored.get(c), like=row.get(c)) == _normalize(row.get(c)) for c in columns])
+
+
+class DimensionStore(object):
+    def __init__(self,
+                 aws_s3,
+                 bucket:str = 'prod-satia-raw-data') -> None:
+        # Site and device tables of the star layout, one file per vendor and
+        # table under <Vendor>/_dimensions/. Each table is read once per run
+        # and written back only when a row is new or changed.
+        self.aws_s3 = aws_s3
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._tables = {}
+        self.writes = 0
+
+    def table_key(self, vendor_folder:str, table:str) -> str:
+        return f'{vendor_folder}/{DIMENSIONS_FOLDER}/{table}.{self.aws_s3.writer.extension}'
+
+    def _load(self,
+              vendor_folder:str,
+              table:str,
+              key:str) -> dict:
+        if (vendor_folder, table) not in self._tables:
+            try:
+                df = self.aws_s3.read_df_from_s3(object_key=self.table_key(vendor_folder, table),
+                                                 bucket_name=self.bucket,
+                                                 text=True)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                    raise e
+                df = pd.DataFrame(columns=[key])
+            rows = {}
+            for row in df.to_dict('records'):
+                rows[_key(row[key])] = row
+            self._tables[(vendor_folder, table)] = {'columns': list(df.columns), 'rows': rows}
+        return self._tables[(vendor_folder, table)]
+
+    def upsert(self,
+               vendor_folder:str,
+               table:str,
+               df:pd.DataFrame,
+               key:str) -> int:
+        # Returns the number of rows added or changed
+        if df is None or len(df) == 0:
+            return 0
+        with self._lock:
+            state = self._load(vendor_folder, table, key)
+            updated_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            changed = 0
+            for row in df.drop_duplicates(subset=[key], keep='last').to_dict('records'):
+                row_key = _key(row[key])
+                stored = state['rows'].get(row_key)
+                if stored is not None and same_row(stored, row):
+                    continue
+                row[UPDATED_AT] = updated_at
+                state['rows'][row_key] = row
+                state['columns'] += [c for c in row.keys() if c not in state['columns']]
+                changed += 1
+            if changed > 0:
+                columns = [key] + [c for c in state['columns'] if c not in (key, UPDATED_AT)] + [UPDATED_AT]
+                df_table = pd.DataFrame(list(state['rows'].values()), columns=columns)
+                self.aws_s3.store_df_s3(df=df_table,
+                                        folder=f'{vendor_folder}/{DIMENSIONS_FOLDER}',
+                                        file_name=f'{table}.csv',
+                                        bucket_name=self.bucket)
+                self.writes += 1
+                add('dimension_rows', changed, vendor=vendor_folder.lower())
+                logging.info(f'Upserted {changed} rows of {self.table_key(vendor_folder, table)}')
+        return changed
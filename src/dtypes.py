@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from src.timestamps import UTC_DTYPE, to_utc
+
+
+# Dtype contract of the telemetry frames of every vendor, applied by the
+# extractors as they build each frame:
+#
+#   datetime                  datetime64[ns, UTC], see src/timestamps.py
+#   identifiers (below)       category, also when the values look numeric
+#   measurements              float32, numeric strings included
+#   cumulative counters,      float64, float32 can't hold them to the unit
+#   values beyond 2**24
+#   integers                  int32, int64 for epochs and values beyond int32
+#   booleans                  bool
+#   other text                category
+#
+# FusionSolar devId stays int64, it is the key of the device table.
+IDENTIFIER_COLUMNS = ('site_id', 'component_id', 'pvSystemId', 'deviceId', 'plantCode', 'sn', 'devDn')
+FLOAT64_COLUMNS = ('totalEnergy', 'dataItemMap_total_cap', 'dataItemMap_mppt_total_cap', 'dataItemMap_day_cap')
+INT64_COLUMNS = ('devId', 'collectTime')
+FLOAT32_MAX_EXACT = 2 ** 24
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def _numeric_dtype(name:str, values:pd.Series) -> str:
+    if values.dtype.kind == 'b':
+        return 'bool'
+    if values.dtype.kind in 'iu':
+        if name in INT64_COLUMNS or (len(values) > 0 and values.abs().max() > INT32_MAX):
+            return 'int64'
+        return 'int32'
+    if name in FLOAT64_COLUMNS or values.abs().max() > FLOAT32_MAX_EXACT:
+        return 'float64'
+    return 'float32'
+
+
+def apply_contract(df:pd.DataFrame) -> pd.DataFrame:
+    # Converts the columns of df in place and returns it
+    for c in df.columns:
+        values = df[c]
+        if c == 'datetime':
+            if pd.api.types.is_datetime64_any_dtype(values.dtype) and str(values.dtype) != UTC_DTYPE:
+                # Naive timestamps are UTC, as to_utc reads them without a timezone
+                df[c] = to_utc(values)
+            continue
+        if isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_datetime64_any_dtype(values.dtype):
+            continue
+        if c in IDENTIFIER_COLUMNS and c not in INT64_COLUMNS:
+            df[c] = values.astype('category')
+            continue
+        if values.dtype.kind in 'biuf':
+            df[c] = values.astype(_numeric_dtype(c, values))
+            continue
+        # Text and object columns: numbers when every value parses, category otherwise
+        try:
+            numeric = pd.to_numeric(values, errors='coerce')
+            if numeric.notna().sum() == values.notna().sum():
+                df[c] = numeric.astype(_numeric_dtype(c, numeric))
+            else:
+                df[c] = values.astype('category')
+        except TypeError:
+            # Nested values (lists, dicts) are left as they are
+            pass
+    return df
+
+
+def identifier(value, n_rows:int) -> pd.Categorical:
+    # Column of one repeated identifier, e.g. the device of a frame
+    return pd.Categorical.from_codes(np.zeros(n_rows, dtype=np.int8), categories=[value])
+
+
+def concat_frames(frames:list) -> pd.DataFrame:
+    # pd.concat, but categorical columns keep their dtype when the frames
+    # hold different categories
+    frames = [f for f in frames if f is not None]
+    if len(frames) <= 1:
+        return pd.concat(frames, ignore_index=True) if len(frames) == 1 else pd.DataFrame()
+    categorical = set()
+    for f in frames:
+        categorical.update([c for c in f.columns if isinstance(f[c].dtype, pd.CategoricalDtype)])
+    for c in categorical:
+        parts = [f[c] for f in frames if c in f.columns]
+        try:
+            categories = union_categoricals([p.astype('category') for p in parts], ignore_order=True).categories
+        except TypeError:
+            # Categories of different types, the column ends up as object
+            continue
+        dtype = pd.CategoricalDtype(categories)
+        frames = [f.assign(**{c: f[c].astype(dtype)}) if c in f.columns else f for f in frames]
+    return pd.concat(frames, ignore_index=True)
@@ -1,384 +1,222 @@
 import json
 from argparse import ArgumentParser
 import os
+import signal
 import sys
-from datetime import datetime, timedelta
 import logging
-from unidecode import unidecode
-
-sys.path.insert(0, os.getcwd())
-
-from src.api_solared import *
-from src.api_fronius import *
-from src.api_huaweii import *
-from src.api_metomatics import *
-from src.api_aws import *
-
-
-
-
-
-def store_solaredge_inverter_data_to_S3(sites:dict,
-                                        meteo_credentials:dict,
-                                        aws_access_key_id,
-                                        aws_secret_key,
-                                        coordinates:dict,
-                                        start_time:datetime = None,
-                                        end_time:datetime = None):
-
-    meteo_extractor = MeteoExtractor(meteo_credentials)
-    aws_s3 = AWS3Extractor(aws_secret_key=aws_secret_key,
-                           aws_access_key_id=aws_access_key_id)
-
-    for site in sites.keys():
-        solaredge_extr = SolarEdgeExtractor(sites[site])
-        try:
-            df_site_details = solaredge_extr.get_site_details_as_df()
-        except Exception as e:
-            logging.error('Failed calling SolarEdge API get_site_details method')
-            raise e
-        
-        installation_date = datetime.strptime(df_site_details.loc[0,'installationDate'], '%Y-%m-%d')
-        site_id = df_site_details.loc[0, 'site_id']
-        city = df_site_details.loc[0, 'location_city']
-        timezone = df_site_details.loc[0, 'location_timeZone']
-        
-        try:
-            components = solaredge_extr.get_componet_list()
-        except Exception as e:
-            logging.error('Failed calling SolarEdge API get_component_list method')
-            raise e
-        
-        df_components = pd.DataFrame(components)
-        df_components['site_id'] = site_id
-        df_components.rename(columns={'serialNumber' : 'component_id',
-                                      'name':'component_name'}, inplace=True)
-
-        for j in range(len(df_components)):
-            serial_number = df_components.loc[j,'component_id']
-    
-            start_time = aws_s3.get_last_data_date(folder=f'SolarEdge/{site.upper()}/PlantData')
-            if start_time == None:
-                start_time = installation_date
-            
-            while start_time <= datetime.now():
-                end_time = start_time + timedelta(days=5)
-
-                try:
-                    if site in coordinates.keys():
-                        lon = coordinates[site]["lon"]
-                        lat = coordinates[site]["lat"]
-                        df_meteo = meteo_extractor.get_wheather_data(start_date=start_time,
-                                                                     end_date=end_time,
-                                                                     timezone=timezone,
-                                                                     lon=lon,
-                                                                     lat=lat)
-                    else:
-                        df_meteo = meteo_extractor.get_wheather_data(start_date=start_time,
-                                                                     end_date=end_time,
-                                                                     timezone=timezone,
-                                                                     place=city)
-                except Exception as e:
-                    logging.error(str(e))
-
-                try:
-                    df_inv_data = solaredge_extr.get_inverter_data_as_df(serial_number=serial_number,
-                                                                         start_time=start_time,
-                                                                         end_time=end_time)
-                    
-                    logging.info(f"Extracted SolarEdge API get_inverter_data method for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
-                except Exception as e:
-                    logging.error(f"Failed calling SolarEdge API get_inverter_data method for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
-                    logging.error(str(e))
-                    continue
-            
-                df_inv_data['component_id'] = serial_number
-                df_inv_data = pd.merge(df_inv_data, df_components, on='component_id', how='inner')
-                df_inv_data = pd.merge(df_inv_data, df_site_details, on='site_id', how='inner')
-
-                
-                try:
-                    if len(df_inv_data) >  0:
-                        idx_cols = ['datetime'] + list(df_site_details.columns) + [c for c in df_components.columns if c!='site_id']
-                        data_cols = [c for c in df_inv_data.columns if c not in idx_cols]
-                        df_inv_data = df_inv_data[idx_cols + data_cols].drop_duplicates()
-                        aws_s3.store_csv_s3(df = df_inv_data,
-                                            folder=f'SolarEdge/{site.upper()}/PlantData',
-                                            file_name=f'inverter_details_{start_time}_{serial_number}.csv')
-                        
-                        logging.info(f"Data stored into S3 for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
-                    else:
-                        logging.warning(f"No data retrieved for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
-                
-                except Exception as e:
-                    logging.error(f"Couldn't store inverter data into S3 for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
-                    raise(e)
-
-                try:
-                    if len(df_meteo) > 0:
-                        aws_s3.store_csv_s3(df = df_meteo,
-                                            folder=f'SolarEdge/{site.upper()}/WeatherData',
-                                            file_name=f'weather_data_{start_time}.csv')
-                except Exception as e:
-                    raise(e)
-                
-                start_time = end_time 
-    return
-
-
-
-
-
-
-def store_fronius_inverter_data_to_S3(sites:dict,
-                                      meteo_credentials:dict,
-                                      aws_secret_key:str,
-                                      aws_access_key_id: str,
-                                      coordinates:dict,
-                                      start_time:datetime = None,
-                                      end_time:datetime = None):
-    
-    def equalize_fronius_dataframes(list_df:list) -> list:
-        final_dfs = []
-        cols = []
-        for df in list_df:
-            cols += list(df.columns)
-        tot_cols = list(set(cols))
-        for df in list_df:
-            cols_df = set(df.columns)
-            diff_cols = list(set(tot_cols).difference(cols_df))
-            if len(diff_cols) > 0:
-                for cd in diff_cols:
-                    df[cd] = None
-            final_dfs.append(df[tot_cols])
-        return final_dfs
-
-    
-    fronius_ext = FroniusExtractor(sites)
-    meteo_extractor = MeteoExtractor(meteo_credentials)
-    aws_s3 = AWS3Extractor(aws_secret_key=aws_secret_key,
-                           aws_access_key_id=aws_access_key_id)
-    
-    try:
-        df_pvs = fronius_ext.get_pv_systems_and_components()
-    except Exception as e:
-        logging.error('Failed calling Fronius API get_pv_systems_and_components')
-        raise e
-    
-    
-    for s, d in zip(df_pvs['pvSystemIds'], df_pvs['deviceIds']):
-        # Get PV System details
-        try:
-            df_pvs_details = fronius_ext.get_pv_system_details_as_df(pv_system_id=s)
-            site = df_pvs_details.loc[0, 'name']
-            site = unidecode(site.upper())
-            timezone = df_pvs_details.loc[0, 'timeZone']
-            city = df_pvs_details.loc[0, 'address_city']
-            installation_date = df_pvs_details.loc[0, 'installationDate']
-            logging.info(f'Successfully extracted pv system details for pv_system={s}')
-        except Exception as e:
-            logging.error(f'Failed calling Fronius API get_pv_system_details method for pv_system={s}')
-            logging.error(str(e))
-
-        # Get Device details
-        try:
-            df_dev_details = fronius_ext.get_device_details_as_df(pv_system_id=s, device_id=d)
-            logging.info(f'Successfully extracted pv device details for pv_system={s} and device_id={d}')
-        except Exception as e:
-            logging.error(f'Failed calling Fronius API get_device_details method for pv_system={s} and device_id={d}')
-
-
-        start_time = aws_s3.get_last_data_date(folder=f'Fronius/{site}/PlantData')
-        if start_time == None:
-            start_time = installation_date
-        days = 0
-        inv_data_list = []
-        while start_time <= datetime.now():
-            if days <= 7:
-                end_time = start_time + timedelta(days=1)
-                try:
-                    df_inv_data = fronius_ext.get_device_data_as_df(pv_system_id = s,
-                                                                    device_id = d,
-                                                                    start_time = start_time,
-                                                                    end_time=end_time)
-                    
-                    if len(df_inv_data) > 0:
-                        df_inv_data['deviceId'] = d
-                        df_inv_data['pvSystemId'] = s
-                        inv_data_list.append(df_inv_data)
-                        logging.info(f"Extracted Fronius API get_inverter_data method for system={s}, device={d}, start_time={start_time}, end_time={end_time}")
-                        days += 1
-                except Exception as e:
-                    logging.error(f"Failed calling Fronius API get_inverter_data method for system={s}, device={d}, start_time={start_time}, end_time={end_time}")
-                    logging.error(str(e))
-            else:
-                days = 0
-                inv_data_eq = equalize_fronius_dataframes(inv_data_list)
-                df_inv_data = pd.concat(inv_data_eq)
-
-
-                try:
-                    if len(df_inv_data) > 0:
-                        df_inv = pd.merge(df_inv_data, df_dev_details, on='deviceId', how='inner')
-                        df_inv = pd.merge(df_inv, df_pvs_details, on='pvSystemId', how='inner')
-
-                        df_inv = df_inv[['datetime'] + [c for c in df_pvs_details.columns if c != 'datetime'] + 
-                                        [c for c in df_dev_details.columns if c not in ['datetime', 'pvSystemId']] +
-                                        [c for c in df_inv_data.columns if c not in ['datetime', 'pvSystemId', 'deviceId']]]
-                        
-                        aws_s3.store_csv_s3(df = df_inv_data,
-                                            folder=f'Fronius/{site}/PlantData',
-                                            file_name=f'inverter_details_{start_time}_{d}.csv')
-                        
-                        # Extract meteo data
-                        if site in coordinates.keys():
-                            df_meteo = meteo_extractor.get_wheather_data(start_date=datetime.strptime(min(df_inv['datetime']), '%Y-%m-%d %H:%M:%S'),
-                                                                        end_date=datetime.strptime(max(df_inv['datetime']), '%Y-%m-%d %H:%M:%S'),
-                                                                        timezone=timezone,
-                                                                        lon=coordinates[site]["lon"],
-                                                                        lat=coordinates[site]["lat"])
-                        else:
-
-                            df_meteo = meteo_extractor.get_wheather_data(start_date=datetime.strptime(min(df_inv['datetime']), '%Y-%m-%d %H:%M:%S'),
-                                                                        end_date=datetime.strptime(max(df_inv['datetime']), '%Y-%m-%d %H:%M:%S'),
-                                                                        timezone=timezone,
-                                                                        place=city)
-
-                        if len(df_meteo) > 0:
-                            aws_s3.store_csv_s3(df = df_meteo,
-                                                folder=f'Fronius/{site}/WeatherData',
-                                                file_name=f'weather_data_{start_time}.csv')
-
-                except Exception as e:
-                    logging.error(f"Couldn't store inverter data into S3 for for system={s}, device={d}, start_time={start_time}, end_time={end_time}")
-                    raise(e)
-            start_time = end_time
-
-
-def store_huaweii_inverter_data_to_S3(sites:dict,
-                                      meteo_credentials:dict,
-                                      aws_secret_key:str,
-                                      aws_access_key_id: str):
-    extractor = HuaweiiExtractor(sites)
-    meteo_extractor = MeteoExtractor(meteo_credentials)
-    aws_s3 = AWS3Extractor(aws_secret_key=aws_secret_key,
-                           aws_access_key_id=aws_access_key_id)
-    try:
-        extractor.log_in()
-    except Exception as e:
-        logging.error(f'Failed to login in Huaweii API: {str(e)}')
-    
-    try:
-        plants = extractor.get_plant_list()
-        df_plants = pd.DataFrame(plants)
-        plantCodes = df_plants.plantCode.unique()
-    except Exception as e:
-        logging.error(f'Failed calling Huaweii API get_plant_list: {str(e)}')
-    
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+# Imports resolve from the repository root, whatever the working directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.vendors import VENDORS, VENDOR_FOLDERS, load_vendor
+from src.checkpoints import CheckpointJournal
+from src.metrics import metrics
+
+
+def print_checkpoint_status(journal:CheckpointJournal) -> None:
+    status = journal.status()
+    if not status:
+        print('No ingestion run recorded yet')
+        return
+    print(f"Run started at {status.pop('started_at')}")
+    for vendor, progress in status.items():
+        print(f"{vendor}: {progress['done']}/{progress['planned']} tasks done, {progress['failed']} failed, "
+              f"{progress['remaining']} remaining, {progress['tasks_per_minute']} tasks/min, "
+              f"ETA {progress['eta'] or '-'} ({progress['done_all_runs']} done over all runs)")
+
+
+def write_metrics(metrics_file:str = None) -> None:
+    # Prometheus text for *.prom files, a JSON summary otherwise. Without a
+    # file the summary goes to the log.
+    registry = metrics()
+    if metrics_file is None:
+        logging.info(f'Stage metrics: {registry.to_json()}')
+        return
+    with open(metrics_file, 'w') as f:
+        f.write(registry.to_prometheus() if metrics_file.endswith('.prom') else registry.to_json())
+
+
+def run_daemon(args:ArgumentParser,
+               config:dict,
+               coord:dict,
+               apis:list,
+               stack:ExitStack,
+               scheduler,
+               meteo_extractor,
+               aws_s3,
+               planner,
+               schemas) -> None:
+    # Polls the vendors of --api until SIGTERM or Ctrl-C, the extractors stay
+    # open on the stack of main
+    from src.daemon import PollingDaemon, DEFAULT_FLUSH_ROWS, DEFAULT_FLUSH_SECONDS
+    daemon_config = config.get("DAEMON", {})
+    pollers = {}
+    for api in apis:
+        vendor = VENDORS[api]
+        pollers[api] = load_vendor(api).build_poller(stack,
+                                                     sites=config[vendor['config']],
+                                                     coordinates=coord.get(vendor['config'], {}),
+                                                     pool_size=scheduler.vendor_limits[api],
+                                                     meteo_extractor=meteo_extractor,
+                                                     aws_s3=aws_s3,
+                                                     planner=planner,
+                                                     schemas=schemas,
+                                                     flush_rows=daemon_config.get("FLUSH_ROWS", DEFAULT_FLUSH_ROWS))
+    daemon = PollingDaemon(scheduler, pollers,
+                           poll_seconds=daemon_config.get("POLL_SECONDS"),
+                           flush_seconds=daemon_config.get("FLUSH_SECONDS", DEFAULT_FLUSH_SECONDS),
+                           metadata_refresh=timedelta(hours=daemon_config.get("METADATA_REFRESH_HOURS", 6)),
+                           on_tick=(lambda: write_metrics(args.metrics_file)) if args.metrics_file else None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
     try:
-        devices = extractor.get_device_list(plantCodes)
-        df_devices = pd.DataFrame(devices)
-        df_devices = df_devices[df_devices.devTypeId == 1]
-        df_devices.rename(columns={'stationCode':'plantCode'}, inplace=True)
-    except Exception as e:
-        logging.error(f'Failed calling Huaweii API get_device_list for plants {plantCodes}: {str(e)}')
-    
-    df = pd.merge(df_devices, df_plants, on='plantCode', how='inner')
-    df.rename(columns={'id': 'devId'}, inplace=True)
-    
-    for pl in range(len(df_plants)):
-        plant = df_plants.loc[pl, 'plantCode']
-        site = df_plants.loc[pl, 'plantName']
-        lon = df_plants.loc[pl, 'longitude']
-        lat = df_plants.loc[pl, 'latitude']
-
-        if (lon != None) & (lon != '1.000000') & (lat != None) & (lat != '1.000000') & (lon != '0.000000') & (lat != '0.000000'):
-            lat = lat + "N"
-            lon = str(abs(float(lon))) + "W"
-        else:
-            lat = None
-            lon = None
-
-        devices = list(df[df['plantCode'] == plant]['devId'])
-        devices = [str(d) for d in devices]
-
-        start_date = aws_s3.get_last_data_date(folder=f'Huaweii/{site.upper()}/PlantData')
-        if start_date == None:
-            start_date = df_plants.loc[pl, 'gridConnectionDate']
-        
-        start_date = datetime.strptime(start_date, "%Y-%m-%dT%H:%M:%S%z")
-        end_date = start_date + timedelta(days=3)
-        
-        while end_date <= datetime.now(end_date.tzinfo):
-            start_time = int(start_date.timestamp() * 1000)
-            end_time = int(end_date.timestamp() * 1000)
-
-            try:
-                df_dev_data = extractor.get_device_data_as_df(devices, start_time, end_time)
-            except Exception as e:
-                logging.error(f'Failed calling Huaweii API get_device_data for devices {devices}: {str(e)}')
-            
-            df_ = pd.merge(df, df_dev_data, on='devId', how='inner')
-
-            # Extract meto data
-            if (lon != None) & (lat != None):
-                df_meteo = meteo_extractor.get_wheather_data(start_date=start_date,
-                                                             end_date=end_date,
-                                                             lon=lon,
-                                                             lat=lat)
-            else:
-                df_meteo = pd.DataFrame()
-
-            try:
-                if len(df_dev_data) >  0:
-
-                    aws_s3.store_csv_s3(df = df_,
-                                        folder=f'Huaweii/{site.upper()}/PlantData',
-                                        file_name=f'inverter_details_{start_date.strftime("%Y-%m-%d %H:%M:%S")}_.csv')
-                    
-                    logging.info(f"Data stored into S3 for site={site}, start_time={start_time}, end_time={end_time}")
-                else:
-                    logging.warning(f"No data retrieved for site={site}, start_time={start_time}, end_time={end_time}")
-                
-                if len(df_meteo) > 0:
-                    aws_s3.store_csv_s3(df = df_meteo,
-                                        folder=f'Huaweii/{site.upper()}/WeatherData',
-                                        file_name=f'weather_data_{start_date.strftime("%Y-%m-%d %H:%M:%S")}_.csv')
-
-            except Exception as e:
-                logging.error(f"Couldn't store inverter data into S3 for site={site}, start_time={start_time}, end_time={end_time}")
-                raise(e)
-            start_date = end_date
-            end_date = start_date + timedelta(days=3)
+        daemon.run(cycles=args.daemon_cycles)
+    except KeyboardInterrupt:
+        logging.info('Daemon interrupted, pending batches were stored')
 
 
 def main(args: ArgumentParser) -> None:
+    journal = CheckpointJournal()
+    if args.status:
+        print_checkpoint_status(journal)
+        return
+
+    # pandas, boto3 and the vendor extractors load from here on, and only the
+    # vendors of --api are imported
+    from src.api_aws import AWS3Extractor
+    from src.api_metomatics import MeteoExtractor
+    from src.scheduler import IngestionScheduler, DEFAULT_VENDOR_LIMITS
+    from src.meteo_cache import PlaceCache
+    from src.window_planner import WindowPlanner
+    from src.governor import configure_governors, governors
+    from src.schema_registry import SchemaRegistry
+    from src.pipeline_common import build_weather_cache, run_ingestion_tasks
+
     with open(args.config_file) as f:
         config = json.load(f)
     
     with open(args.coord_file) as f:
         coord = json.load(f)
 
-    print(args.api)
+    apis = list(VENDOR_FOLDERS.keys()) if 'all' in args.api else args.api
+    print(apis)
+
+    # Vendor calls can be recorded to, or replayed from, a cassette directory
+    if (args.record or args.replay) and args.async_io:
+        raise ValueError('--record and --replay apply to the threaded extractors, drop --async_io')
+    if args.daemon and args.async_io:
+        raise ValueError('--daemon polls with the threaded extractors, drop --async_io')
+    if args.record or args.replay:
+        from src.http_session import set_transport
+        from src.replay import Cassette, RecordingAdapter, ReplayAdapter
+    if args.record:
+        cassette = Cassette(args.record)
+        set_transport(lambda pool_size: RecordingAdapter(cassette, pool_size=pool_size))
+    elif args.replay:
+        cassette = Cassette(args.replay)
+        set_transport(lambda pool_size: ReplayAdapter(cassette, pool_size=pool_size))
+
+    # Every worker thread may hold one S3 connection
+    vendor_limits = dict(DEFAULT_VENDOR_LIMITS)
+    vendor_limits.update(config.get("CONCURRENCY") or {})
+    client = None
+    if args.local_s3:
+        from src.local_s3 import LocalS3Client
+        client = LocalS3Client(args.local_s3)
+    aws_s3 = AWS3Extractor(aws_secret_key=config["AWS_SECRET_ACCESS_KEY"],
+                           aws_access_key_id=config["AWS_ACCESS_KEY_ID"],
+                           output_format=args.output_format or config.get("OUTPUT_FORMAT", 'csv'),
+                           max_pool_connections=sum(vendor_limits.values()) + config["METEOSOURCE"].get("MAX_WORKERS", 4),
+                           client=client,
+                           layout=args.layout or config.get("OUTPUT_LAYOUT", 'wide'))
+
+    if args.migrate_to_parquet:
+        for api in apis:
+            migrated = aws_s3.migrate_csv_to_parquet(prefix=f'{VENDOR_FOLDERS[api]}/',
+                                                     delete=args.delete_migrated_csv)
+            print(f'Migrated {migrated} {api} CSV files to Parquet')
+        return
+
+    if args.rebuild_watermarks:
+        for api in apis:
+            rebuilt = aws_s3.rebuild_watermarks(prefix=f'{VENDOR_FOLDERS[api]}/')
+            for key, last_date in rebuilt.items():
+                logging.info(f'Rebuilt watermark {key}: {last_date}')
+            print(f'Rebuilt {len(rebuilt)} {api} watermarks')
+        return
+
+    configure_governors(config.get("RATE_LIMITS"))
+    with ExitStack() as stack:
+        # Daemon polls aren't journaled, every poll asks for the newest interval
+        scheduler = stack.enter_context(IngestionScheduler(vendor_limits=vendor_limits,
+                                                           journal=None if args.daemon else journal))
+        limits = scheduler.vendor_limits
+
+        places = PlaceCache()
+        for vendor_coordinates in coord.values():
+            places.warm(vendor_coordinates)
+
+        # HTTP pools are sized to the number of workers that share them
+        meteo_workers = config["METEOSOURCE"].get("MAX_WORKERS", 4)
+        meteo_extractor = stack.enter_context(MeteoExtractor(config["METEOSOURCE"],
+                                                             pool_size=meteo_workers + sum([limits[api] for api in apis]),
+                                                             cache=build_weather_cache(config, client_factory=aws_s3.get_client),
+                                                             places=places,
+                                                             max_workers=meteo_workers,
+                                                             rate_limit=config["METEOSOURCE"].get("RATE_LIMIT")))
+        planner = WindowPlanner()
+        schemas = SchemaRegistry()
+        if args.daemon:
+            run_daemon(args, config, coord, apis,
+                       stack=stack,
+                       scheduler=scheduler,
+                       meteo_extractor=meteo_extractor,
+                       aws_s3=aws_s3,
+                       planner=planner,
+                       schemas=schemas)
+        else:
+            planners = {}
+            for api in apis:
+                vendor = VENDORS[api]
+                planners[api] = load_vendor(api).build_planner(stack,
+                                                               sites=config[vendor['config']],
+                                                               coordinates=coord.get(vendor['config'], {}),
+                                                               pool_size=limits[api],
+                                                               meteo_extractor=meteo_extractor,
+                                                               aws_s3=aws_s3,
+                                                               planner=planner,
+                                                               schemas=schemas)
+
+            # Vendors are planned side by side and their tasks share one scheduler run
+            tasks = []
+            unplanned = []
+            with ThreadPoolExecutor(max_workers=len(apis)) as executor:
+                futures = {api: executor.submit(planners[api]) for api in apis}
+            for api, future in futures.items():
+                try:
+                    tasks += future.result()
+                except Exception as e:
+                    logging.error(f'Failed planning {api} ingestion: {str(e)}')
+                    unplanned.append(api)
 
-    if args.api == 'solaredge':
-        store_solaredge_inverter_data_to_S3(sites=config["SOLAREDGE"],
-                                            meteo_credentials=config["METEOSOURCE"],
-                                            coordinates=coord["SOLAREDGE"],
-                                            aws_secret_key=config["AWS_SECRET_ACCESS_KEY"],
-                                            aws_access_key_id=config["AWS_ACCESS_KEY_ID"])
-    
-    elif args.api == 'fronius':
-        store_fronius_inverter_data_to_S3(sites=config["FRONIUS"],
-                                          meteo_credentials=config["METEOSOURCE"],
-                                          coordinates=coord["FRONIUS"],
-                                          aws_secret_key=config["AWS_SECRET_ACCESS_KEY"],
-                                          aws_access_key_id=config["AWS_ACCESS_KEY_ID"])
-    elif args.api == 'huaweii':
-        store_huaweii_inverter_data_to_S3(sites = config["HUAWEII"],
-                                          meteo_credentials = config["METEOSOURCE"],
-                                          aws_secret_key=config["AWS_SECRET_ACCESS_KEY"],
-                                          aws_access_key_id=config["AWS_ACCESS_KEY_ID"])
+            if args.async_io:
+                import asyncio
+                from src.pipeline_common import run_ingestion_tasks_async
+                failed = asyncio.run(run_ingestion_tasks_async(tasks, aws_s3, config.get("ASYNC_CONCURRENCY"), journal))
+            else:
+                failed = run_ingestion_tasks(tasks, aws_s3, scheduler)
+        planner.save()
+        schemas.save()
+    logging.info(f'S3 upload stats: {aws_s3.upload_stats()}')
+    for governor in governors():
+        logging.info(f'API calls of {governor.name}: {governor.requests}, retries: {governor.retries}, left today: {governor.remaining()}')
+    write_metrics(args.metrics_file)
+    if not args.daemon:
+        print(f'Ran {len(tasks)} tasks, {len(failed)} failed')
+        if len(unplanned) > 0:
+            print(f'Failed planning {", ".join(unplanned)}, see logs/upload.log')
     print('Done')
     
 
@@ -388,8 +226,8 @@ def main(args: ArgumentParser) -> None:
 
 if __name__ == "__main__":
     logging.basicConfig(filename=os.path.join(os.getcwd(), 'logs', 'upload.log'),
-                        filemode='w', 
-                        format='%(name)s - %(levelname)s - %(message)s')
+                        filemode='a',
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     parser = ArgumentParser()
     parser.add_argument('--config_file',
                         type=str,
@@ -404,8 +242,92 @@ if __name__ == "__main__":
     parser.add_argument('--api',
                         type=str,
                         required=False,
-                        default='huaweii',
-                        choices=['huaweii', 'fronius', 'solaredge'])
+                        nargs='+',
+                        default=['huaweii'],
+                        choices=list(VENDORS.keys()) + ['all'])
+
+    parser.add_argument('--async_io',
+                        action='store_true',
+                        help='Fetch the planned windows with the asyncio extractors (requires aiohttp)')
+
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help='Keep running and poll --api for the newest data, see "DAEMON" in the config file')
+
+    parser.add_argument('--daemon_cycles',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='Stop the daemon after this many polling cycles')
+
+    parser.add_argument('--status',
+                        action='store_true',
+                        help='Print the progress and ETA of the latest ingestion run from the checkpoint journal')
+
+    parser.add_argument('--record',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='Directory where every vendor API response is recorded')
+
+    parser.add_argument('--replay',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='Serve vendor API calls from a directory written by --record, offline')
+
+    parser.add_argument('--local_s3',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='Store files in this local directory instead of S3')
+
+    parser.add_argument('--rebuild_watermarks',
+                        action='store_true',
+                        help='Regenerate the S3 watermark manifests of --api from the stored files')
+
+    parser.add_argument('--output_format',
+                        type=str,
+                        required=False,
+                        default=None,
+                        choices=['csv', 'parquet'],
+                        help='Format of the stored files, OUTPUT_FORMAT in the config file or csv by default')
+
+    parser.add_argument('--layout',
+                        type=str,
+                        required=False,
+                        default=None,
+                        choices=['wide', 'star'],
+                        help='wide repeats the site and device fields on every row, star stores them once in '
+                             '<Vendor>/_dimensions/ tables. OUTPUT_LAYOUT in the config file or wide by default')
+
+    parser.add_argument('--migrate_to_parquet',
+                        action='store_true',
+                        help='Convert the stored CSV files of --api to partitioned Parquet')
+
+    parser.add_argument('--delete_migrated_csv',
+                        action='store_true',
+                        help='Delete each CSV file once --migrate_to_parquet has converted it')
     
+    parser.add_argument('--metrics_file',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='Write the per-stage metrics of the run here, Prometheus text for *.prom and JSON otherwise')
+
+    parser.add_argument('--profile',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='Run under cProfile and write the stats to this file (read with python -m pstats)')
+
     args = parser.parse_args()
-    main(args)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        main(args)
@@ -0,0 +1,338 @@
+import asyncio
+import atexit
+import json
+import os
+import random
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from src.metrics import add, current_site
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# Sustained calls per second, burst size and calls per day of every API key.
+# None means unlimited. SolarEdge allows 300 daily calls per site and 3
+# concurrent calls, FusionSolar throttles with failCode 407.
+VENDOR_RATES = {'solaredge': {'rate': 3, 'burst': 3, 'daily': 300},
+                'fronius': {'rate': 5, 'burst': 5, 'daily': None},
+                'huaweii': {'rate': 1, 'burst': 2, 'daily': None},
+                'meteosource': {'rate': None, 'burst': 1, 'daily': None}}
+
+
+# The quota file is rewritten after this many calls or seconds, and at exit
+QUOTA_SAVE_CALLS = 20
+QUOTA_SAVE_SECONDS = 5.0
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def retry_after_seconds(res:requests.Response) -> float:
+    # Retry-After holds either a number of seconds or an HTTP date
+    value = res.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    def __init__(self,
+                 rate:float = None,
+                 burst:int = 1) -> None:
+        # rate is the number of tokens added per second, None never waits
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        # Takes a token and returns 0, or returns how long to wait for one
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self.rate is None:
+                return 0.0
+            self._tokens = min(self.burst, self._tokens + max(now - self._updated, 0) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        wait_time = self.take()
+        while wait_time > 0:
+            time.sleep(wait_time)
+            wait_time = self.take()
+
+    async def acquire_async(self) -> None:
+        wait_time = self.take()
+        while wait_time > 0:
+            await asyncio.sleep(wait_time)
+            wait_time = self.take()
+
+    def block(self, seconds:float) -> None:
+        # Every caller of the bucket waits, the API is throttling the key
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._blocked_until
+
+
+class QuotaStore(object):
+    def __init__(self, state_file:str = None) -> None:
+        # Daily counters are kept across runs, days are counted in UTC
+        self.state_file = state_file or os.path.join(os.getcwd(), 'cache', 'quota.json')
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._state = self._load()
+        self._version = 0
+        self._saved_version = 0
+        self._saved_at = time.monotonic()
+        atexit.register(self.save)
+
+    def _load(self) -> dict:
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self,
+               content:str,
+               version:int) -> None:
+        # Outside the counter lock, a newer snapshot is never overwritten by an older one
+        with self._save_lock:
+            if version <= self._saved_version:
+                return
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(content)
+            os.replace(tmp_file, self.state_file)
+            self._saved_version = version
+
+    def save(self) -> None:
+        with self._lock:
+            if self._version == self._saved_version:
+                return
+            content, version = json.dumps(self._state, indent=1, sort_keys=True), self._version
+            self._saved_at = time.monotonic()
+        self._write(content, version)
+
+    def _today(self) -> str:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+    def used(self, key:str) -> int:
+        with self._lock:
+            entry = self._state.get(key)
+            return entry['used'] if entry is not None and entry['day'] == self._today() else 0
+
+    def consume(self,
+                key:str,
+                limit:int) -> None:
+        with self._lock:
+            today = self._today()
+            entry = self._state.get(key)
+            if entry is None or entry['day'] != today:
+                entry = {'day': today, 'used': 0}
+                self._state[key] = entry
+            if entry['used'] >= limit:
+                raise QuotaExceeded(f'Daily quota of {limit} calls used up for {key}')
+            entry['used'] += 1
+            self._version += 1
+            now = time.monotonic()
+            if self._version - self._saved_version < QUOTA_SAVE_CALLS and now - self._saved_at < QUOTA_SAVE_SECONDS:
+                return
+            content, version = json.dumps(self._state, indent=1, sort_keys=True), self._version
+            self._saved_at = now
+        self._write(content, version)
+
+
+def seconds_until_reset() -> float:
+    now = datetime.now(timezone.utc)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return 86400 - (now - midnight).total_seconds()
+
+
+class RequestGovernor(object):
+    def __init__(self,
+                 vendor:str,
+                 key:str = None,
+                 rate:float = None,
+                 burst:int = 1,
+                 daily:int = None,
+                 spread:bool = False,
+                 quota:QuotaStore = None,
+                 max_retries:int = 5,
+                 backoff_base:float = 1.0,
+                 backoff_max:float = 300.0) -> None:
+
+        self.vendor = vendor
+        self.key = key
+        self.name = f'{vendor}/{key}' if key is not None else vendor
+        self.daily = daily
+        self.spread = spread
+        self.quota = quota
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.requests = 0
+        self.retries = 0
+        self._count_lock = threading.Lock()
+        self._spread_lock = threading.Lock()
+        self._next_spread = time.monotonic()
+
+    def remaining(self) -> int:
+        # Calls left today, None without a daily quota
+        if self.daily is None or self.quota is None:
+            return None
+        return max(self.daily - self.quota.used(self.name), 0)
+
+    def backoff(self, attempt:int) -> float:
+        # Full jitter keeps throttled threads from retrying in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _pace(self) -> float:
+        # With spread=True the remaining quota is stretched until the daily
+        # reset, returns how long the caller has to wait
+        remaining = self.remaining()
+        if not self.spread or not remaining:
+            return 0.0
+        with self._spread_lock:
+            now = time.monotonic()
+            wait_time = self._next_spread - now
+            self._next_spread = max(now, self._next_spread) + seconds_until_reset() / remaining
+        return max(wait_time, 0.0)
+
+    def _before_request(self) -> float:
+        if self.daily is not None and self.quota is not None:
+            self.quota.consume(self.name, self.daily)
+        with self._count_lock:
+            self.requests += 1
+        return self._pace()
+
+    def _retry_delay(self,
+                     attempt:int,
+                     res = None,
+                     error:Exception = None,
+                     throttled = None) -> float:
+        # None when res is final (or the retries are used up), otherwise the
+        # delay before the next attempt
+        if error is not None:
+            if attempt >= self.max_retries:
+                raise error
+            delay = self.backoff(attempt)
+            reason = type(error).__name__
+        else:
+            is_throttled = res.status_code == 429 or (throttled is not None and throttled(res))
+            if (not is_throttled and res.status_code not in RETRY_STATUS_CODES) or attempt >= self.max_retries:
+                return None
+            retry_after = retry_after_seconds(res)
+            delay = min(retry_after, self.backoff_max) if retry_after is not None else self.backoff(attempt)
+            if is_throttled:
+                self.bucket.block(delay)
+            reason = f'status {res.status_code}' + (' (throttled)' if is_throttled else '')
+        with self._count_lock:
+            self.retries += 1
+        add('retries', vendor=self.vendor, site=current_site())
+        logging.warning(f'{self.name} request failed with {reason}, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s')
+        return delay
+
+    def request(self,
+                send,
+                throttled = None,
+                retry_errors:tuple = RETRY_ERRORS) -> requests.Response:
+        # send performs one HTTP call, throttled tells throttling answers that
+        # don't use status 429 apart. The last response is returned once the
+        # retries are used up, callers check it as before.
+        attempt = 0
+        while True:
+            time.sleep(self._before_request())
+            self.bucket.acquire()
+            try:
+                res = send()
+                delay = self._retry_delay(attempt, res=res, throttled=throttled)
+            except retry_errors as e:
+                delay = self._retry_delay(attempt, error=e)
+            if delay is None:
+                return res
+            time.sleep(delay)
+            attempt += 1
+
+    async def request_async(self,
+                            send,
+                            throttled = None,
+                            retry_errors:tuple = RETRY_ERRORS):
+        # Same as request for a coroutine function send
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._before_request())
+            await self.bucket.acquire_async()
+            try:
+                res = await send()
+                delay = self._retry_delay(attempt, res=res, throttled=throttled)
+            except retry_errors as e:
+                delay = self._retry_delay(attempt, error=e)
+            if delay is None:
+                return res
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+_governors = {}
+_settings = {}
+_quota = None
+_lock = threading.Lock()
+
+
+def configure_governors(rate_limits:dict = None,
+                        quota:QuotaStore = None) -> None:
+    # rate_limits is the RATE_LIMITS section of config.json, e.g.
+    # {"solaredge": {"RATE": 3, "BURST": 3, "DAILY": 300, "SPREAD": false}}
+    global _quota
+    with _lock:
+        for vendor, limits in (rate_limits or {}).items():
+            _settings[vendor] = {k.lower(): v for k, v in limits.items()}
+        if quota is not None:
+            _quota = quota
+        _governors.clear()
+
+
+def get_governor(vendor:str,
+                 key:str = None,
+                 **settings) -> RequestGovernor:
+    # One governor per vendor and API key, shared by every extractor using it
+    global _quota
+    with _lock:
+        name = (vendor, key)
+        if name not in _governors:
+            if _quota is None:
+                _quota = QuotaStore()
+            kwargs = dict(VENDOR_RATES.get(vendor, {}))
+            kwargs.update(_settings.get(vendor, {}))
+            kwargs.update({k: v for k, v in settings.items() if v is not None})
+            _governors[name] = RequestGovernor(vendor, key, quota=_quota, **kwargs)
+        return _governors[name]
+
+
+def governors() -> list:
+    with _lock:
+        return list(_governors.values())
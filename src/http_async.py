@@ -0,0 +1,94 @@
+import asyncio
+from src.http_session import HTTPExtractor, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT
+from src.governor import RequestGovernor
+from src.metrics import stage, add, current_site
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncResponse(object):
+    # The parts of requests.Response the extractors and the governor use
+    def __init__(self,
+                 status_code:int,
+                 headers:dict,
+                 content:bytes) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+
+class AsyncHTTPExtractor(HTTPExtractor):
+    # Async counterparts (AsyncSolarEdgeExtractor, ...) put this class after
+    # their synchronous extractor, so the vendor constructor lands here and
+    # _get/_post become coroutines on one aiohttp session
+    def __init__(self,
+                 session = None,
+                 pool_size:int = DEFAULT_POOL_SIZE,
+                 timeout:tuple = DEFAULT_TIMEOUT,
+                 governor:RequestGovernor = None) -> None:
+        if aiohttp is None:
+            raise ImportError('Async extractors require aiohttp, install it with `pip install aiohttp`')
+        self._owns_session = session is None
+        self._session = session
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.governor = governor
+
+    @property
+    def session(self):
+        # Created on first use, inside the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                                  timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0],
+                                                                                sock_read=self.timeout[1]))
+        return self._session
+
+    @session.setter
+    def session(self, session) -> None:
+        self._session = session
+
+    async def _request(self, method:str, url:str, **kwargs) -> AsyncResponse:
+        kwargs.pop('timeout', None)
+        async def send() -> AsyncResponse:
+            async with self.session.request(method, url, **kwargs) as res:
+                return AsyncResponse(res.status, res.headers, await res.read())
+        site = current_site()
+        with stage('http', vendor=self.vendor, site=site):
+            if self.governor is None:
+                res = await send()
+            else:
+                res = await self.governor.request_async(send,
+                                                        throttled=self.throttled,
+                                                        retry_errors=(aiohttp.ClientConnectionError, asyncio.TimeoutError))
+        add('http_requests', vendor=self.vendor, site=site)
+        add('http_bytes', len(res.content), vendor=self.vendor, site=site)
+        return res
+
+    async def _get(self, url:str, **kwargs) -> AsyncResponse:
+        return await self._request('GET', url, **kwargs)
+
+    async def _post(self, url:str, **kwargs) -> AsyncResponse:
+        return await self._request('POST', url, **kwargs)
+
+    async def _get_json(self, url:str, **kwargs):
+        res = await self._get(url, **kwargs)
+        if res.ok:
+            return self.decode(res)
+        raise Exception(f"API response not OK: {res.status_code}")
+
+    async def close(self) -> None:
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
@@ -0,0 +1,110 @@
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from src.governor import RequestGovernor
+from src.metrics import stage, add, current_site
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (10, 120)
+
+_transport = None
+
+
+def json_loads(content:bytes):
+    # orjson parses the large telemetry payloads several times faster when it
+    # is installed. It rejects what only the json module accepts (NaN), those
+    # payloads are parsed again with json.
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(content)
+
+
+def set_transport(adapter_factory = None) -> None:
+    # adapter_factory(pool_size) builds the adapter of every session created
+    # from now on, e.g. src.replay.RecordingAdapter. None restores plain HTTP.
+    global _transport
+    _transport = adapter_factory
+
+
+def build_session(pool_size:int = DEFAULT_POOL_SIZE,
+                  headers:dict = None) -> requests.Session:
+    # Connections are kept alive and reused, pool_size should match the
+    # number of threads sharing the session
+    session = requests.Session()
+    if _transport is not None:
+        adapter = _transport(pool_size)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers is not None:
+        session.headers.update(headers)
+    return session
+
+
+class HTTPExtractor(object):
+    # Label of the vendor in the run metrics
+    vendor = None
+
+    def __init__(self,
+                 session:requests.Session = None,
+                 pool_size:int = DEFAULT_POOL_SIZE,
+                 timeout:tuple = DEFAULT_TIMEOUT,
+                 governor:RequestGovernor = None) -> None:
+
+        # A session handed in by the caller is shared, and closed by the caller
+        self._owns_session = session is None
+        self.session = session if session is not None else build_session(pool_size=pool_size)
+        self.timeout = timeout
+        self.governor = governor
+
+    def throttled(self, res:requests.Response) -> bool:
+        # Vendors that signal throttling in the body override this
+        return False
+
+    def _request(self, method:str, url:str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        site = current_site()
+        with stage('http', vendor=self.vendor, site=site):
+            if self.governor is None:
+                res = self.session.request(method, url, **kwargs)
+            else:
+                res = self.governor.request(lambda: self.session.request(method, url, **kwargs),
+                                            throttled=self.throttled)
+        add('http_requests', vendor=self.vendor, site=site)
+        add('http_bytes', len(res.content), vendor=self.vendor, site=site)
+        return res
+
+    def decode(self, res:requests.Response):
+        # Parsed once per response, the throttling check may have read it
+        if '_decoded' not in res.__dict__:
+            with stage('json_decode', vendor=self.vendor, site=current_site()):
+                res._decoded = json_loads(res.content)
+        return res._decoded
+
+    def _get(self, url:str, **kwargs) -> requests.Response:
+        return self._request('GET', url, **kwargs)
+
+    def _post(self, url:str, **kwargs) -> requests.Response:
+        return self._request('POST', url, **kwargs)
+
+    def close(self) -> None:
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
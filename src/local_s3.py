@@ -0,0 +1,134 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+
+class LocalBody(BytesIO):
+    pass
+
+
+class LocalPaginator(object):
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def paginate(self, Bucket:str, Prefix:str = '', **kwargs):
+        token = None
+        while True:
+            page = self.client.list_objects_v2(Bucket=Bucket, Prefix=Prefix, ContinuationToken=token)
+            yield page
+            token = page.get('NextContinuationToken')
+            if token is None:
+                return
+
+
+class LocalS3Client(object):
+    def __init__(self, root:str) -> None:
+        # Stands in for the boto3 S3 client: objects are files under
+        # <root>/<bucket>/<key>. Only the calls this project makes are implemented.
+        self.root = root
+        self._lock = threading.Lock()
+        self._uploads = {}
+
+    def _path(self, bucket:str, key:str) -> str:
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _no_such_key(self, operation:str, key:str) -> ClientError:
+        return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f'The specified key does not exist: {key}'}}, operation)
+
+    def _write(self, path:str, body) -> str:
+        if hasattr(body, 'read'):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_file, path)
+        return f'"{hashlib.md5(body).hexdigest()}"'
+
+    def put_object(self, Bucket:str, Key:str, Body = b'', **kwargs) -> dict:
+        return {'ETag': self._write(self._path(Bucket, Key), Body)}
+
+    def upload_fileobj(self, Fileobj, Bucket:str, Key:str, ExtraArgs:dict = None, Config = None, **kwargs) -> None:
+        self._write(self._path(Bucket, Key), Fileobj)
+
+    def get_object(self, Bucket:str, Key:str, **kwargs) -> dict:
+        try:
+            with open(self._path(Bucket, Key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise self._no_such_key('GetObject', Key)
+        return {'Body': LocalBody(data), 'ContentLength': len(data)}
+
+    def delete_object(self, Bucket:str, Key:str, **kwargs) -> dict:
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def list_objects_v2(self,
+                        Bucket:str,
+                        Prefix:str = '',
+                        ContinuationToken:str = None,
+                        MaxKeys:int = 1000,
+                        **kwargs) -> dict:
+        bucket_root = os.path.join(self.root, Bucket)
+        keys = []
+        for folder, _, files in os.walk(bucket_root):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(os.path.join(folder, name), bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+        if ContinuationToken is not None:
+            keys = [k for k in keys if k > ContinuationToken]
+        page = {'Contents': [{'Key': k, 'Size': os.path.getsize(self._path(Bucket, k))} for k in keys[:MaxKeys]],
+                'KeyCount': min(len(keys), MaxKeys),
+                'IsTruncated': len(keys) > MaxKeys}
+        if len(keys) > MaxKeys:
+            page['NextContinuationToken'] = keys[MaxKeys - 1]
+        return page
+
+    def get_paginator(self, operation:str) -> LocalPaginator:
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(f'LocalS3Client has no paginator for {operation}')
+        return LocalPaginator(self)
+
+    def create_multipart_upload(self, Bucket:str, Key:str, **kwargs) -> dict:
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = os.path.join(self.root, '.multipart', upload_id)
+        os.makedirs(self._uploads[upload_id], exist_ok=True)
+        return {'UploadId': upload_id, 'Bucket': Bucket, 'Key': Key}
+
+    def upload_part(self, Bucket:str, Key:str, UploadId:str, PartNumber:int, Body, **kwargs) -> dict:
+        return {'ETag': self._write(os.path.join(self._uploads[UploadId], f'{PartNumber:05d}'), Body)}
+
+    def complete_multipart_upload(self, Bucket:str, Key:str, UploadId:str, MultipartUpload:dict, **kwargs) -> dict:
+        with self._lock:
+            upload_dir = self._uploads.pop(UploadId)
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f'{path}.{UploadId}.tmp'
+        with open(tmp_file, 'wb') as f:
+            for part in sorted(MultipartUpload['Parts'], key=lambda p: p['PartNumber']):
+                with open(os.path.join(upload_dir, f"{part['PartNumber']:05d}"), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, f)
+        os.replace(tmp_file, path)
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket:str, Key:str, UploadId:str, **kwargs) -> dict:
+        with self._lock:
+            upload_dir = self._uploads.pop(UploadId, None)
+        if upload_dir is not None:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+        return {}
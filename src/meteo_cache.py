@@ -0,0 +1,247 @@
+import json
+import os
+import hashlib
+import threading
+import logging
+from datetime import datetime, timedelta
+import boto3
+from botocore.exceptions import ClientError
+
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_PLACE_TTL = timedelta(days=30)
+
+
+class WeatherCache(object):
+    def __init__(self,
+                 cache_dir:str = None,
+                 max_bytes:int = DEFAULT_MAX_BYTES,
+                 aws_access_key_id:str = None,
+                 aws_secret_key:str = None,
+                 bucket:str = None,
+                 prefix:str = '_cache/weather',
+                 client_factory = None) -> None:
+
+        self.cache_dir = cache_dir or os.path.join(os.getcwd(), 'cache', 'weather')
+        self.max_bytes = max_bytes
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_key = aws_secret_key
+        self.client_factory = client_factory
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = None
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def client(self):
+        if self._client is None and self.client_factory is not None:
+            self._client = self.client_factory()
+        if self._client is None:
+            self._client = boto3.client('s3',
+                                        aws_access_key_id=self.aws_access_key_id,
+                                        aws_secret_access_key=self.aws_secret_key)
+        return self._client
+
+    def key(self,
+            lat:str,
+            lon:str,
+            date:str,
+            timezone:str) -> str:
+        content = json.dumps([str(lat), str(lon), date, timezone])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def _read_local(self, key:str) -> list:
+        try:
+            with open(self._path(key)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return data
+
+    def _write_local(self, key:str, data:list) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+        self._track(os.path.getsize(path))
+
+    def _read_s3(self, key:str) -> list:
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=f'{self.prefix}/{key}.json')
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise e
+        return json.loads(obj['Body'].read())
+
+    def _write_s3(self, key:str, data:list) -> None:
+        self.client.put_object(Bucket=self.bucket,
+                               Key=f'{self.prefix}/{key}.json',
+                               Body=json.dumps(data).encode('utf-8'),
+                               ContentType='application/json')
+
+    def get(self, key:str) -> list:
+        data = self._read_local(key)
+        if data is None and self.bucket is not None:
+            data = self._read_s3(key)
+            if data is not None:
+                self._write_local(key, data)
+        return data
+
+    def put(self, key:str, data:list) -> None:
+        self._write_local(key, data)
+        if self.bucket is not None:
+            self._write_s3(key, data)
+
+    def get_or_fetch(self,
+                     lat:str,
+                     lon:str,
+                     date:str,
+                     timezone:str,
+                     fetch) -> list:
+
+        # The current day is still being filled by the API, it is never cached
+        if date >= datetime.now().strftime('%Y-%m-%d'):
+            return fetch()
+
+        key = self.key(lat=lat, lon=lon, date=date, timezone=timezone)
+        with self._lock:
+            # [lock, callers holding or waiting for it], dropped by the last one
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        # Concurrent requests for the same location-day wait for the first
+        # one, and find its data in the cache once they get the lock
+        try:
+            with entry[0]:
+                data = self.get(key)
+                if data is None:
+                    data = fetch()
+                    self.put(key, data)
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._key_locks.pop(key, None)
+        return data
+
+    def _track(self, size:int) -> None:
+        with self._lock:
+            if self._size is None:
+                self._size = sum([f[1] for f in self._list_files()])
+            else:
+                self._size += size
+            over_limit = self._size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _list_files(self) -> list:
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self) -> None:
+        files = self._list_files()
+        total = sum([f[1] for f in files])
+
+        # Least recently used days go first
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._size = total
+        if removed > 0:
+            logging.info(f'Weather cache evicted {removed} days, {total} bytes left')
+
+
+class PlaceCache(object):
+    def __init__(self,
+                 cache_file:str = None,
+                 ttl:timedelta = DEFAULT_PLACE_TTL) -> None:
+
+        self.cache_file = cache_file or os.path.join(os.getcwd(), 'cache', 'places.json')
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)
+
+    def _key(self,
+             name:str,
+             timezone:str = None,
+             kind:str = 'place') -> str:
+        return f'{kind}:{str(name).strip().lower()}|{timezone or ""}'
+
+    def get(self,
+            name:str,
+            timezone:str = None,
+            kind:str = 'place') -> dict:
+        # Returns None when unknown or expired, and an entry with lat=None
+        # when the place is known not to resolve
+        entry = self._entries.get(self._key(name, timezone, kind))
+        if entry is None:
+            return None
+        if datetime.now() - datetime.fromtimestamp(entry['fetched_at']) > self.ttl:
+            return None
+        return entry
+
+    def put(self,
+            name:str,
+            lat:str,
+            lon:str,
+            timezone:str = None,
+            kind:str = 'place',
+            source:str = 'api') -> None:
+        with self._lock:
+            self._entries[self._key(name, timezone, kind)] = {'lat': lat,
+                                                              'lon': lon,
+                                                              'source': source,
+                                                              'fetched_at': datetime.now().timestamp()}
+            self._save()
+
+    def warm(self,
+             coordinates:dict,
+             source:str = 'coordinates.json') -> None:
+        with self._lock:
+            for site, coord in coordinates.items():
+                self._entries[self._key(site, kind='site')] = {'lat': coord['lat'],
+                                                               'lon': coord['lon'],
+                                                               'source': source,
+                                                               'fetched_at': datetime.now().timestamp()}
+            self._save()
@@ -0,0 +1,182 @@
+import bisect
+import contextvars
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets:tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q:float) -> float:
+        # Upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+
+class MetricsRegistry(object):
+    def __init__(self) -> None:
+        # Latencies per (stage, vendor, site), and counters of bytes, rows,
+        # retries, ... per (name, vendor, site)
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self,
+                stage:str,
+                seconds:float,
+                vendor:str = None,
+                site:str = None) -> None:
+        key = (stage, vendor or '', str(site or ''))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def add(self,
+            name:str,
+            value:float = 1,
+            vendor:str = None,
+            site:str = None) -> None:
+        key = (name, vendor or '', str(site or ''))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def stage(self,
+              stage:str,
+              vendor:str = None,
+              site:str = None):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0, vendor=vendor, site=site)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = [{'stage': stage, 'vendor': vendor, 'site': site,
+                       'count': h.count,
+                       'seconds': round(h.sum, 6),
+                       'mean': round(h.sum / h.count, 6),
+                       'p50': h.quantile(0.5),
+                       'p95': h.quantile(0.95),
+                       'max': round(h.max, 6)}
+                      for (stage, vendor, site), h in sorted(self.histograms.items())]
+            counters = [{'name': name, 'vendor': vendor, 'site': site, 'value': value}
+                        for (name, vendor, site), value in sorted(self.counters.items())]
+        return {'stages': stages, 'counters': counters}
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=1)
+
+    def to_prometheus(self, prefix:str = 'ingestion') -> str:
+        def labels(vendor:str, site:str, **extra) -> str:
+            items = {'vendor': vendor, 'site': site}
+            items.update(extra)
+            escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"')
+            return ','.join([f'{k}="{escape(v)}"' for k, v in items.items() if v != ''])
+
+        lines = [f'# TYPE {prefix}_stage_seconds histogram']
+        with self._lock:
+            for (stage, vendor, site), h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    cumulative += n
+                    lines.append(f'{prefix}_stage_seconds_bucket{{{labels(vendor, site, stage=stage, le=bound)}}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{{labels(vendor, site, stage=stage)}}} {h.sum}')
+                lines.append(f'{prefix}_stage_seconds_count{{{labels(vendor, site, stage=stage)}}} {h.count}')
+            names = sorted(set([name for name, _, _ in self.counters.keys()]))
+            for name in names:
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                for (n, vendor, site), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f'{prefix}_{name}_total{{{labels(vendor, site)}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+_registry = MetricsRegistry()
+
+# Site of the task running in this thread or coroutine, set by the scheduler
+# for the stages that don't know it themselves (HTTP calls, retries)
+_site = contextvars.ContextVar('metrics_site', default=None)
+
+
+def metrics() -> MetricsRegistry:
+    # The registry every stage of the run reports to
+    return _registry
+
+
+def current_site() -> str:
+    return _site.get()
+
+
+@contextmanager
+def site_label(site:str):
+    # Labels the stages and counters reported inside the block with site
+    token = _site.set(site)
+    try:
+        yield
+    finally:
+        _site.reset(token)
+
+
+def stage(name:str,
+          vendor:str = None,
+          site:str = None):
+    return _registry.stage(name, vendor=vendor, site=site)
+
+
+def add(name:str,
+        value:float = 1,
+        vendor:str = None,
+        site:str = None) -> None:
+    _registry.add(name, value=value, vendor=vendor, site=site)
+
+
+def timed(name:str):
+    # Times an extractor method under its vendor
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with _registry.stage(name, vendor=getattr(self, 'vendor', None), site=current_site()):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def key_labels(key:str) -> tuple:
+    # (vendor, site) of an object key such as SolarEdge/SITE/PlantData/...
+    parts = key.split('/')
+    vendor = parts[0].lower() if len(parts) > 1 else None
+    site = parts[1] if len(parts) > 2 else None
+    return vendor, site
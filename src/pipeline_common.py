@@ -0,0 +1,230 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from functools import partial
+from typing import TYPE_CHECKING
+import pandas as pd
+from src.api_aws import AWS3Extractor
+from src.api_metomatics import MeteoExtractor
+from src.checkpoints import CheckpointJournal
+from src.daemon import PollStream, DEFAULT_FLUSH_ROWS
+from src.meteo_cache import WeatherCache
+from src.scheduler import IngestionScheduler, AsyncIngestionScheduler, IngestionTask
+from src.watermarks import DATA_FOLDER, WatermarkStore, data_file_time
+
+if TYPE_CHECKING:
+    from src.api_async import AsyncMeteoExtractor
+
+
+# Steps shared by every vendor pipeline: weather windows, running the planned
+# tasks, holding the watermarks behind unfinished windows and rewinding those
+# of the failed ones.
+
+# Weather is requested in windows of this length
+WEATHER_WINDOW = timedelta(days=5)
+
+
+def build_weather_cache(config:dict, client_factory = None) -> WeatherCache:
+    cache_config = config.get("WEATHER_CACHE", {})
+    return WeatherCache(cache_dir=cache_config.get("DIR"),
+                        max_bytes=int(cache_config.get("MAX_MB", 512)) * 1024 * 1024,
+                        aws_access_key_id=config["AWS_ACCESS_KEY_ID"],
+                        aws_secret_key=config["AWS_SECRET_ACCESS_KEY"],
+                        bucket='prod-satia-raw-data' if cache_config.get("S3", False) else None,
+                        client_factory=client_factory)
+
+
+def task_folders(task:IngestionTask) -> list:
+    # Data folders whose watermarks the task moves, batched tasks cover several
+    folders = task.kwargs.get('folders', [task.kwargs.get('folder')])
+    return [f for f in folders if f is not None and f.endswith(DATA_FOLDER)]
+
+
+class WatermarkHolds(object):
+    # Scheduler listener holding the watermarks of every planned window, so
+    # they only move across the windows that finished
+    def __init__(self, watermarks:WatermarkStore) -> None:
+        self.watermarks = watermarks
+
+    def _manifests(self, task:IngestionTask) -> list:
+        return [(folder, device) for folder in task_folders(task) for device in set([task.device, None])]
+
+    def planned(self, tasks:list) -> None:
+        for task in tasks:
+            for folder, device in self._manifests(task):
+                self.watermarks.hold(folder=folder, device=device, start_time=task.start_time)
+
+    def finished(self,
+                 task:IngestionTask,
+                 error:Exception = None) -> None:
+        for folder, device in self._manifests(task):
+            self.watermarks.release(folder=folder, device=device, start_time=task.start_time, failed=error is not None)
+
+
+def rewind_failed_watermarks(aws_s3:AWS3Extractor, failed:list) -> None:
+    # Windows run out of order, so a failed window must pull the resume point back
+    earliest = {}
+    for task in failed:
+        for folder in task_folders(task):
+            key = (folder, task.device)
+            if key not in earliest or task.start_time < earliest[key]:
+                earliest[key] = task.start_time
+    for (folder, device), start_time in earliest.items():
+        aws_s3.watermarks.rewind(folder=folder, device=device, last_date=start_time)
+        logging.warning(f'Rewound watermark of folder={folder}, device={device} to {start_time}')
+
+
+def run_ingestion_tasks(tasks:list,
+                        aws_s3:AWS3Extractor,
+                        scheduler:IngestionScheduler = None) -> list:
+    holds = WatermarkHolds(aws_s3.watermarks)
+    if scheduler is None:
+        with IngestionScheduler() as scheduler:
+            failed = scheduler.run(tasks, listener=holds)
+    else:
+        failed = scheduler.run(tasks, listener=holds)
+    rewind_failed_watermarks(aws_s3, failed)
+    return failed
+
+
+def store_weather_window(site:str,
+                         device:str,
+                         start_time:datetime,
+                         end_time:datetime,
+                         folder:str,
+                         meteo_extractor:MeteoExtractor,
+                         aws_s3:AWS3Extractor,
+                         timezone:str = 'Europe/Madrid',
+                         lon:str = None,
+                         lat:str = None,
+                         place:str = None) -> None:
+    try:
+        df_meteo = meteo_extractor.get_wheather_data(start_date=start_time,
+                                                     end_date=end_time,
+                                                     timezone=timezone,
+                                                     lon=lon,
+                                                     lat=lat,
+                                                     place=place,
+                                                     site=site)
+    except Exception as e:
+        logging.error(f"Failed extracting weather data for site={site}, start_time={start_time}, end_time={end_time}")
+        raise e
+
+    if len(df_meteo) > 0:
+        store_weather_frame(df_meteo, start_time, end_time,
+                            folder=folder,
+                            aws_s3=aws_s3)
+
+
+def store_weather_frame(df_meteo:pd.DataFrame,
+                        start_time:datetime,
+                        end_time:datetime,
+                        folder:str,
+                        aws_s3:AWS3Extractor) -> None:
+    aws_s3.store_df_s3(df = df_meteo,
+                        folder=folder,
+                        file_name=f'weather_data_{data_file_time(start_time)}.csv')
+
+
+def weather_location(site:str,
+                     coordinates:dict,
+                     place:str) -> dict:
+    # Coordinates from coordinates.json, or the place to look up
+    if site in coordinates.keys():
+        return {'lon': coordinates[site]["lon"], 'lat': coordinates[site]["lat"]}
+    return {'place': place}
+
+
+def weather_stream(vendor:str,
+                   site:str,
+                   folder:str,
+                   meteo_extractor:MeteoExtractor,
+                   aws_s3:AWS3Extractor,
+                   watermark:datetime,
+                   flush_rows:int = DEFAULT_FLUSH_ROWS,
+                   timezone:str = 'Europe/Madrid',
+                   lon:str = None,
+                   lat:str = None,
+                   place:str = None) -> PollStream:
+    # Weather of a site for the daemon, polled on the weather cadence
+    return PollStream(vendor, site, ['weather'],
+                      fetch=partial(meteo_extractor.get_wheather_data,
+                                    timezone=timezone,
+                                    lon=lon,
+                                    lat=lat,
+                                    place=place,
+                                    site=site),
+                      store=partial(store_weather_frame, folder=folder, aws_s3=aws_s3),
+                      watermarks={'weather': watermark},
+                      step=WEATHER_WINDOW,
+                      governor=meteo_extractor.governor,
+                      cadence='weather',
+                      flush_rows=flush_rows)
+
+
+async def store_weather_window_async(site:str,
+                                     device:str,
+                                     start_time:datetime,
+                                     end_time:datetime,
+                                     folder:str,
+                                     meteo_extractor:'AsyncMeteoExtractor',
+                                     aws_s3:AWS3Extractor,
+                                     timezone:str = 'Europe/Madrid',
+                                     lon:str = None,
+                                     lat:str = None,
+                                     place:str = None) -> None:
+    try:
+        df_meteo = await meteo_extractor.get_wheather_data(start_date=start_time,
+                                                           end_date=end_time,
+                                                           timezone=timezone,
+                                                           lon=lon,
+                                                           lat=lat,
+                                                           place=place,
+                                                           site=site)
+    except Exception as e:
+        logging.error(f"Failed extracting weather data for site={site}, start_time={start_time}, end_time={end_time}")
+        raise e
+
+    if len(df_meteo) > 0:
+        await asyncio.to_thread(aws_s3.store_df_s3,
+                                df=df_meteo,
+                                folder=folder,
+                                file_name=f'weather_data_{data_file_time(start_time)}.csv')
+
+
+# Window functions with an async counterpart, and the extractor arguments
+# that are swapped for async ones. Each vendor pipeline adds its own when
+# it is loaded.
+ASYNC_WINDOWS = {store_weather_window: (store_weather_window_async, ['meteo_extractor'])}
+
+
+async def run_ingestion_tasks_async(tasks:list,
+                                    aws_s3:AWS3Extractor,
+                                    vendor_limits:dict = None,
+                                    journal:CheckpointJournal = None) -> list:
+    # Runs the planned window tasks as coroutines on one event loop, the
+    # in-flight requests are bounded per vendor and paced by the governors
+    # The async extractors subclass those of every vendor, they are loaded
+    # by --async_io runs only
+    from src.api_async import async_extractor
+    scheduler = AsyncIngestionScheduler(vendor_limits=vendor_limits, journal=journal)
+    twins = {}
+    async_tasks = []
+    for task in tasks:
+        func, names = ASYNC_WINDOWS[task.func]
+        kwargs = dict(task.kwargs)
+        for name in names:
+            if id(kwargs[name]) not in twins:
+                twins[id(kwargs[name])] = async_extractor(kwargs[name], pool_size=scheduler.vendor_limits.get(task.vendor, 1))
+            kwargs[name] = twins[id(kwargs[name])]
+        async_tasks.append(IngestionTask(task.vendor, task.site, task.device, task.start_time, task.end_time, func,
+                                         governor=task.governor,
+                                         cost=task.cost,
+                                         **kwargs))
+    try:
+        failed = await scheduler.run_async(async_tasks, listener=WatermarkHolds(aws_s3.watermarks))
+    finally:
+        for twin in twins.values():
+            await twin.close()
+    rewind_failed_watermarks(aws_s3, failed)
+    return failed
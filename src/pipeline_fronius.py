@@ -0,0 +1,442 @@
+import asyncio
+import logging
+from contextlib import ExitStack
+from functools import partial
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+import pandas as pd
+from unidecode import unidecode
+from src.api_fronius import FroniusExtractor
+from src.api_metomatics import MeteoExtractor
+from src.api_aws import AWS3Extractor
+from src.scheduler import IngestionScheduler, IngestionTask, split_windows
+from src.meteo_cache import WeatherCache, PlaceCache
+from src.window_planner import WindowPlanner, VENDOR_WINDOWS
+from src.batching import FrameBatcher, DEFAULT_BATCH_ROWS
+from src.schema_registry import SchemaRegistry
+from src.metrics import stage
+from src.timestamps import as_utc, utc_now
+from src.watermarks import data_file_time
+from src.dtypes import identifier
+from src.pipeline_common import ASYNC_WINDOWS, run_ingestion_tasks, weather_location, weather_stream
+from src.daemon import PollStream, DEFAULT_FLUSH_ROWS
+
+if TYPE_CHECKING:
+    from src.api_async import AsyncFroniusExtractor
+
+
+def store_fronius_batch(df_inv_data:pd.DataFrame,
+                        start_time:datetime,
+                        end_time:datetime,
+                        site:str,
+                        folder:str,
+                        pv_system_id:str,
+                        device:str,
+                        meteo_extractor:MeteoExtractor,
+                        aws_s3:AWS3Extractor,
+                        df_pvs_details:pd.DataFrame,
+                        df_dev_details:pd.DataFrame,
+                        coordinates:dict,
+                        city:str,
+                        timezone:str,
+                        weather:bool = True) -> None:
+    s = pv_system_id
+    d = device
+    try:
+        if aws_s3.dimensions is not None:
+            # Star layout: the system and device fields live in the dimension tables
+            aws_s3.dimensions.upsert('Fronius', 'sites', df_pvs_details, key='pvSystemId')
+            aws_s3.dimensions.upsert('Fronius', 'devices', df_dev_details.assign(pvSystemId=s), key='deviceId')
+            df_inv = df_inv_data[['datetime', 'pvSystemId', 'deviceId'] +
+                                 [c for c in df_inv_data.columns if c not in ['datetime', 'pvSystemId', 'deviceId']]]
+        else:
+            with stage('merge', vendor='fronius', site=site):
+                df_inv = pd.merge(df_inv_data, df_dev_details, on='deviceId', how='inner')
+                df_inv = pd.merge(df_inv, df_pvs_details, on='pvSystemId', how='inner')
+
+                df_inv = df_inv[['datetime'] + [c for c in df_pvs_details.columns if c != 'datetime'] +
+                                [c for c in df_dev_details.columns if c not in ['datetime', 'pvSystemId']] +
+                                [c for c in df_inv_data.columns if c not in ['datetime', 'pvSystemId', 'deviceId']]]
+
+        aws_s3.store_df_s3(df = df_inv,
+                            folder=folder,
+                            file_name=f'inverter_details_{data_file_time(start_time)}_{d}.csv',
+                            device=d)
+
+        # Extract meteo data, unless the weather of the site is polled on its own
+        if not weather:
+            return
+        if site in coordinates.keys():
+            df_meteo = meteo_extractor.get_wheather_data(start_date=df_inv_data['datetime'].min().to_pydatetime(),
+                                                        end_date=df_inv_data['datetime'].max().to_pydatetime(),
+                                                        timezone=timezone,
+                                                        lon=coordinates[site]["lon"],
+                                                        lat=coordinates[site]["lat"])
+        else:
+
+            df_meteo = meteo_extractor.get_wheather_data(start_date=df_inv_data['datetime'].min().to_pydatetime(),
+                                                        end_date=df_inv_data['datetime'].max().to_pydatetime(),
+                                                        timezone=timezone,
+                                                        place=city,
+                                                        site=site)
+
+        if len(df_meteo) > 0:
+            aws_s3.store_df_s3(df = df_meteo,
+                                folder=f'Fronius/{site}/WeatherData',
+                                file_name=f'weather_data_{data_file_time(start_time)}.csv')
+
+    except Exception as e:
+        logging.error(f"Couldn't store inverter data into S3 for for system={s}, device={d}, start_time={start_time}, end_time={end_time}")
+        raise(e)
+
+
+def fronius_batch_flush(**kwargs):
+    return lambda df, batch_start, batch_end: store_fronius_batch(df, batch_start, batch_end, **kwargs)
+
+
+def store_fronius_window(site:str,
+                         device:str,
+                         start_time:datetime,
+                         end_time:datetime,
+                         folder:str,
+                         pv_system_id:str,
+                         fronius_ext:FroniusExtractor,
+                         meteo_extractor:MeteoExtractor,
+                         aws_s3:AWS3Extractor,
+                         df_pvs_details:pd.DataFrame,
+                         df_dev_details:pd.DataFrame,
+                         coordinates:dict,
+                         city:str,
+                         timezone:str,
+                         planner:WindowPlanner,
+                         data_start:datetime = None,
+                         data_end:datetime = None,
+                         batch_rows:int = DEFAULT_BATCH_ROWS) -> None:
+    s = pv_system_id
+    d = device
+
+    # Daily frames are stored in batches of about batch_rows rows, each batch
+    # is released once it is written
+    flush = fronius_batch_flush(site=site,
+                                folder=folder,
+                                pv_system_id=s,
+                                device=d,
+                                meteo_extractor=meteo_extractor,
+                                aws_s3=aws_s3,
+                                df_pvs_details=df_pvs_details,
+                                df_dev_details=df_dev_details,
+                                coordinates=coordinates,
+                                city=city,
+                                timezone=timezone)
+    with FrameBatcher(flush, batch_rows=batch_rows) as batcher:
+        for day_start, day_end in planner.plan('fronius', site, start_time, end_time,
+                                               device=d,
+                                               data_start=data_start,
+                                               data_end=data_end):
+            try:
+                df_inv_data = fronius_ext.get_device_data_as_df(pv_system_id = s,
+                                                                device_id = d,
+                                                                start_time = day_start,
+                                                                end_time=day_end)
+                planner.record('fronius', site, day_start, day_end, len(df_inv_data), device=d)
+                
+                if len(df_inv_data) > 0:
+                    df_inv_data['deviceId'] = identifier(d, len(df_inv_data))
+                    df_inv_data['pvSystemId'] = identifier(s, len(df_inv_data))
+                    logging.info(f"Extracted Fronius API get_inverter_data method for system={s}, device={d}, start_time={day_start}, end_time={day_end}")
+            except Exception as e:
+                logging.error(f"Failed calling Fronius API get_inverter_data method for system={s}, device={d}, start_time={day_start}, end_time={day_end}")
+                raise e
+            batcher.add(df_inv_data, day_start, day_end)
+
+    if batcher.batches == 0:
+        logging.warning(f"No data retrieved for system={s}, device={d}, start_time={start_time}, end_time={end_time}")
+
+
+def fronius_devices(fronius_ext:FroniusExtractor,
+                    aws_s3:AWS3Extractor) -> list:
+    # Details and resume point of every device, devices whose details can't
+    # be read are left out
+    try:
+        df_pvs = fronius_ext.get_pv_systems_and_components()
+    except Exception as e:
+        logging.error('Failed calling Fronius API get_pv_systems_and_components')
+        raise e
+
+    devices = []
+    for s, d in zip(df_pvs['pvSystemIds'], df_pvs['deviceIds']):
+        # Get PV System details
+        try:
+            df_pvs_details = fronius_ext.get_pv_system_details_as_df(pv_system_id=s)
+            site = df_pvs_details.loc[0, 'name']
+            site = unidecode(site.upper())
+            timezone = df_pvs_details.loc[0, 'timeZone']
+            city = df_pvs_details.loc[0, 'address_city']
+            installation_date = df_pvs_details.loc[0, 'installationDate']
+            logging.info(f'Successfully extracted pv system details for pv_system={s}')
+        except Exception as e:
+            logging.error(f'Failed calling Fronius API get_pv_system_details method for pv_system={s}')
+            logging.error(str(e))
+            continue
+
+        # Get Device details
+        try:
+            df_dev_details = fronius_ext.get_device_details_as_df(pv_system_id=s, device_id=d)
+            logging.info(f'Successfully extracted pv device details for pv_system={s} and device_id={d}')
+        except Exception:
+            logging.error(f'Failed calling Fronius API get_device_details method for pv_system={s} and device_id={d}')
+            continue
+
+        # Fronius answers in UTC, files written before the UTC timestamps
+        # hold naive UTC times
+        folder = f'Fronius/{site}/PlantData'
+        start_time = as_utc(aws_s3.get_last_data_date(folder=folder, device=d), 'UTC')
+        if start_time == None:
+            start_time = installation_date
+
+        # Nothing is requested outside the device's active period
+        data_start = df_dev_details['activationDate'].min() if len(df_dev_details) > 0 else None
+        data_end = df_dev_details['deactivationDate'].max() if len(df_dev_details) > 0 else None
+        data_start = data_start if not pd.isnull(data_start) else None
+        data_end = data_end if not pd.isnull(data_end) else None
+        if data_start is not None and start_time < data_start:
+            start_time = data_start
+
+        devices.append({'pv_system_id': s,
+                        'device': d,
+                        'site': site,
+                        'folder': folder,
+                        'timezone': timezone,
+                        'city': city,
+                        'start_time': start_time,
+                        'data_start': data_start,
+                        'data_end': data_end,
+                        'df_pvs_details': df_pvs_details,
+                        'df_dev_details': df_dev_details})
+    return devices
+
+
+def plan_fronius_tasks(fronius_ext:FroniusExtractor,
+                       meteo_extractor:MeteoExtractor,
+                       aws_s3:AWS3Extractor,
+                       coordinates:dict,
+                       planner:WindowPlanner) -> list:
+    tasks = []
+    for device in fronius_devices(fronius_ext, aws_s3):
+        data_end = device['data_end']
+        end_time = min(utc_now(), data_end) if data_end is not None else utc_now()
+
+        # Daily histdata calls are grouped in 8-day files
+        for window_start, window_end in split_windows(device['start_time'], end_time, timedelta(days=8)):
+            tasks.append(IngestionTask('fronius', device['site'], device['device'], window_start, window_end,
+                                       store_fronius_window,
+                                       folder=device['folder'],
+                                       pv_system_id=device['pv_system_id'],
+                                       fronius_ext=fronius_ext,
+                                       meteo_extractor=meteo_extractor,
+                                       aws_s3=aws_s3,
+                                       df_pvs_details=device['df_pvs_details'],
+                                       df_dev_details=device['df_dev_details'],
+                                       coordinates=coordinates,
+                                       city=device['city'],
+                                       timezone=device['timezone'],
+                                       planner=planner,
+                                       data_start=device['data_start'],
+                                       data_end=data_end))
+    return tasks
+
+
+def fronius_device_frame(start_time:datetime,
+                         end_time:datetime,
+                         fronius_ext:FroniusExtractor,
+                         pv_system_id:str,
+                         device:str) -> pd.DataFrame:
+    # histdata of one device with its identifiers, as polled by the daemon
+    df_inv_data = fronius_ext.get_device_data_as_df(pv_system_id=pv_system_id,
+                                                    device_id=device,
+                                                    start_time=start_time,
+                                                    end_time=end_time)
+    if len(df_inv_data) > 0:
+        df_inv_data['deviceId'] = identifier(device, len(df_inv_data))
+        df_inv_data['pvSystemId'] = identifier(pv_system_id, len(df_inv_data))
+    return df_inv_data
+
+
+def fronius_streams(fronius_ext:FroniusExtractor,
+                    meteo_extractor:MeteoExtractor,
+                    aws_s3:AWS3Extractor,
+                    coordinates:dict,
+                    flush_rows:int = DEFAULT_FLUSH_ROWS) -> list:
+    # Daemon streams: one per active device and one for the weather of each
+    # site, the batches are stored without their weather
+    streams = []
+    sites = {}
+    for device in fronius_devices(fronius_ext, aws_s3):
+        if device['data_end'] is not None and device['data_end'] < utc_now():
+            continue
+        site = device['site']
+        streams.append(PollStream('fronius', site, [device['device']],
+                                  fetch=partial(fronius_device_frame,
+                                                fronius_ext=fronius_ext,
+                                                pv_system_id=device['pv_system_id'],
+                                                device=device['device']),
+                                  store=partial(store_fronius_batch,
+                                                site=site,
+                                                folder=device['folder'],
+                                                pv_system_id=device['pv_system_id'],
+                                                device=device['device'],
+                                                meteo_extractor=meteo_extractor,
+                                                aws_s3=aws_s3,
+                                                df_pvs_details=device['df_pvs_details'],
+                                                df_dev_details=device['df_dev_details'],
+                                                coordinates=coordinates,
+                                                city=device['city'],
+                                                timezone=device['timezone'],
+                                                weather=False),
+                                  watermarks={device['device']: device['start_time']},
+                                  step=VENDOR_WINDOWS['fronius']['max'],
+                                  governor=fronius_ext.governor,
+                                  flush_rows=flush_rows))
+        if site not in sites or device['start_time'] < sites[site]['start_time']:
+            sites[site] = device
+
+    for site, device in sites.items():
+        streams.append(weather_stream('fronius', site, f'Fronius/{site}/WeatherData',
+                                      meteo_extractor=meteo_extractor,
+                                      aws_s3=aws_s3,
+                                      watermark=device['start_time'],
+                                      flush_rows=flush_rows,
+                                      timezone=device['timezone'],
+                                      **weather_location(site, coordinates, device['city'])))
+    return streams
+
+
+def store_fronius_inverter_data_to_S3(sites:dict,
+                                      meteo_credentials:dict,
+                                      aws_secret_key:str,
+                                      aws_access_key_id: str,
+                                      coordinates:dict,
+                                      start_time:datetime = None,
+                                      end_time:datetime = None,
+                                      scheduler:IngestionScheduler = None):
+    
+    aws_s3 = AWS3Extractor(aws_secret_key=aws_secret_key,
+                           aws_access_key_id=aws_access_key_id)
+    places = PlaceCache()
+    places.warm(coordinates)
+    schemas = SchemaRegistry()
+    with FroniusExtractor(sites, schemas=schemas) as fronius_ext, MeteoExtractor(meteo_credentials, cache=WeatherCache(), places=places) as meteo_extractor:
+        planner = WindowPlanner()
+        tasks = plan_fronius_tasks(fronius_ext=fronius_ext,
+                                   meteo_extractor=meteo_extractor,
+                                   aws_s3=aws_s3,
+                                   coordinates=coordinates,
+                                   planner=planner)
+        failed = run_ingestion_tasks(tasks, aws_s3, scheduler)
+        planner.save()
+        schemas.save()
+        return failed
+
+
+async def store_fronius_window_async(site:str,
+                                     device:str,
+                                     start_time:datetime,
+                                     end_time:datetime,
+                                     folder:str,
+                                     pv_system_id:str,
+                                     fronius_ext:'AsyncFroniusExtractor',
+                                     meteo_extractor:MeteoExtractor,
+                                     aws_s3:AWS3Extractor,
+                                     df_pvs_details:pd.DataFrame,
+                                     df_dev_details:pd.DataFrame,
+                                     coordinates:dict,
+                                     city:str,
+                                     timezone:str,
+                                     planner:WindowPlanner,
+                                     data_start:datetime = None,
+                                     data_end:datetime = None,
+                                     batch_rows:int = DEFAULT_BATCH_ROWS) -> None:
+    s = pv_system_id
+    d = device
+
+    # The days of the window are fetched together, then batched in order
+    days = planner.plan('fronius', site, start_time, end_time,
+                        device=d,
+                        data_start=data_start,
+                        data_end=data_end)
+    try:
+        frames = await asyncio.gather(*[fronius_ext.get_device_data_as_df(pv_system_id=s,
+                                                                         device_id=d,
+                                                                         start_time=day_start,
+                                                                         end_time=day_end)
+                                        for day_start, day_end in days])
+    except Exception as e:
+        logging.error(f"Failed calling Fronius API get_inverter_data method for system={s}, device={d}, start_time={start_time}, end_time={end_time}")
+        raise e
+
+    for (day_start, day_end), df_inv_data in zip(days, frames):
+        planner.record('fronius', site, day_start, day_end, len(df_inv_data), device=d)
+        if len(df_inv_data) > 0:
+            df_inv_data['deviceId'] = identifier(d, len(df_inv_data))
+            df_inv_data['pvSystemId'] = identifier(s, len(df_inv_data))
+
+    # Weather of each batch is looked up by the synchronous meteo extractor
+    def store_batches() -> int:
+        flush = fronius_batch_flush(site=site,
+                                    folder=folder,
+                                    pv_system_id=s,
+                                    device=d,
+                                    meteo_extractor=meteo_extractor,
+                                    aws_s3=aws_s3,
+                                    df_pvs_details=df_pvs_details,
+                                    df_dev_details=df_dev_details,
+                                    coordinates=coordinates,
+                                    city=city,
+                                    timezone=timezone)
+        with FrameBatcher(flush, batch_rows=batch_rows) as batcher:
+            for (day_start, day_end), df_inv_data in zip(days, frames):
+                batcher.add(df_inv_data, day_start, day_end)
+        return batcher.batches
+
+    if await asyncio.to_thread(store_batches) == 0:
+        logging.warning(f"No data retrieved for system={s}, device={d}, start_time={start_time}, end_time={end_time}")
+
+ASYNC_WINDOWS[store_fronius_window] = (store_fronius_window_async, ['fronius_ext'])
+
+
+def build_planner(stack:ExitStack,
+                  sites:dict,
+                  coordinates:dict,
+                  pool_size:int,
+                  meteo_extractor:MeteoExtractor,
+                  aws_s3:AWS3Extractor,
+                  planner:WindowPlanner,
+                  schemas:SchemaRegistry = None):
+    fronius_ext = stack.enter_context(FroniusExtractor(sites,
+                                                       pool_size=pool_size,
+                                                       schemas=schemas))
+    return lambda: plan_fronius_tasks(fronius_ext=fronius_ext,
+                                      meteo_extractor=meteo_extractor,
+                                      aws_s3=aws_s3,
+                                      coordinates=coordinates,
+                                      planner=planner)
+
+
+def build_poller(stack:ExitStack,
+                 sites:dict,
+                 coordinates:dict,
+                 pool_size:int,
+                 meteo_extractor:MeteoExtractor,
+                 aws_s3:AWS3Extractor,
+                 planner:WindowPlanner,
+                 schemas:SchemaRegistry = None,
+                 flush_rows:int = DEFAULT_FLUSH_ROWS):
+    # Daemon counterpart of build_planner, the extractor lasts the whole run
+    fronius_ext = stack.enter_context(FroniusExtractor(sites,
+                                                       pool_size=pool_size,
+                                                       schemas=schemas))
+    return lambda: fronius_streams(fronius_ext=fronius_ext,
+                                   meteo_extractor=meteo_extractor,
+                                   aws_s3=aws_s3,
+                                   coordinates=coordinates,
+                                   flush_rows=flush_rows)
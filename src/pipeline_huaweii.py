@@ -0,0 +1,395 @@
+import asyncio
+import logging
+from contextlib import ExitStack
+from functools import partial
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+import pandas as pd
+from src.api_huaweii import HuaweiiExtractor, MAX_DEVICES_PER_CALL
+from src.api_metomatics import MeteoExtractor
+from src.api_aws import AWS3Extractor
+from src.scheduler import IngestionScheduler, IngestionTask
+from src.meteo_cache import WeatherCache, PlaceCache
+from src.window_planner import WindowPlanner, VENDOR_WINDOWS, naive
+from src.schema_registry import SchemaRegistry
+from src.metrics import stage
+from src.dtypes import concat_frames
+from src.timestamps import as_utc
+from src.watermarks import data_file_time
+from src.pipeline_common import ASYNC_WINDOWS, run_ingestion_tasks, weather_stream
+from src.daemon import PollStream, DEFAULT_FLUSH_ROWS
+
+if TYPE_CHECKING:
+    from src.api_async import AsyncHuaweiiExtractor
+
+
+HUAWEII_WINDOW_ANCHOR = datetime(2020, 1, 1)
+
+
+def huaweii_grid_windows(start_time:datetime,
+                         end_time:datetime,
+                         step:timedelta = VENDOR_WINDOWS['huaweii']['max']) -> list:
+    # Whole windows on a grid shared by every plant, so plants resuming from
+    # different dates still fall into the same windows and share calls
+    start_time = naive(start_time)
+    end_time = naive(end_time)
+    window_start = HUAWEII_WINDOW_ANCHOR + ((start_time - HUAWEII_WINDOW_ANCHOR) // step) * step
+    windows = []
+    while window_start + step <= end_time:
+        windows.append((window_start, window_start + step))
+        window_start = window_start + step
+    return windows
+
+
+def pack_huaweii_plants(plants:list) -> list:
+    # Plants are packed into groups of at most MAX_DEVICES_PER_CALL devices,
+    # a larger plant is a group of its own and takes several calls
+    groups = []
+    for plant in sorted(plants, key=lambda p: len(p['devices']), reverse=True):
+        n_devices = len(plant['devices'])
+        for group in groups:
+            if sum([len(p['devices']) for p in group]) + n_devices <= MAX_DEVICES_PER_CALL:
+                group.append(plant)
+                break
+        else:
+            groups.append([plant])
+    return groups
+
+
+def fetch_huaweii_devices(extractor:HuaweiiExtractor,
+                          devices:list,
+                          start_date:datetime,
+                          end_date:datetime) -> list:
+    # One getDevHistoryKpi call per MAX_DEVICES_PER_CALL devices
+    start_time = int(start_date.timestamp() * 1000)
+    end_time = int(end_date.timestamp() * 1000)
+    frames = []
+    for i in range(0, len(devices), MAX_DEVICES_PER_CALL):
+        try:
+            frames.append(extractor.get_device_data_as_df(devices[i:i + MAX_DEVICES_PER_CALL], start_time, end_time))
+        except Exception as e:
+            logging.error(f'Failed calling Huaweii API get_device_data for devices {devices[i:i + MAX_DEVICES_PER_CALL]}: {str(e)}')
+            raise e
+    return frames
+
+
+def store_huaweii_window(site:str,
+                         device:str,
+                         start_time:datetime,
+                         end_time:datetime,
+                         plants:list,
+                         folders:list,
+                         extractor:HuaweiiExtractor,
+                         meteo_extractor:MeteoExtractor,
+                         aws_s3:AWS3Extractor,
+                         planner:WindowPlanner) -> None:
+    # The devices of every plant in the group are requested together
+    devices = [d for plant in plants for d in plant['devices']]
+    frames = fetch_huaweii_devices(extractor, devices, start_time, end_time)
+    store_huaweii_frames(frames, start_time, end_time,
+                         plants=plants,
+                         meteo_extractor=meteo_extractor,
+                         aws_s3=aws_s3,
+                         planner=planner)
+
+
+def store_huaweii_frames(frames:list,
+                         start_date:datetime,
+                         end_date:datetime,
+                         plants:list,
+                         meteo_extractor:MeteoExtractor,
+                         aws_s3:AWS3Extractor,
+                         planner:WindowPlanner = None,
+                         weather:bool = True) -> None:
+    # Without a planner the windows aren't recorded, without weather the
+    # weather of the plants is left to its own stream
+    start_time = int(start_date.timestamp() * 1000)
+    end_time = int(end_date.timestamp() * 1000)
+    frames = [f for f in frames if len(f) > 0]
+    df_dev_data = concat_frames(frames) if len(frames) > 0 else pd.DataFrame(columns=['devId'])
+
+    for plant in plants:
+        site = plant['site']
+        df_plant_data = df_dev_data[df_dev_data['devId'].isin(plant['df']['devId'])]
+        if planner is not None:
+            planner.record('huaweii', site, start_date, end_date, len(df_plant_data))
+
+        # Extract meto data
+        if weather and (plant['lon'] != None) & (plant['lat'] != None):
+            df_meteo = meteo_extractor.get_wheather_data(start_date=start_date,
+                                                         end_date=end_date,
+                                                         lon=plant['lon'],
+                                                         lat=plant['lat'])
+        else:
+            df_meteo = pd.DataFrame()
+
+        try:
+            if len(df_plant_data) >  0:
+                if aws_s3.dimensions is not None:
+                    # Star layout: only the keys and measurements are stored,
+                    # the plant and device fields live in the dimension tables
+                    aws_s3.dimensions.upsert('Huaweii', 'sites', plant.get('site_df'), key='plantCode')
+                    aws_s3.dimensions.upsert('Huaweii', 'devices', plant.get('devices_df', plant['df']), key='devId')
+                    with stage('merge', vendor='huaweii', site=site):
+                        df_ = pd.merge(plant['df'][['devId', 'plantCode']], df_plant_data, on='devId', how='inner')
+                        df_ = df_[['datetime'] + [c for c in df_.columns if c != 'datetime']]
+                else:
+                    with stage('merge', vendor='huaweii', site=site):
+                        df_ = pd.merge(plant['df'], df_plant_data, on='devId', how='inner')
+                aws_s3.store_df_s3(df = df_,
+                                    folder=plant['folder'],
+                                    file_name=f'inverter_details_{data_file_time(start_date)}_.csv')
+                
+                logging.info(f"Data stored into S3 for site={site}, start_time={start_time}, end_time={end_time}")
+            else:
+                logging.warning(f"No data retrieved for site={site}, start_time={start_time}, end_time={end_time}")
+            
+            if len(df_meteo) > 0:
+                aws_s3.store_df_s3(df = df_meteo,
+                                    folder=f'Huaweii/{site.upper()}/WeatherData',
+                                    file_name=f'weather_data_{data_file_time(start_date)}_.csv')
+
+        except Exception as e:
+            logging.error(f"Couldn't store inverter data into S3 for site={site}, start_time={start_time}, end_time={end_time}")
+            raise(e)
+
+
+def huaweii_plants(extractor:HuaweiiExtractor,
+                   meteo_extractor:MeteoExtractor,
+                   aws_s3:AWS3Extractor) -> list:
+    # Every plant with inverters, its devices and its resume point
+    try:
+        plants = extractor.get_plant_list()
+        df_plants = pd.DataFrame(plants)
+        plantCodes = df_plants.plantCode.unique()
+    except Exception as e:
+        logging.error(f'Failed calling Huaweii API get_plant_list: {str(e)}')
+        raise e
+    
+    try:
+        devices = extractor.get_device_list(plantCodes)
+        df_devices = pd.DataFrame(devices)
+        df_devices = df_devices[df_devices.devTypeId == 1]
+        df_devices.rename(columns={'stationCode':'plantCode'}, inplace=True)
+    except Exception as e:
+        logging.error(f'Failed calling Huaweii API get_device_list for plants {plantCodes}: {str(e)}')
+        raise e
+    
+    df = pd.merge(df_devices, df_plants, on='plantCode', how='inner')
+    df.rename(columns={'id': 'devId'}, inplace=True)
+    
+    plant_infos = []
+    for pl in range(len(df_plants)):
+        plant = df_plants.loc[pl, 'plantCode']
+        site = df_plants.loc[pl, 'plantName']
+        lon = df_plants.loc[pl, 'longitude']
+        lat = df_plants.loc[pl, 'latitude']
+
+        if (lon != None) & (lon != '1.000000') & (lat != None) & (lat != '1.000000') & (lon != '0.000000') & (lat != '0.000000'):
+            lat = lat + "N"
+            lon = str(abs(float(lon))) + "W"
+            if meteo_extractor.places is not None:
+                meteo_extractor.places.put(site, lat=lat, lon=lon, kind='site', source='huaweii')
+        else:
+            lat = None
+            lon = None
+
+        # Each plant is merged with its own devices only
+        df_plant = df[df['plantCode'] == plant]
+        devices = [str(d) for d in df_plant['devId']]
+        if len(devices) == 0:
+            continue
+
+        folder = f'Huaweii/{site.upper()}/PlantData'
+        start_date = aws_s3.get_last_data_date(folder=folder)
+        if start_date == None:
+            start_date = datetime.strptime(df_plants.loc[pl, 'gridConnectionDate'], "%Y-%m-%dT%H:%M:%S%z")
+
+        plant_infos.append({'site': site,
+                            'folder': folder,
+                            'devices': devices,
+                            'df': df_plant,
+                            'site_df': df_plants.loc[[pl]],
+                            'devices_df': df_devices[df_devices['plantCode'] == plant].rename(columns={'id': 'devId'}),
+                            'lon': lon,
+                            'lat': lat,
+                            'start_date': start_date})
+    return plant_infos
+
+
+def plan_huaweii_tasks(extractor:HuaweiiExtractor,
+                       meteo_extractor:MeteoExtractor,
+                       aws_s3:AWS3Extractor,
+                       planner:WindowPlanner) -> list:
+    # Without a token every window would fail later with an unrelated error,
+    # the vendor is not planned at all
+    try:
+        extractor.log_in()
+    except Exception as e:
+        logging.error(f'Failed to login in Huaweii API, no windows planned: {str(e)}')
+        raise e
+
+    windows = {}
+    for plant_info in huaweii_plants(extractor, meteo_extractor, aws_s3):
+        for window in huaweii_grid_windows(plant_info['start_date'], datetime.now()):
+            if not planner.is_empty('huaweii', plant_info['site'], *window):
+                windows.setdefault(window, []).append(plant_info)
+
+    # One task per window and group of plants whose devices fit in one call
+    tasks = []
+    for (window_start, window_end), window_plants in sorted(windows.items()):
+        for group in pack_huaweii_plants(window_plants):
+            tasks.append(IngestionTask('huaweii', ','.join([p['site'] for p in group]), None, window_start, window_end,
+                                       store_huaweii_window,
+                                       plants=group,
+                                       folders=[p['folder'] for p in group],
+                                       extractor=extractor,
+                                       meteo_extractor=meteo_extractor,
+                                       aws_s3=aws_s3,
+                                       planner=planner))
+    return tasks
+
+
+def huaweii_group_frame(start_time:datetime,
+                        end_time:datetime,
+                        extractor:HuaweiiExtractor,
+                        devices:list) -> pd.DataFrame:
+    frames = [f for f in fetch_huaweii_devices(extractor, devices, start_time, end_time) if len(f) > 0]
+    return concat_frames(frames) if len(frames) > 0 else pd.DataFrame()
+
+
+def store_huaweii_batch(df_dev_data:pd.DataFrame,
+                        start_time:datetime,
+                        end_time:datetime,
+                        plants:list,
+                        meteo_extractor:MeteoExtractor,
+                        aws_s3:AWS3Extractor) -> None:
+    store_huaweii_frames([df_dev_data], start_time, end_time,
+                         plants=plants,
+                         meteo_extractor=meteo_extractor,
+                         aws_s3=aws_s3,
+                         weather=False)
+
+
+def huaweii_streams(extractor:HuaweiiExtractor,
+                    meteo_extractor:MeteoExtractor,
+                    aws_s3:AWS3Extractor,
+                    flush_rows:int = DEFAULT_FLUSH_ROWS) -> list:
+    # Daemon streams: one per group of plants whose devices fit in one call,
+    # with a watermark per device, and one for the weather of each located
+    # plant. The token of the extractor is kept and renewed when it expires.
+    plants = huaweii_plants(extractor, meteo_extractor, aws_s3)
+    streams = []
+    for group in pack_huaweii_plants(plants):
+        devices = [d for plant in group for d in plant['devices']]
+        watermarks = {d: as_utc(plant['start_date']) for plant in group for d in plant['devices']}
+        streams.append(PollStream('huaweii', ','.join([p['site'] for p in group]), devices,
+                                  fetch=partial(huaweii_group_frame, extractor=extractor, devices=devices),
+                                  store=partial(store_huaweii_batch,
+                                                plants=group,
+                                                meteo_extractor=meteo_extractor,
+                                                aws_s3=aws_s3),
+                                  watermarks=watermarks,
+                                  step=VENDOR_WINDOWS['huaweii']['max'],
+                                  device_column='devId',
+                                  governor=extractor.governor,
+                                  calls=-(-len(devices) // MAX_DEVICES_PER_CALL),
+                                  flush_rows=flush_rows))
+    for plant in plants:
+        if plant['lon'] == None or plant['lat'] == None:
+            continue
+        streams.append(weather_stream('huaweii', plant['site'], f"Huaweii/{plant['site'].upper()}/WeatherData",
+                                      meteo_extractor=meteo_extractor,
+                                      aws_s3=aws_s3,
+                                      watermark=as_utc(plant['start_date']),
+                                      flush_rows=flush_rows,
+                                      lon=plant['lon'],
+                                      lat=plant['lat']))
+    return streams
+
+
+def store_huaweii_inverter_data_to_S3(sites:dict,
+                                      meteo_credentials:dict,
+                                      aws_secret_key:str,
+                                      aws_access_key_id: str,
+                                      scheduler:IngestionScheduler = None):
+    aws_s3 = AWS3Extractor(aws_secret_key=aws_secret_key,
+                           aws_access_key_id=aws_access_key_id)
+    schemas = SchemaRegistry()
+    with HuaweiiExtractor(sites, schemas=schemas) as extractor, MeteoExtractor(meteo_credentials, cache=WeatherCache(), places=PlaceCache()) as meteo_extractor:
+        planner = WindowPlanner()
+        tasks = plan_huaweii_tasks(extractor=extractor,
+                                   meteo_extractor=meteo_extractor,
+                                   aws_s3=aws_s3,
+                                   planner=planner)
+        failed = run_ingestion_tasks(tasks, aws_s3, scheduler)
+        planner.save()
+        schemas.save()
+        return failed
+
+
+async def store_huaweii_window_async(site:str,
+                                     device:str,
+                                     start_time:datetime,
+                                     end_time:datetime,
+                                     plants:list,
+                                     folders:list,
+                                     extractor:'AsyncHuaweiiExtractor',
+                                     meteo_extractor:MeteoExtractor,
+                                     aws_s3:AWS3Extractor,
+                                     planner:WindowPlanner) -> None:
+    devices = [d for plant in plants for d in plant['devices']]
+    chunks = [devices[i:i + MAX_DEVICES_PER_CALL] for i in range(0, len(devices), MAX_DEVICES_PER_CALL)]
+    try:
+        frames = await asyncio.gather(*[extractor.get_device_data_as_df(chunk,
+                                                                        int(start_time.timestamp() * 1000),
+                                                                        int(end_time.timestamp() * 1000))
+                                        for chunk in chunks])
+    except Exception as e:
+        logging.error(f'Failed calling Huaweii API get_device_data for devices {devices}: {str(e)}')
+        raise e
+    await asyncio.to_thread(store_huaweii_frames, list(frames), start_time, end_time,
+                            plants=plants,
+                            meteo_extractor=meteo_extractor,
+                            aws_s3=aws_s3,
+                            planner=planner)
+
+ASYNC_WINDOWS[store_huaweii_window] = (store_huaweii_window_async, ['extractor'])
+
+
+def build_planner(stack:ExitStack,
+                  sites:dict,
+                  coordinates:dict,
+                  pool_size:int,
+                  meteo_extractor:MeteoExtractor,
+                  aws_s3:AWS3Extractor,
+                  planner:WindowPlanner,
+                  schemas:SchemaRegistry = None):
+    # Plant coordinates come from the FusionSolar plant list
+    huaweii_ext = stack.enter_context(HuaweiiExtractor(sites,
+                                                       pool_size=pool_size,
+                                                       schemas=schemas))
+    return lambda: plan_huaweii_tasks(extractor=huaweii_ext,
+                                      meteo_extractor=meteo_extractor,
+                                      aws_s3=aws_s3,
+                                      planner=planner)
+
+
+def build_poller(stack:ExitStack,
+                 sites:dict,
+                 coordinates:dict,
+                 pool_size:int,
+                 meteo_extractor:MeteoExtractor,
+                 aws_s3:AWS3Extractor,
+                 planner:WindowPlanner,
+                 schemas:SchemaRegistry = None,
+                 flush_rows:int = DEFAULT_FLUSH_ROWS):
+    # Daemon counterpart of build_planner, the extractor and its token last
+    # the whole run
+    huaweii_ext = stack.enter_context(HuaweiiExtractor(sites,
+                                                       pool_size=pool_size,
+                                                       schemas=schemas))
+    return lambda: huaweii_streams(extractor=huaweii_ext,
+                                   meteo_extractor=meteo_extractor,
+                                   aws_s3=aws_s3,
+                                   flush_rows=flush_rows)
@@ -0,0 +1,347 @@
+import asyncio
+import logging
+from contextlib import ExitStack
+from functools import partial
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+import pandas as pd
+import requests
+from src.api_solared import SolarEdgeExtractor
+from src.api_metomatics import MeteoExtractor
+from src.api_aws import AWS3Extractor
+from src.scheduler import IngestionScheduler, IngestionTask, split_windows
+from src.http_session import build_session
+from src.meteo_cache import WeatherCache, PlaceCache
+from src.window_planner import WindowPlanner, VENDOR_WINDOWS, naive
+from src.metrics import stage
+from src.timestamps import as_utc
+from src.watermarks import data_file_time
+from src.dtypes import identifier
+from src.pipeline_common import (ASYNC_WINDOWS, WEATHER_WINDOW, run_ingestion_tasks, store_weather_window,
+                                  weather_location, weather_stream)
+from src.daemon import PollStream, DEFAULT_FLUSH_ROWS
+
+if TYPE_CHECKING:
+    from src.api_async import AsyncSolarEdgeExtractor
+
+
+BACKFILL_PROBE_AFTER = timedelta(days=30)
+
+
+def store_solaredge_window(site:str,
+                           device:str,
+                           start_time:datetime,
+                           end_time:datetime,
+                           folder:str,
+                           solaredge_extr:SolarEdgeExtractor,
+                           aws_s3:AWS3Extractor,
+                           df_site_details:pd.DataFrame,
+                           df_components:pd.DataFrame,
+                           planner:WindowPlanner) -> None:
+    serial_number = device
+    try:
+        df_inv_data = solaredge_extr.get_inverter_data_as_df(serial_number=serial_number,
+                                                             start_time=start_time,
+                                                             end_time=end_time)
+        planner.record('solaredge', site, start_time, end_time, len(df_inv_data), device=serial_number)
+        
+        logging.info(f"Extracted SolarEdge API get_inverter_data method for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
+    except Exception as e:
+        logging.error(f"Failed calling SolarEdge API get_inverter_data method for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
+        raise e
+
+    store_solaredge_frame(df_inv_data, site, serial_number, start_time, end_time,
+                          folder=folder,
+                          aws_s3=aws_s3,
+                          df_site_details=df_site_details,
+                          df_components=df_components)
+
+
+def store_solaredge_frame(df_inv_data:pd.DataFrame,
+                          site:str,
+                          serial_number:str,
+                          start_time:datetime,
+                          end_time:datetime,
+                          folder:str,
+                          aws_s3:AWS3Extractor,
+                          df_site_details:pd.DataFrame,
+                          df_components:pd.DataFrame) -> None:
+    with stage('merge', vendor='solaredge', site=site):
+        df_inv_data['component_id'] = identifier(serial_number, len(df_inv_data))
+        if aws_s3.dimensions is not None:
+            # Star layout: the site and component fields live in the dimension tables
+            df_inv_data['site_id'] = identifier(df_site_details.loc[0, 'site_id'], len(df_inv_data))
+            idx_cols = ['datetime', 'site_id', 'component_id']
+        else:
+            df_inv_data = pd.merge(df_inv_data, df_components, on='component_id', how='inner')
+            df_inv_data = pd.merge(df_inv_data, df_site_details, on='site_id', how='inner')
+            idx_cols = ['datetime'] + list(df_site_details.columns) + [c for c in df_components.columns if c!='site_id']
+
+    try:
+        if len(df_inv_data) >  0:
+            if aws_s3.dimensions is not None:
+                aws_s3.dimensions.upsert('SolarEdge', 'sites', df_site_details, key='site_id')
+                aws_s3.dimensions.upsert('SolarEdge', 'devices', df_components, key='component_id')
+            data_cols = [c for c in df_inv_data.columns if c not in idx_cols]
+            df_inv_data = df_inv_data[idx_cols + data_cols].drop_duplicates()
+            aws_s3.store_df_s3(df = df_inv_data,
+                                folder=folder,
+                                file_name=f'inverter_details_{data_file_time(start_time)}_{serial_number}.csv',
+                                device=serial_number)
+            
+            logging.info(f"Data stored into S3 for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
+        else:
+            logging.warning(f"No data retrieved for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
+    
+    except Exception as e:
+        logging.error(f"Couldn't store inverter data into S3 for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
+        raise(e)
+
+
+def probe_solaredge_site(solaredge_extr:SolarEdgeExtractor,
+                         planner:WindowPlanner,
+                         site:str,
+                         start_time:datetime) -> tuple:
+    # One dataPeriod call, and one daily energy call per year of backfill,
+    # mark the days without any production data as empty for the planner.
+    # Dates come in the site's wall time, the planner works in server local time.
+    site_time = lambda value: naive(as_utc(datetime.strptime(value, '%Y-%m-%d %H:%M:%S'), solaredge_extr.timezone))
+    period = solaredge_extr.get_data_period()
+    data_start = site_time(f"{period['startDate']} 00:00:00") if period.get('startDate') else None
+    data_end = site_time(f"{period['endDate']} 00:00:00") + timedelta(days=1) if period.get('endDate') else None
+
+    cursor = max(start_time, data_start) if data_start is not None else start_time
+    probe_end = min(data_end, datetime.now()) if data_end is not None else datetime.now()
+    while cursor < probe_end:
+        chunk_end = min(cursor + timedelta(days=365), probe_end)
+        for value in solaredge_extr.get_site_energy(start_time=cursor, end_time=chunk_end):
+            if value['value'] is None:
+                day = site_time(value['date'])
+                planner.mark_empty('solaredge', site, day, day + timedelta(days=1))
+        cursor = chunk_end + timedelta(days=1)
+    return data_start, data_end
+
+
+def solaredge_site_metadata(solaredge_extr:SolarEdgeExtractor) -> tuple:
+    # Site details and inverters of the extractor's site
+    try:
+        df_site_details = solaredge_extr.get_site_details_as_df()
+    except Exception as e:
+        logging.error('Failed calling SolarEdge API get_site_details method')
+        raise e
+
+    try:
+        components = solaredge_extr.get_componet_list()
+    except Exception as e:
+        logging.error('Failed calling SolarEdge API get_component_list method')
+        raise e
+
+    df_components = pd.DataFrame(components)
+    df_components['site_id'] = df_site_details.loc[0, 'site_id']
+    df_components.rename(columns={'serialNumber' : 'component_id',
+                                  'name':'component_name'}, inplace=True)
+    return df_site_details, df_components
+
+
+def plan_solaredge_tasks(sites:dict,
+                         meteo_extractor:MeteoExtractor,
+                         aws_s3:AWS3Extractor,
+                         coordinates:dict,
+                         planner:WindowPlanner,
+                         session:requests.Session = None) -> list:
+    tasks = []
+    for site in sites.keys():
+        # Sites share one keep-alive session, it is closed by the caller
+        solaredge_extr = SolarEdgeExtractor(sites[site], session=session)
+        df_site_details, df_components = solaredge_site_metadata(solaredge_extr)
+        city = df_site_details.loc[0, 'location_city']
+        timezone = df_site_details.loc[0, 'location_timeZone']
+        installation_date = naive(as_utc(datetime.strptime(df_site_details.loc[0,'installationDate'], '%Y-%m-%d'), timezone))
+
+        folder = f'SolarEdge/{site.upper()}/PlantData'
+        start_times = {}
+        for j in range(len(df_components)):
+            serial_number = df_components.loc[j,'component_id']
+            # Files written before the UTC timestamps resume in the site's wall time
+            start_time = aws_s3.get_last_data_date(folder=folder, device=serial_number)
+            start_times[serial_number] = naive(as_utc(start_time, timezone)) if start_time != None else installation_date
+        if len(start_times) == 0:
+            continue
+        site_start_time = min(start_times.values())
+
+        # Backfills are worth a few calls to learn where the data actually is
+        data_start, data_end = None, None
+        if site_start_time < datetime.now() - BACKFILL_PROBE_AFTER:
+            try:
+                data_start, data_end = probe_solaredge_site(solaredge_extr, planner, site, site_start_time)
+            except Exception as e:
+                logging.error(f'Failed probing SolarEdge data period for site={site}: {str(e)}')
+
+        for serial_number, start_time in start_times.items():
+            windows = planner.plan('solaredge', site, start_time, datetime.now(),
+                                   device=serial_number,
+                                   data_start=data_start,
+                                   data_end=data_end)
+            for window_start, window_end in windows:
+                tasks.append(IngestionTask('solaredge', site, serial_number, window_start, window_end,
+                                           store_solaredge_window,
+                                           governor=solaredge_extr.governor,
+                                           folder=folder,
+                                           solaredge_extr=solaredge_extr,
+                                           aws_s3=aws_s3,
+                                           df_site_details=df_site_details,
+                                           df_components=df_components,
+                                           planner=planner))
+
+        # Weather is the same for every component, it is stored once per site window
+        location = weather_location(site, coordinates, city)
+        weather_start_time = max(site_start_time, data_start) if data_start is not None else site_start_time
+        for window_start, window_end in split_windows(weather_start_time, datetime.now(), WEATHER_WINDOW):
+            tasks.append(IngestionTask('solaredge', site, None, window_start, window_end,
+                                       store_weather_window,
+                                       folder=f'SolarEdge/{site.upper()}/WeatherData',
+                                       meteo_extractor=meteo_extractor,
+                                       aws_s3=aws_s3,
+                                       timezone=timezone,
+                                       **location))
+    return tasks
+
+
+def solaredge_streams(sites:dict,
+                      meteo_extractor:MeteoExtractor,
+                      aws_s3:AWS3Extractor,
+                      coordinates:dict,
+                      session:requests.Session = None,
+                      flush_rows:int = DEFAULT_FLUSH_ROWS) -> list:
+    # Daemon streams: one per inverter, resuming from its watermark, and one
+    # for the weather of each site
+    streams = []
+    for site in sites.keys():
+        solaredge_extr = SolarEdgeExtractor(sites[site], session=session)
+        df_site_details, df_components = solaredge_site_metadata(solaredge_extr)
+        city = df_site_details.loc[0, 'location_city']
+        timezone = df_site_details.loc[0, 'location_timeZone']
+        installation_date = as_utc(datetime.strptime(df_site_details.loc[0,'installationDate'], '%Y-%m-%d'), timezone)
+
+        folder = f'SolarEdge/{site.upper()}/PlantData'
+        watermarks = {}
+        for serial_number in df_components['component_id']:
+            last_date = aws_s3.get_last_data_date(folder=folder, device=serial_number)
+            watermarks[serial_number] = as_utc(last_date, timezone) if last_date != None else installation_date
+            streams.append(PollStream('solaredge', site, [serial_number],
+                                      fetch=partial(solaredge_extr.get_inverter_data_as_df, serial_number),
+                                      store=partial(store_solaredge_frame,
+                                                    site=site,
+                                                    serial_number=serial_number,
+                                                    folder=folder,
+                                                    aws_s3=aws_s3,
+                                                    df_site_details=df_site_details,
+                                                    df_components=df_components),
+                                      watermarks={serial_number: watermarks[serial_number]},
+                                      step=VENDOR_WINDOWS['solaredge']['max'],
+                                      governor=solaredge_extr.governor,
+                                      flush_rows=flush_rows))
+        if len(watermarks) == 0:
+            continue
+        streams.append(weather_stream('solaredge', site, f'SolarEdge/{site.upper()}/WeatherData',
+                                      meteo_extractor=meteo_extractor,
+                                      aws_s3=aws_s3,
+                                      watermark=min(watermarks.values()),
+                                      flush_rows=flush_rows,
+                                      timezone=timezone,
+                                      **weather_location(site, coordinates, city)))
+    return streams
+
+
+def store_solaredge_inverter_data_to_S3(sites:dict,
+                                        meteo_credentials:dict,
+                                        aws_access_key_id,
+                                        aws_secret_key,
+                                        coordinates:dict,
+                                        start_time:datetime = None,
+                                        end_time:datetime = None,
+                                        scheduler:IngestionScheduler = None):
+
+    aws_s3 = AWS3Extractor(aws_secret_key=aws_secret_key,
+                           aws_access_key_id=aws_access_key_id)
+    places = PlaceCache()
+    places.warm(coordinates)
+    with MeteoExtractor(meteo_credentials, cache=WeatherCache(), places=places) as meteo_extractor, build_session() as session:
+        planner = WindowPlanner()
+        tasks = plan_solaredge_tasks(sites=sites,
+                                     meteo_extractor=meteo_extractor,
+                                     aws_s3=aws_s3,
+                                     coordinates=coordinates,
+                                     session=session,
+                                     planner=planner)
+        failed = run_ingestion_tasks(tasks, aws_s3, scheduler)
+        planner.save()
+        return failed
+
+
+async def store_solaredge_window_async(site:str,
+                                       device:str,
+                                       start_time:datetime,
+                                       end_time:datetime,
+                                       folder:str,
+                                       solaredge_extr:'AsyncSolarEdgeExtractor',
+                                       aws_s3:AWS3Extractor,
+                                       df_site_details:pd.DataFrame,
+                                       df_components:pd.DataFrame,
+                                       planner:WindowPlanner) -> None:
+    serial_number = device
+    try:
+        df_inv_data = await solaredge_extr.get_inverter_data_as_df(serial_number=serial_number,
+                                                                   start_time=start_time,
+                                                                   end_time=end_time)
+        planner.record('solaredge', site, start_time, end_time, len(df_inv_data), device=serial_number)
+        logging.info(f"Extracted SolarEdge API get_inverter_data method for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
+    except Exception as e:
+        logging.error(f"Failed calling SolarEdge API get_inverter_data method for site={site}, serial_number={serial_number}, start_time={start_time}, end_time={end_time}")
+        raise e
+
+    # Merging and uploading run on a worker thread, the loop keeps fetching
+    await asyncio.to_thread(store_solaredge_frame, df_inv_data, site, serial_number, start_time, end_time,
+                            folder=folder,
+                            aws_s3=aws_s3,
+                            df_site_details=df_site_details,
+                            df_components=df_components)
+
+ASYNC_WINDOWS[store_solaredge_window] = (store_solaredge_window_async, ['solaredge_extr'])
+
+
+def build_planner(stack:ExitStack,
+                  sites:dict,
+                  coordinates:dict,
+                  pool_size:int,
+                  meteo_extractor:MeteoExtractor,
+                  aws_s3:AWS3Extractor,
+                  planner:WindowPlanner,
+                  schemas = None):
+    # Sites share one keep-alive session, closed with the stack
+    session = stack.enter_context(build_session(pool_size=pool_size))
+    return lambda: plan_solaredge_tasks(sites=sites,
+                                        meteo_extractor=meteo_extractor,
+                                        aws_s3=aws_s3,
+                                        coordinates=coordinates,
+                                        session=session,
+                                        planner=planner)
+
+
+def build_poller(stack:ExitStack,
+                 sites:dict,
+                 coordinates:dict,
+                 pool_size:int,
+                 meteo_extractor:MeteoExtractor,
+                 aws_s3:AWS3Extractor,
+                 planner:WindowPlanner,
+                 schemas = None,
+                 flush_rows:int = DEFAULT_FLUSH_ROWS):
+    # Daemon counterpart of build_planner, the session lasts the whole run
+    session = stack.enter_context(build_session(pool_size=pool_size))
+    return lambda: solaredge_streams(sites=sites,
+                                     meteo_extractor=meteo_extractor,
+                                     aws_s3=aws_s3,
+                                     coordinates=coordinates,
+                                     session=session,
+                                     flush_rows=flush_rows)
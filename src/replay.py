@@ -0,0 +1,250 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from src.http_session import DEFAULT_POOL_SIZE
+
+
+# Credentials are left out of the recorded requests and of the lookup keys,
+# so a cassette replays with any config.json
+REDACTED_FIELDS = ('api_key', 'key', 'userName', 'systemCode')
+# Headers that describe the original transfer, not the payload
+SKIPPED_HEADERS = ('set-cookie', 'content-encoding', 'transfer-encoding', 'content-length', 'connection', 'keep-alive')
+
+
+class ReplayMiss(requests.exceptions.RequestException):
+    # Not a connection error, so the governors don't retry it
+    pass
+
+
+def _redact_body(body) -> object:
+    if body is None or len(body) == 0:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    if isinstance(data, dict):
+        data = {k: v for k, v in data.items() if k not in REDACTED_FIELDS}
+    return data
+
+
+def request_key(method:str,
+                url:str,
+                body = None) -> tuple:
+    # (lookup hash, redacted request) of one call
+    parts = urlsplit(url)
+    query = sorted([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in REDACTED_FIELDS])
+    request = {'method': method.upper(),
+               'host': parts.netloc,
+               'path': parts.path,
+               'query': query,
+               'body': _redact_body(body)}
+    digest = hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+    return digest, request
+
+
+class Cassette(object):
+    def __init__(self, directory:str) -> None:
+        # One JSON file per recorded call, named after the request hash and
+        # grouped by host
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, host:str, digest:str) -> str:
+        return os.path.join(self.directory, host.replace(':', '_'), f'{digest}.json')
+
+    def get(self,
+            method:str,
+            url:str,
+            body = None) -> dict:
+        digest, request = request_key(method, url, body)
+        try:
+            with open(self._path(request['host'], digest)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        content = entry['content']
+        entry['content'] = base64.b64decode(content) if entry.get('base64') else content.encode('utf-8')
+        return entry
+
+    def put(self,
+            method:str,
+            url:str,
+            body,
+            status_code:int,
+            headers:dict,
+            content:bytes) -> None:
+        digest, request = request_key(method, url, body)
+        try:
+            text, is_base64 = content.decode('utf-8'), False
+        except UnicodeDecodeError:
+            text, is_base64 = base64.b64encode(content).decode('ascii'), True
+        entry = {'request': request,
+                 'status_code': status_code,
+                 'headers': {k: v for k, v in headers.items() if k.lower() not in SKIPPED_HEADERS},
+                 'content': text,
+                 'base64': is_base64}
+        path = self._path(request['host'], digest)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_file = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(entry, f, indent=1)
+            os.replace(tmp_file, path)
+
+    def __len__(self) -> int:
+        return sum([len([f for f in files if f.endswith('.json')]) for _, _, files in os.walk(self.directory)])
+
+
+def build_response(request:requests.PreparedRequest,
+                   status_code:int,
+                   headers:dict,
+                   content:bytes) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status_code
+    res.headers = CaseInsensitiveDict(headers)
+    res._content = content
+    res.encoding = 'utf-8'
+    res.url = request.url
+    res.request = request
+    return res
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self,
+                 cassette:Cassette,
+                 pool_size:int = DEFAULT_POOL_SIZE) -> None:
+        # Calls go to the network as usual, every answer is also written to
+        # the cassette
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.cassette = cassette
+
+    def send(self, request:requests.PreparedRequest, **kwargs) -> requests.Response:
+        res = super().send(request, **kwargs)
+        self.cassette.put(request.method, request.url, request.body, res.status_code, res.headers, res.content)
+        return res
+
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self,
+                 cassette:Cassette,
+                 pool_size:int = DEFAULT_POOL_SIZE) -> None:
+        # Answers come from the cassette in process, nothing reaches the network
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request:requests.PreparedRequest, **kwargs) -> requests.Response:
+        entry = self.cassette.get(request.method, request.url, request.body)
+        if entry is None:
+            _, redacted = request_key(request.method, request.url, request.body)
+            raise ReplayMiss(f'No recorded response for {redacted}')
+        return build_response(request, entry['status_code'], entry['headers'], entry['content'])
+
+    def close(self) -> None:
+        pass
+
+
+class StubAdapter(HTTPAdapter):
+    def __init__(self,
+                 base_url:str,
+                 pool_size:int = DEFAULT_POOL_SIZE) -> None:
+        # https://host/path is sent to <base_url>/host/path, the local
+        # StubServer answers as host would
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request:requests.PreparedRequest, **kwargs) -> requests.Response:
+        parts = urlsplit(request.url)
+        request = request.copy()
+        request.url = f'{self.base_url}/{parts.netloc}{parts.path}' + (f'?{parts.query}' if parts.query else '')
+        return super().send(request, **kwargs)
+
+
+class StubServer(object):
+    def __init__(self,
+                 cassette:Cassette = None,
+                 fallback = None,
+                 host:str = '127.0.0.1',
+                 port:int = 0) -> None:
+        # Serves the recorded calls over local HTTP. fallback(method, url, body)
+        # answers calls the cassette doesn't hold with (status, headers, content),
+        # or None for a 404.
+        self.cassette = cassette
+        self.fallback = fallback
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def respond(self,
+                method:str,
+                url:str,
+                body:bytes) -> tuple:
+        with self._lock:
+            self.requests += 1
+        entry = self.cassette.get(method, url, body) if self.cassette is not None else None
+        if entry is not None:
+            return entry['status_code'], entry['headers'], entry['content']
+        if self.fallback is not None:
+            return self.fallback(method, url, body)
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _serve(self) -> None:
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length > 0 else None
+                host, _, path = self.path.lstrip('/').partition('/')
+                answer = server.respond(self.command, f'https://{host}/{path}', body)
+                status, headers, content = answer if answer is not None else (404, {}, b'{}')
+                self.send_response(status)
+                for k, v in headers.items():
+                    if k.lower() not in SKIPPED_HEADERS:
+                        self.send_header(k, v)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = _serve
+            do_POST = _serve
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
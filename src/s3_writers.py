@@ -0,0 +1,295 @@
+import threading
+import time
+import pandas as pd
+from boto3.s3.transfer import TransferConfig
+from io import BytesIO
+from src.metrics import metrics, key_labels
+from src.dtypes import IDENTIFIER_COLUMNS, INT64_COLUMNS
+from src.timestamps import to_utc
+from src.watermarks import parse_data_folder
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def strip_extension(file_name:str) -> str:
+    for extension in ('.csv', '.parquet'):
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return file_name
+
+
+def coerce_dtypes(df:pd.DataFrame) -> pd.DataFrame:
+    # Parquet needs one type per column, object columns become numbers when
+    # every value is a number and strings otherwise. Text stays text, zip
+    # codes and other numeric-looking strings keep their leading zeros.
+    df = df.copy()
+    for c in df.columns:
+        if c == 'datetime':
+            df[c] = to_utc(df[c])
+        elif df[c].dtype == object or pd.api.types.is_string_dtype(df[c].dtype):
+            values = df[c].dropna()
+            if len(values) > 0 and not values.map(lambda v: isinstance(v, str)).any():
+                numeric = pd.to_numeric(df[c], errors='coerce')
+                if numeric.notna().sum() == df[c].notna().sum():
+                    df[c] = numeric
+                    continue
+            df[c] = df[c].astype('string')
+    return df
+
+
+def arrow_type(name:str, values:pd.Series):
+    # Stored type of a column, from its name and dtype kind only, so every
+    # partition of a dataset gets the same one whatever its values. Numbers
+    # are stored as float64, which holds the float32, float64 and int32 of
+    # the dtype contract (src/dtypes.py) and the missing values between them.
+    # None for a column without any value, its type can't be told.
+    if name == 'datetime':
+        return pa.timestamp('ns', tz='UTC')
+    if name in INT64_COLUMNS:
+        return pa.int64()
+    if name in IDENTIFIER_COLUMNS:
+        return pa.string()
+    if not values.notna().any():
+        return None
+    if values.dtype.kind == 'b':
+        return pa.bool_()
+    if values.dtype.kind in 'iuf':
+        return pa.float64()
+    return pa.string()
+
+
+def record_write(key:str,
+                 nbytes:int,
+                 serialize_time:float,
+                 upload_time:float) -> None:
+    vendor, site = key_labels(key)
+    registry = metrics()
+    registry.observe('serialize', serialize_time, vendor=vendor, site=site)
+    registry.observe('upload', upload_time, vendor=vendor, site=site)
+    registry.add('upload_bytes', nbytes, vendor=vendor, site=site)
+
+
+class UploadStats(object):
+    def __init__(self) -> None:
+        self.uploads = 0
+        self.parts = 0
+        self.bytes = 0
+        self.peak_buffer_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self,
+               parts:int,
+               nbytes:int,
+               peak_buffer_bytes:int) -> None:
+        with self._lock:
+            self.uploads += 1
+            self.parts += parts
+            self.bytes += nbytes
+            self.peak_buffer_bytes = max(self.peak_buffer_bytes, peak_buffer_bytes)
+
+    def as_dict(self) -> dict:
+        # ru_maxrss is the high-water mark of the whole process, in KB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource is not None else None
+        return {'uploads': self.uploads,
+                'parts': self.parts,
+                'bytes': self.bytes,
+                'peak_buffer_bytes': self.peak_buffer_bytes,
+                'peak_rss_bytes': peak_rss}
+
+
+class CsvWriter(object):
+    extension = 'csv'
+
+    def __init__(self,
+                 chunk_rows:int = 20000,
+                 part_size:int = 8 * 1024 * 1024) -> None:
+        # S3 rejects multipart parts under 5 MB, except the last one
+        self.chunk_rows = chunk_rows
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.stats = UploadStats()
+
+    def keys(self,
+             df:pd.DataFrame,
+             folder:str,
+             file_name:str) -> list:
+        return [(f'{folder}/{strip_extension(file_name)}.csv', df)]
+
+    def encode_chunks(self, df:pd.DataFrame):
+        if len(df) == 0:
+            yield df.to_csv(index=False).encode('utf-8')
+        for i in range(0, len(df), self.chunk_rows):
+            yield df.iloc[i:i + self.chunk_rows].to_csv(index=False, header=(i == 0)).encode('utf-8')
+
+    def write(self,
+              df:pd.DataFrame,
+              bucket_name:str,
+              key:str,
+              client,
+              transfer_config:TransferConfig = None) -> None:
+        # Rows are encoded chunk by chunk into a buffer of about part_size, which
+        # is shipped as one part of a multipart upload. Frames that fit in one
+        # part are sent with a single PUT.
+        buffer = bytearray()
+        upload_id = None
+        parts = []
+        total = 0
+        peak = 0
+        # Encoding and uploading interleave, the write time minus the time
+        # spent in S3 calls is the serialization time
+        started = time.perf_counter()
+        upload_time = 0.0
+        try:
+            for chunk in self.encode_chunks(df):
+                buffer += chunk
+                peak = max(peak, len(buffer))
+                if len(buffer) >= self.part_size:
+                    t0 = time.perf_counter()
+                    if upload_id is None:
+                        upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key)['UploadId']
+                    parts.append(self._upload_part(client, bucket_name, key, upload_id, len(parts) + 1, buffer))
+                    upload_time += time.perf_counter() - t0
+                    total += len(buffer)
+                    buffer = bytearray()
+
+            t0 = time.perf_counter()
+            if upload_id is None:
+                client.put_object(Bucket=bucket_name, Key=key, Body=buffer)
+            else:
+                if len(buffer) > 0:
+                    parts.append(self._upload_part(client, bucket_name, key, upload_id, len(parts) + 1, buffer))
+                client.complete_multipart_upload(Bucket=bucket_name,
+                                                 Key=key,
+                                                 UploadId=upload_id,
+                                                 MultipartUpload={'Parts': parts})
+            upload_time += time.perf_counter() - t0
+            total += len(buffer)
+        except Exception as e:
+            if upload_id is not None:
+                client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise e
+        self.stats.record(parts=max(len(parts), 1), nbytes=total, peak_buffer_bytes=peak)
+        record_write(key, nbytes=total, serialize_time=time.perf_counter() - started - upload_time, upload_time=upload_time)
+
+    def _upload_part(self,
+                     client,
+                     bucket_name:str,
+                     key:str,
+                     upload_id:str,
+                     part_number:int,
+                     buffer:bytearray) -> dict:
+        res = client.upload_part(Bucket=bucket_name,
+                                 Key=key,
+                                 UploadId=upload_id,
+                                 PartNumber=part_number,
+                                 Body=buffer)
+        return {'ETag': res['ETag'], 'PartNumber': part_number}
+
+    def read(self,
+             body:bytes,
+             text:bool = False) -> pd.DataFrame:
+        # text=True keeps every cell as written, e.g. zip codes with their
+        # leading zeros, and empty cells as ''
+        if text:
+            return pd.read_csv(BytesIO(body), dtype=str, keep_default_na=False)
+        return pd.read_csv(BytesIO(body))
+
+
+class ParquetWriter(object):
+    extension = 'parquet'
+
+    def __init__(self, compression:str = 'zstd') -> None:
+        if pa is None:
+            raise ImportError('Parquet output requires pyarrow, install it with `pip install pyarrow`')
+        self.compression = compression
+        self.stats = UploadStats()
+        # Column types of every dataset (data folder) written so far
+        self._datasets = {}
+        self._lock = threading.Lock()
+
+    def keys(self,
+             df:pd.DataFrame,
+             folder:str,
+             file_name:str) -> list:
+        # vendor/site/<data folder>/year=YYYY/month=MM/<file>.parquet
+        name = f'{strip_extension(file_name)}.parquet'
+        df = coerce_dtypes(df)
+        if 'datetime' not in df.columns or len(df) == 0:
+            return [(f'{folder}/{name}', df)]
+        keys = []
+        for (year, month), df_part in df.groupby([df['datetime'].dt.year, df['datetime'].dt.month]):
+            keys.append((f'{folder}/year={year}/month={month:02d}/{name}', df_part))
+        return keys
+
+    def schema(self,
+               df:pd.DataFrame,
+               dataset:str):
+        # Schema of a partition of dataset. Columns without any value take
+        # their type from the dataset, or are left out until it is known.
+        # A column whose type differs from earlier partitions is an error.
+        with self._lock:
+            known = self._datasets.setdefault(dataset, {})
+            fields = []
+            for c in df.columns:
+                stored = arrow_type(c, df[c])
+                if stored is None:
+                    stored = known.get(c)
+                    if stored is None:
+                        continue
+                elif c in known and known[c] != stored:
+                    raise ValueError(f'Column {c} of {dataset} is {stored}, earlier partitions hold {known[c]}')
+                known[c] = stored
+                fields.append(pa.field(c, stored))
+            return pa.schema(fields)
+
+    def table(self,
+              df:pd.DataFrame,
+              dataset:str):
+        schema = self.schema(df, dataset)
+        table = pa.Table.from_pandas(df[schema.names], preserve_index=False)
+        return table.replace_schema_metadata(None).cast(schema)
+
+    def write(self,
+              df:pd.DataFrame,
+              bucket_name:str,
+              key:str,
+              client,
+              transfer_config:TransferConfig = None) -> None:
+        started = time.perf_counter()
+        buffer = BytesIO()
+        pq.write_table(self.table(df, dataset=parse_data_folder(key)),
+                       buffer,
+                       compression=self.compression)
+        nbytes = buffer.tell()
+        buffer.seek(0)
+        serialize_time = time.perf_counter() - started
+        client.upload_fileobj(buffer, bucket_name, key, Config=transfer_config)
+        self.stats.record(parts=1, nbytes=nbytes, peak_buffer_bytes=nbytes)
+        record_write(key, nbytes=nbytes, serialize_time=serialize_time, upload_time=time.perf_counter() - started - serialize_time)
+
+    def read(self,
+             body:bytes,
+             text:bool = False) -> pd.DataFrame:
+        # Parquet columns keep the types they were written with
+        return pd.read_parquet(BytesIO(body))
+
+
+WRITERS = {'csv': CsvWriter,
+           'parquet': ParquetWriter}
+
+
+def get_writer(output_format:str = 'csv'):
+    return WRITERS[output_format]()
+
+
+def reader_for_key(key:str):
+    return ParquetWriter() if key.endswith('.parquet') else CsvWriter()
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from src.governor import RequestGovernor
+from src.checkpoints import CheckpointJournal
+from src.metrics import site_label
+
+
+DEFAULT_VENDOR_LIMITS = {'solaredge': 4,
+                         'fronius': 4,
+                         'huaweii': 2}
+
+# In-flight tasks per vendor on the event loop. SolarEdge accepts 3
+# concurrent calls, the governors pace the rest.
+DEFAULT_ASYNC_LIMITS = {'solaredge': 3,
+                        'fronius': 64,
+                        'huaweii': 8}
+
+
+def split_windows(start_time:datetime,
+                  end_time:datetime,
+                  step:timedelta) -> list:
+    windows = []
+    while start_time <= end_time:
+        windows.append((start_time, start_time + step))
+        start_time = start_time + step
+    return windows
+
+
+class IngestionTask(object):
+    def __init__(self,
+                 vendor:str,
+                 site:str,
+                 device:str,
+                 start_time:datetime,
+                 end_time:datetime,
+                 func,
+                 governor:RequestGovernor = None,
+                 cost:int = 1,
+                 **kwargs) -> None:
+
+        # governor and cost (API calls the task makes) let the scheduler keep
+        # the task within the daily quota of its API key
+        self.vendor = vendor
+        self.site = site
+        self.device = device
+        self.start_time = start_time
+        self.end_time = end_time
+        self.func = func
+        self.governor = governor
+        self.cost = cost
+        self.kwargs = kwargs
+
+    def run(self):
+        return self.func(site=self.site,
+                         device=self.device,
+                         start_time=self.start_time,
+                         end_time=self.end_time,
+                         **self.kwargs)
+
+    def __repr__(self) -> str:
+        return f'{self.vendor}(site={self.site}, device={self.device}, start_time={self.start_time}, end_time={self.end_time})'
+
+
+class IngestionScheduler(object):
+    def __init__(self,
+                 vendor_limits:dict = None,
+                 journal:CheckpointJournal = None) -> None:
+        self.vendor_limits = dict(DEFAULT_VENDOR_LIMITS)
+        self.vendor_limits.update(vendor_limits or {})
+        self.journal = journal
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def _executor(self, vendor:str) -> ThreadPoolExecutor:
+        # One bounded pool per vendor, so a slow API never starves the others
+        with self._lock:
+            if vendor not in self._executors:
+                self._executors[vendor] = ThreadPoolExecutor(max_workers=self.vendor_limits.get(vendor, 1),
+                                                             thread_name_prefix=vendor)
+            return self._executors[vendor]
+
+    def within_quota(self, tasks:list) -> tuple:
+        # Oldest windows get the remaining daily calls first, so resume points
+        # move forward without gaps. The rest is left for a later run.
+        budgets = {}
+        runnable = []
+        deferred = []
+        for task in sorted(tasks, key=lambda t: t.start_time.timestamp()):
+            remaining = task.governor.remaining() if task.governor is not None else None
+            if remaining is None:
+                runnable.append(task)
+                continue
+            budget = budgets.setdefault(id(task.governor), remaining)
+            if budget < task.cost:
+                deferred.append(task)
+            else:
+                budgets[id(task.governor)] = budget - task.cost
+                runnable.append(task)
+        return runnable, deferred
+
+    def plan(self, tasks:list) -> tuple:
+        # Tasks a previous run already finished are skipped, the rest is kept
+        # within the daily quotas
+        if self.journal is not None:
+            tasks, done = self.journal.pending(tasks)
+            if len(done) > 0:
+                logging.info(f'Skipped {len(done)} ingestion tasks finished by a previous run')
+            self.journal.start_run(tasks)
+        tasks, deferred = self.within_quota(tasks)
+        if len(deferred) > 0:
+            logging.warning(f'Deferred {len(deferred)} ingestion tasks, their daily API quota is used up')
+        return tasks, deferred
+
+    def record(self,
+               task:IngestionTask,
+               started:float,
+               error:Exception = None) -> None:
+        if error is not None:
+            logging.error(f'Ingestion task {task} failed: {str(error)}')
+        if self.journal is not None:
+            self.journal.record(task, seconds=time.monotonic() - started, error=error)
+
+    def _run_task(self,
+                  task:IngestionTask,
+                  listener = None) -> None:
+        started = time.monotonic()
+        try:
+            with site_label(task.site):
+                task.run()
+        except Exception as e:
+            self.record(task, started, error=e)
+            if listener is not None:
+                listener.finished(task, error=e)
+            raise
+        self.record(task, started)
+        if listener is not None:
+            listener.finished(task)
+
+    def run(self,
+            tasks:list,
+            listener = None) -> list:
+        # listener.planned(tasks) is called with the tasks left to run, the
+        # deferred ones included, and listener.finished(task, error=None) as
+        # each one ends
+        tasks, deferred = self.plan(tasks)
+        if listener is not None:
+            listener.planned(tasks + deferred)
+        failed = list(deferred)
+        futures = {self._executor(t.vendor).submit(self._run_task, t, listener): t for t in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                future.result()
+            except Exception:
+                failed.append(task)
+        logging.info(f'Ran {len(tasks)} ingestion tasks, {len(failed)} failed')
+        return failed
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for executor in self._executors.values():
+                executor.shutdown(wait=True)
+            self._executors = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.shutdown()
+
+
+class AsyncIngestionScheduler(IngestionScheduler):
+    def __init__(self,
+                 vendor_limits:dict = None,
+                 journal:CheckpointJournal = None) -> None:
+        super().__init__(journal=journal)
+        self.vendor_limits = dict(DEFAULT_ASYNC_LIMITS)
+        self.vendor_limits.update(vendor_limits or {})
+
+    async def run_async(self,
+                        tasks:list,
+                        listener = None) -> list:
+        # Task functions are coroutines, every task is in flight at once and
+        # waits on its vendor's semaphore
+        tasks, deferred = self.plan(tasks)
+        if listener is not None:
+            listener.planned(tasks + deferred)
+        semaphores = {v: asyncio.Semaphore(self.vendor_limits.get(v, 1)) for v in set([t.vendor for t in tasks])}
+
+        async def run(task:IngestionTask) -> IngestionTask:
+            async with semaphores[task.vendor]:
+                started = time.monotonic()
+                try:
+                    with site_label(task.site):
+                        await task.run()
+                except Exception as e:
+                    self.record(task, started, error=e)
+                    if listener is not None:
+                        listener.finished(task, error=e)
+                    return task
+            self.record(task, started)
+            if listener is not None:
+                listener.finished(task)
+            return None
+
+        results = await asyncio.gather(*[run(t) for t in tasks])
+        failed = list(deferred) + [t for t in results if t is not None]
+        logging.info(f'Ran {len(tasks)} async ingestion tasks, {len(failed)} failed')
+        return failed
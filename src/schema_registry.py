@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+MAX_DRIFT_EVENTS = 20
+
+
+class SchemaRegistry(object):
+    def __init__(self, state_file:str = None) -> None:
+        # Known columns (in first-seen order) and dtypes of every vendor and
+        # device type, kept across runs in cache/schemas.json
+        self.state_file = state_file or os.path.join(os.getcwd(), 'cache', 'schemas.json')
+        self._lock = threading.Lock()
+        self._state = self._load()
+        self._dirty = False
+
+    def _load(self) -> dict:
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._state, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.state_file)
+            self._dirty = False
+
+    def _key(self,
+             vendor:str,
+             device_type:str) -> str:
+        return f'{vendor}/{device_type}'
+
+    def schema(self,
+               vendor:str,
+               device_type:str) -> tuple:
+        # (columns, dtypes) known for the vendor and device type
+        with self._lock:
+            entry = self._state.get(self._key(vendor, device_type), {'columns': [], 'dtypes': {}})
+            return list(entry['columns']), dict(entry['dtypes'])
+
+    def observe(self,
+                vendor:str,
+                device_type:str,
+                columns:list,
+                dtypes:dict = None) -> list:
+        # Adds unseen columns and dtype changes to the schema, each change is
+        # logged once as a drift event. Returns the full column list.
+        key = self._key(vendor, device_type)
+        with self._lock:
+            entry = self._state.setdefault(key, {'columns': [], 'dtypes': {}, 'drift': []})
+            known = set(entry['columns'])
+            added = [c for c in dict.fromkeys(columns) if c not in known]
+            changed = {c: [entry['dtypes'][c], d] for c, d in (dtypes or {}).items()
+                       if c in entry['dtypes'] and entry['dtypes'][c] != d}
+            new_dtypes = {c: d for c, d in (dtypes or {}).items() if c not in entry['dtypes']}
+            if len(added) == 0 and len(changed) == 0 and len(new_dtypes) == 0:
+                return list(entry['columns'])
+
+            first_seen = len(entry['columns']) == 0
+            entry['columns'] += added
+            entry['dtypes'].update({c: d[1] for c, d in changed.items()})
+            entry['dtypes'].update(new_dtypes)
+            if not first_seen and (len(added) > 0 or len(changed) > 0):
+                entry.setdefault('drift', []).append({'at': datetime.now().strftime(TIME_FORMAT),
+                                                      'added': added,
+                                                      'changed': changed})
+                entry['drift'] = entry['drift'][-MAX_DRIFT_EVENTS:]
+                logging.warning(f'Schema drift in {key}: added columns {added}, changed dtypes {changed}')
+            self._dirty = True
+            return list(entry['columns'])
+
+    def build_frame(self,
+                    vendor:str,
+                    device_type:str,
+                    columns:dict,
+                    n_rows:int) -> pd.DataFrame:
+        # columns maps names to lists of n_rows values (None when missing).
+        # Every known column is built straight into its recorded dtype, absent
+        # ones are filled with missing values, so frames of the same device
+        # type always share one schema.
+        schema = self.observe(vendor, device_type, list(columns.keys()))
+        _, dtypes = self.schema(vendor, device_type)
+
+        data = {}
+        observed = {}
+        for c in schema:
+            values = columns.get(c)
+            dtype = dtypes.get(c)
+            if values is None:
+                data[c] = np.full(n_rows, np.nan) if dtype == 'float64' else [None] * n_rows
+                continue
+            if dtype == 'object':
+                data[c] = values
+                continue
+            if dtype == 'float64':
+                try:
+                    data[c] = np.array(values, dtype=dtype)
+                    continue
+                except (TypeError, ValueError):
+                    pass
+            elif dtype == 'int64':
+                # Missing values or floats turn the column into float64
+                array = np.asarray(values)
+                if array.dtype.kind in 'iu':
+                    data[c] = array.astype(dtype)
+                    continue
+            series = pd.Series(values, dtype=object).infer_objects()
+            data[c] = series.to_numpy()
+            # Columns without any value yet don't pin a dtype
+            if series.notna().any():
+                observed[c] = {'i': 'int64', 'u': 'int64', 'f': 'float64'}.get(series.dtype.kind, 'object')
+
+        new = {c: d for c, d in observed.items() if dtypes.get(c) != d}
+        if len(new) > 0:
+            self.observe(vendor, device_type, [], new)
+        return pd.DataFrame(data, columns=schema)
@@ -0,0 +1,81 @@
+from datetime import datetime, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+
+
+# Timestamps stored by every vendor pipeline are datetime64 UTC columns.
+# Vendors answer in their own conventions:
+#   SolarEdge    naive wall time of the site ('2024-03-01 10:05:00')
+#   Fronius      UTC with a Z suffix ('2024-03-01T09:05:00Z')
+#   FusionSolar  epoch milliseconds (collectTime)
+#   Meteosource  naive wall time of the requested timezone ('2024-03-01T10:00:00')
+# Planning windows stay naive datetimes in server local time, see
+# window_planner.naive, and extractors convert them to what their API expects:
+# SolarEdge to the site's wall time, Fronius to UTC.
+UTC = 'UTC'
+UTC_DTYPE = 'datetime64[ns, UTC]'
+
+
+def parse_timestamps(values) -> pd.Series:
+    # Parses without localizing: the result is tz-aware only when the values
+    # carry an offset. Mixed offsets, e.g. across a DST change, come back in UTC.
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return series
+    try:
+        return pd.to_datetime(series, format='ISO8601')
+    except (ValueError, TypeError):
+        return pd.to_datetime(series, format='mixed', utc=True)
+
+
+def to_utc(values,
+           tz:str = None,
+           unit:str = None) -> pd.Series:
+    # One vectorized conversion of a column of vendor timestamps to
+    # datetime64 UTC. unit reads epoch numbers ('ms', 's'); otherwise values
+    # with an offset are converted and naive ones are wall times in tz (UTC
+    # when None).
+    if unit is not None:
+        series = values if isinstance(values, pd.Series) else pd.Series(values)
+        return pd.to_datetime(pd.to_numeric(series, errors='coerce'), unit=unit, utc=True).astype(UTC_DTYPE)
+
+    parsed = parse_timestamps(values)
+    if isinstance(parsed.dtype, pd.DatetimeTZDtype):
+        return parsed.dt.tz_convert(UTC).astype(UTC_DTYPE)
+    if tz is None or tz == UTC:
+        return parsed.dt.tz_localize(UTC).astype(UTC_DTYPE)
+    try:
+        localized = parsed.dt.tz_localize(tz, ambiguous='infer', nonexistent='shift_forward')
+    except ValueError:
+        # The repeated hour of a DST change can't be told apart, it is read
+        # as standard time
+        localized = parsed.dt.tz_localize(tz, ambiguous=np.zeros(len(parsed), dtype=bool), nonexistent='shift_forward')
+    return localized.dt.tz_convert(UTC).astype(UTC_DTYPE)
+
+
+def as_utc(dt:datetime,
+           tz:str = None) -> datetime:
+    # Aware UTC datetime, a naive one is a wall time in tz (server local when None)
+    if dt is None:
+        return None
+    if isinstance(dt, pd.Timestamp):
+        dt = dt.to_pydatetime()
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo(tz)) if tz is not None else dt.astimezone()
+    return dt.astimezone(dt_timezone.utc)
+
+
+def to_local(dt:datetime,
+             tz:str = None) -> datetime:
+    # Naive wall time in tz (server local when None) of an aware datetime or
+    # of a naive one in server local time
+    if dt is None:
+        return None
+    if tz is None:
+        return dt.astimezone().replace(tzinfo=None) if dt.tzinfo is not None else dt
+    return dt.astimezone(ZoneInfo(tz)).replace(tzinfo=None)
+
+
+def utc_now() -> datetime:
+    return datetime.now(dt_timezone.utc)
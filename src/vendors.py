@@ -0,0 +1,21 @@
+import importlib
+
+
+# Vendors selectable with --api. A vendor's pipeline module, and with it its
+# extractor and their dependencies, is imported only when the vendor runs.
+# Every module exposes build_planner(stack, sites, coordinates, pool_size,
+# meteo_extractor, aws_s3, planner, schemas), which opens the vendor's
+# extractor on the stack and returns the callable planning its tasks, and
+# build_poller with the same arguments plus flush_rows, which returns the
+# callable discovering the vendor's PollStreams for --daemon.
+VENDORS = {'solaredge': {'folder': 'SolarEdge', 'config': 'SOLAREDGE', 'module': 'src.pipeline_solaredge'},
+           'fronius': {'folder': 'Fronius', 'config': 'FRONIUS', 'module': 'src.pipeline_fronius'},
+           'huaweii': {'folder': 'Huaweii', 'config': 'HUAWEII', 'module': 'src.pipeline_huaweii'}}
+
+VENDOR_FOLDERS = {api: vendor['folder'] for api, vendor in VENDORS.items()}
+
+
+def load_vendor(api:str):
+    if api not in VENDORS:
+        raise ValueError(f'Unknown vendor {api}, expected one of {list(VENDORS.keys())}')
+    return importlib.import_module(VENDORS[api]['module'])
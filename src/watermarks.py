@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+import boto3
+from src.timestamps import as_utc, to_local
+from botocore.exceptions import ClientError
+
+
+WATERMARK_PREFIX = '_watermarks'
+DATA_FOLDER = 'PlantData'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+SITE_DEVICE = '_site'
+
+
+def data_file_time(start_time:datetime) -> str:
+    # Start time of a data file name, server local time as the planner windows
+    return to_local(start_time).strftime(TIME_FORMAT)
+
+
+def parse_data_file_name(key:str) -> tuple:
+    # inverter_details_{start_time}_{device}.csv -> (start_time, device), the
+    # start time in server local time. Names written from aware datetimes
+    # carry an offset, and some fractions of a second.
+    name = key.split('/')[-1].rsplit('.', 1)[0]
+    parts = name.split('_')
+    try:
+        start_time = to_local(datetime.fromisoformat(parts[2]))
+    except (IndexError, ValueError):
+        return None, None
+    device = '_'.join(parts[3:])
+    return start_time, device if device != '' else None
+
+
+def parse_data_folder(key:str) -> str:
+    # Drops the file name and any year=/month= partition directories
+    parts = key.split('/')[:-1]
+    while len(parts) > 0 and '=' in parts[-1]:
+        parts = parts[:-1]
+    return '/'.join(parts)
+
+
+class WatermarkStore(object):
+    def __init__(self,
+                 aws_access_key_id:str,
+                 aws_secret_key:str,
+                 cache_file:str = None,
+                 client_factory = None) -> None:
+
+        self.aws_access_key_id = aws_access_key_id
+        self.client_factory = client_factory
+        self.aws_secret_key = aws_secret_key
+        self.cache_file = cache_file or os.path.join(os.getcwd(), 'cache', 'watermarks.json')
+        self._client = None
+        self._lock = threading.Lock()
+        self._cache = self._load_cache()
+        # Starts (UTC) of the unfinished windows of every manifest, and the
+        # newest update held back behind them
+        self._holds = {}
+        self._held = {}
+
+    @property
+    def client(self):
+        if self._client is None and self.client_factory is not None:
+            self._client = self.client_factory()
+        if self._client is None:
+            self._client = boto3.client('s3',
+                                        aws_access_key_id=self.aws_access_key_id,
+                                        aws_secret_access_key=self.aws_secret_key)
+        return self._client
+
+    def manifest_key(self, folder:str, device:str = None) -> str:
+        return f'{WATERMARK_PREFIX}/{folder.strip("/")}/{device or SITE_DEVICE}.json'
+
+    def _cache_key(self, bucket:str, folder:str, device:str = None) -> str:
+        return f'{bucket}/{self.manifest_key(folder, device)}'
+
+    def _load_cache(self) -> dict:
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self._cache, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)
+
+    def _read_manifest(self, bucket:str, key:str) -> dict:
+        try:
+            obj = self.client.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise e
+        return json.loads(obj['Body'].read())
+
+    def get(self,
+            folder:str,
+            device:str = None,
+            bucket:str = 'prod-satia-raw-data',
+            refresh:bool = False) -> datetime:
+
+        cache_key = self._cache_key(bucket, folder, device)
+        manifest = None if refresh else self._cache.get(cache_key)
+        if manifest is None:
+            manifest = self._read_manifest(bucket, self.manifest_key(folder, device))
+            if manifest is None:
+                return None
+            with self._lock:
+                self._cache[cache_key] = manifest
+                self._save_cache()
+        return self._manifest_date(manifest)
+
+    def _manifest_date(self, manifest:dict) -> datetime:
+        # Manifests marked UTC hold UTC, older ones the naive wall time their
+        # data files were written in
+        last_date = datetime.strptime(manifest['last_date'], TIME_FORMAT)
+        return last_date.replace(tzinfo=timezone.utc) if manifest.get('tz') == 'UTC' else last_date
+
+    def update(self,
+               folder:str,
+               last_date:datetime,
+               last_key:str,
+               device:str = None,
+               bucket:str = 'prod-satia-raw-data',
+               force:bool = False) -> None:
+
+        # While earlier windows of the manifest are unfinished the update is
+        # held back, see hold()
+        if not force:
+            cache_key = self._cache_key(bucket, folder, device)
+            with self._lock:
+                held = cache_key in self._holds
+                if held:
+                    current = self._held.get(cache_key)
+                    if current is None or as_utc(current[0]) < as_utc(last_date):
+                        self._held[cache_key] = (last_date, last_key)
+            if held:
+                self._advance(folder, device, bucket)
+                return
+        self._write(folder=folder, last_date=last_date, last_key=last_key, device=device, bucket=bucket, force=force)
+
+    def _write(self,
+               folder:str,
+               last_date:datetime,
+               last_key:str,
+               device:str = None,
+               bucket:str = 'prod-satia-raw-data',
+               force:bool = False) -> None:
+
+        # Aware dates are kept in UTC, naive ones (from files with naive
+        # timestamps) as they are
+        cache_key = self._cache_key(bucket, folder, device)
+        manifest_tz = 'UTC' if last_date.tzinfo is not None else None
+        with self._lock:
+            current = self._cache.get(cache_key)
+            if current is None and not force:
+                current = self._read_manifest(bucket, self.manifest_key(folder, device))
+            # Watermarks only move forward, unless a rebuild says otherwise
+            if not force and current is not None and as_utc(self._manifest_date(current)) >= as_utc(last_date):
+                return
+            manifest = {'folder': folder,
+                        'device': device,
+                        'last_date': (as_utc(last_date) if manifest_tz else last_date).strftime(TIME_FORMAT),
+                        'tz': manifest_tz,
+                        'last_key': last_key,
+                        'updated_at': datetime.now(timezone.utc).strftime(TIME_FORMAT)}
+            # A single PUT replaces the manifest atomically
+            self.client.put_object(Bucket=bucket,
+                                   Key=self.manifest_key(folder, device),
+                                   Body=json.dumps(manifest).encode('utf-8'),
+                                   ContentType='application/json')
+            self._cache[cache_key] = manifest
+            self._save_cache()
+
+    def hold(self,
+             folder:str,
+             start_time:datetime,
+             device:str = None,
+             bucket:str = 'prod-satia-raw-data') -> None:
+        # A window starting at start_time is planned. Windows finish out of
+        # order, and the manifest only moves across the ones that finished:
+        # a run dying with an earlier window unfinished resumes from it.
+        with self._lock:
+            self._holds.setdefault(self._cache_key(bucket, folder, device), []).append(as_utc(start_time))
+
+    def release(self,
+                folder:str,
+                start_time:datetime,
+                device:str = None,
+                bucket:str = 'prod-satia-raw-data',
+                failed:bool = False) -> None:
+        # A failed window keeps its hold, nothing after it is stored as done
+        cache_key = self._cache_key(bucket, folder, device)
+        with self._lock:
+            holds = self._holds.get(cache_key)
+            if holds is None:
+                return
+            if not failed:
+                holds.remove(as_utc(start_time))
+                if len(holds) == 0:
+                    del self._holds[cache_key]
+        self._advance(folder, device, bucket)
+
+    def _advance(self,
+                 folder:str,
+                 device:str = None,
+                 bucket:str = 'prod-satia-raw-data') -> None:
+        # Moves the manifest to the held update, or up to the earliest
+        # unfinished window: every window before it is stored
+        cache_key = self._cache_key(bucket, folder, device)
+        with self._lock:
+            held = self._held.get(cache_key)
+            if held is None:
+                return
+            holds = self._holds.get(cache_key)
+            if holds is None or as_utc(held[0]) <= min(holds):
+                del self._held[cache_key]
+                last_date, last_key = held
+            else:
+                last_date, last_key = min(holds), None
+        self._write(folder=folder, last_date=last_date, last_key=last_key, device=device, bucket=bucket)
+
+    def rewind(self,
+               folder:str,
+               last_date:datetime,
+               device:str = None,
+               bucket:str = 'prod-satia-raw-data') -> None:
+
+        current = self.get(folder=folder, device=device, bucket=bucket)
+        # last_date is a window start, naive ones are in server local time
+        if current is not None and as_utc(current) > as_utc(last_date):
+            self.update(folder=folder,
+                        device=device,
+                        last_date=as_utc(last_date),
+                        last_key=None,
+                        bucket=bucket,
+                        force=True)
@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Largest range each history endpoint accepts in one request, the smallest
+# window worth requesting, and the row count above which a window is
+# considered too large and is halved next time.
+VENDOR_WINDOWS = {'solaredge': {'max': timedelta(days=7),
+                                'min': timedelta(days=1),
+                                'large_rows': 10000},
+                  'fronius': {'max': timedelta(days=1),
+                              'min': timedelta(hours=6),
+                              'large_rows': 5000},
+                  'huaweii': {'max': timedelta(days=3),
+                              'min': timedelta(days=1),
+                              'large_rows': 20000}}
+
+# Recent windows may still be filled by the vendor, they are never marked empty
+EMPTY_MARGIN = timedelta(days=2)
+
+
+def naive(dt:datetime) -> datetime:
+    # State is kept in naive local time, aware datetimes are converted to it
+    return dt.astimezone().replace(tzinfo=None) if dt.tzinfo is not None else dt
+
+
+class WindowPlanner(object):
+    def __init__(self, state_file:str = None) -> None:
+        self.state_file = state_file or os.path.join(os.getcwd(), 'cache', 'windows.json')
+        self._lock = threading.Lock()
+        self._state = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        with self._lock:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._state, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.state_file)
+
+    def _key(self,
+             vendor:str,
+             site:str,
+             device:str = None) -> str:
+        return f'{vendor}/{site}/{device or ""}'
+
+    def _entry(self,
+               vendor:str,
+               site:str,
+               device:str = None) -> dict:
+        key = self._key(vendor, site, device)
+        if key not in self._state:
+            self._state[key] = {'step': VENDOR_WINDOWS[vendor]['max'].total_seconds(),
+                                'empty': []}
+        return self._state[key]
+
+    def empty_ranges(self,
+                     vendor:str,
+                     site:str,
+                     device:str = None) -> list:
+        # Ranges known to be empty for the device, or for the whole site
+        with self._lock:
+            ranges = list(self._entry(vendor, site, device)['empty'])
+            if device is not None:
+                ranges += self._entry(vendor, site)['empty']
+        ranges = [(datetime.strptime(s, TIME_FORMAT), datetime.strptime(e, TIME_FORMAT)) for s, e in ranges]
+        return sorted(ranges)
+
+    def mark_empty(self,
+                   vendor:str,
+                   site:str,
+                   start_time:datetime,
+                   end_time:datetime,
+                   device:str = None) -> None:
+        start_time = naive(start_time)
+        end_time = min(naive(end_time), datetime.now() - EMPTY_MARGIN)
+        if end_time <= start_time:
+            return
+        with self._lock:
+            entry = self._entry(vendor, site, device)
+            ranges = [(datetime.strptime(s, TIME_FORMAT), datetime.strptime(e, TIME_FORMAT)) for s, e in entry['empty']]
+            ranges = sorted(ranges + [(start_time, end_time)])
+
+            # Overlapping or touching ranges are merged
+            merged = [ranges[0]]
+            for s, e in ranges[1:]:
+                if s <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+                else:
+                    merged.append((s, e))
+            entry['empty'] = [[s.strftime(TIME_FORMAT), e.strftime(TIME_FORMAT)] for s, e in merged]
+
+    def is_empty(self,
+                 vendor:str,
+                 site:str,
+                 start_time:datetime,
+                 end_time:datetime,
+                 device:str = None) -> bool:
+        for s, e in self.empty_ranges(vendor, site, device):
+            if s <= naive(start_time) and naive(end_time) <= e:
+                return True
+        return False
+
+    def record(self,
+               vendor:str,
+               site:str,
+               start_time:datetime,
+               end_time:datetime,
+               rows:int,
+               device:str = None) -> None:
+        limits = VENDOR_WINDOWS[vendor]
+        if rows == 0:
+            self.mark_empty(vendor, site, start_time, end_time, device)
+        with self._lock:
+            entry = self._entry(vendor, site, device)
+            step = timedelta(seconds=entry['step'])
+            if rows > limits['large_rows']:
+                step = max(step / 2, limits['min'])
+            elif rows < limits['large_rows'] / 4:
+                step = min(step * 2, limits['max'])
+            entry['step'] = step.total_seconds()
+
+    def plan(self,
+             vendor:str,
+             site:str,
+             start_time:datetime,
+             end_time:datetime,
+             device:str = None,
+             data_start:datetime = None,
+             data_end:datetime = None,
+             whole:bool = False) -> list:
+        # Windows of the current step (never above the API maximum) covering
+        # start_time..end_time, clipped to the range the vendor reports data
+        # for and jumping over ranges known to be empty. With whole=True a
+        # trailing window shorter than the step is left for a later run.
+        start_time = naive(start_time)
+        end_time = naive(end_time)
+        if data_start is not None:
+            start_time = max(start_time, naive(data_start))
+        if data_end is not None:
+            end_time = min(end_time, naive(data_end))
+
+        with self._lock:
+            step = timedelta(seconds=self._entry(vendor, site, device)['step'])
+        step = min(step, VENDOR_WINDOWS[vendor]['max'])
+        empty = self.empty_ranges(vendor, site, device)
+
+        windows = []
+        cursor = start_time
+        while cursor < end_time:
+            skipped = False
+            for s, e in empty:
+                if s <= cursor < e:
+                    cursor = e
+                    skipped = True
+            if skipped:
+                continue
+            window_end = cursor + step
+            if whole and window_end > end_time:
+                break
+            window_end = min(window_end, end_time)
+            # A window stops where the next empty range starts
+            for s, e in empty:
+                if cursor < s < window_end:
+                    window_end = s
+                    break
+            windows.append((cursor, window_end))
+            cursor = window_end
+        return windows
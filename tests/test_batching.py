@@ -0,0 +1,62 @@
+import os
+import sys
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.batching import FrameBatcher
+from src.dtypes import identifier
+
+
+START = datetime(2024, 3, 1)
+DAY = timedelta(days=1)
+
+
+def day_frame(i:int, rows:int = 100, columns:tuple = ('power',)) -> pd.DataFrame:
+    df = pd.DataFrame({'datetime': pd.date_range(START + i * DAY, periods=rows, freq='5min', tz='UTC')})
+    df['deviceId'] = identifier(f'DEV{i % 2}', rows)
+    for c in columns:
+        df[c] = 1.0
+    return df
+
+
+def test_flushes_every_batch_and_the_rest_on_close():
+    batches = []
+    with FrameBatcher(lambda df, s, e: batches.append((df, s, e)), batch_rows=250) as batcher:
+        for i in range(6):
+            batcher.add(day_frame(i), START + i * DAY, START + (i + 1) * DAY)
+        batcher.add(day_frame(6).iloc[:0], START + 6 * DAY, START + 7 * DAY)
+        assert len(batches) == 2
+    assert [len(df) for df, _, _ in batches] == [300, 300]
+    # Each batch covers the windows of its frames
+    assert [(s, e) for _, s, e in batches] == [(START, START + 3 * DAY), (START + 3 * DAY, START + 6 * DAY)]
+    assert batcher.batches == 2 and batcher.rows == 600
+
+    with FrameBatcher(lambda df, s, e: batches.append((df, s, e)), batch_rows=250) as batcher:
+        batcher.add(day_frame(7), START + 7 * DAY, START + 8 * DAY)
+    assert len(batches[-1][0]) == 100
+
+
+def test_union_of_columns_in_order_of_appearance():
+    batches = []
+    batcher = FrameBatcher(lambda df, s, e: batches.append(df), batch_rows=1000)
+    batcher.add(day_frame(0, columns=('power', 'voltage')), START, START + DAY)
+    batcher.add(day_frame(1, columns=('energy', 'power')), START + DAY, START + 2 * DAY)
+    batcher.close()
+    [df] = batches
+    assert list(df.columns) == ['datetime', 'deviceId', 'power', 'voltage', 'energy']
+    assert df['voltage'].isna().sum() == 100 and df['energy'].isna().sum() == 100
+    # Identifiers stay categorical across frames with different categories
+    assert isinstance(df['deviceId'].dtype, pd.CategoricalDtype)
+    assert set(df['deviceId']) == {'DEV0', 'DEV1'}
+
+
+def test_pending_rows_are_dropped_on_error():
+    batches = []
+    with pytest.raises(RuntimeError):
+        with FrameBatcher(lambda df, s, e: batches.append(df), batch_rows=1000) as batcher:
+            batcher.add(day_frame(0), START, START + DAY)
+            raise RuntimeError('HTTP 500')
+    assert batches == []
@@ -0,0 +1,66 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.checkpoints import CheckpointJournal
+from src.scheduler import IngestionTask
+from src.window_planner import EMPTY_MARGIN
+
+
+START = datetime(2024, 3, 1)
+DAY = timedelta(days=1)
+
+
+def task(start_day:float, end_day:float, device:str = 'INV1') -> IngestionTask:
+    return IngestionTask('solaredge', 'SITE', device, START + start_day * DAY, START + end_day * DAY, None)
+
+
+def journal(tmp_path, finished:list, failed:list = ()) -> CheckpointJournal:
+    journal = CheckpointJournal(db_file=str(tmp_path / 'checkpoints.db'))
+    for t in finished:
+        journal.record(t, seconds=1.0)
+    for t in failed:
+        journal.record(t, seconds=1.0, error=RuntimeError('HTTP 500'))
+    return journal
+
+
+def test_exact_window_is_done(tmp_path):
+    j = journal(tmp_path, [task(0, 7)])
+    assert j.is_done(task(0, 7))
+    assert not j.is_done(task(7, 14))
+    assert not j.is_done(task(0, 7, device='INV2'))
+
+
+def test_windows_covered_by_the_union_of_finished_ones(tmp_path):
+    # A run in 7 day windows, restarted in 5 day windows
+    j = journal(tmp_path, [task(0, 7), task(7, 14), task(12, 21)])
+    assert j.is_done(task(0, 5))
+    assert j.is_done(task(5, 10))
+    assert j.is_done(task(10, 15))
+    assert j.is_done(task(15, 20))
+    assert not j.is_done(task(20, 25))
+    todo, done = j.pending([task(i, i + 5) for i in range(0, 25, 5)])
+    assert [t.start_time for t in todo] == [START + 20 * DAY]
+    assert len(done) == 4
+
+
+def test_gaps_and_failures_are_not_covered(tmp_path):
+    j = journal(tmp_path, [task(0, 7), task(8, 14)], failed=[task(7, 8)])
+    assert not j.is_done(task(5, 10))
+    assert not j.is_done(task(7, 8))
+    assert j.is_done(task(8, 10))
+
+
+def test_recent_windows_stay_open(tmp_path):
+    now = datetime.now().replace(microsecond=0)
+    recent = IngestionTask('solaredge', 'SITE', 'INV1', now - DAY, now, None)
+    old = IngestionTask('solaredge', 'SITE', 'INV1', now - EMPTY_MARGIN - 2 * DAY, now - EMPTY_MARGIN - DAY, None)
+    j = journal(tmp_path, [recent, old])
+    status = dict(j._conn.execute('SELECT start_time, status FROM tasks').fetchall())
+    assert sorted(status.values()) == ['done', 'open']
+    # Open windows are fetched again, and don't cover later plans either
+    assert not j.is_done(recent)
+    assert not j.is_done(IngestionTask('solaredge', 'SITE', 'INV1', now - DAY, now - DAY / 2, None))
+    assert j.is_done(old)
@@ -0,0 +1,55 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.api_aws import AWS3Extractor
+from src.local_s3 import LocalS3Client
+from src.watermarks import WatermarkStore
+
+
+def aws_s3(tmp:str, output_format:str) -> AWS3Extractor:
+    # A new extractor is a new run, the tables are read again from the bucket
+    client = LocalS3Client(os.path.join(tmp, 's3'))
+    watermarks = WatermarkStore(None, None, cache_file=os.path.join(tmp, 'watermarks.json'), client_factory=lambda: client)
+    return AWS3Extractor(None, None, watermarks=watermarks, client=client, output_format=output_format, layout='star')
+
+
+def sites() -> pd.DataFrame:
+    return pd.DataFrame([{'site_id': 1001, 'site_name': 'ONE', 'location_zip': '01001', 'peakPower': 5.5,
+                          'installationDate': pd.Timestamp('2020-01-01'), 'notes': None, 'active': True},
+                         {'site_id': 1002, 'site_name': 'TWO', 'location_zip': '18001', 'peakPower': 10,
+                          'installationDate': pd.Timestamp('2021-06-01'), 'notes': 'roof', 'active': False}])
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_upserting_the_same_rows_writes_once(tmp_path, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    first = aws_s3(str(tmp_path), output_format)
+    assert first.dimensions.upsert('SolarEdge', 'sites', sites(), key='site_id') == 2
+    assert first.dimensions.upsert('SolarEdge', 'sites', sites(), key='site_id') == 0
+    assert first.dimensions.writes == 1
+
+    # The next run compares against the table read back from the file
+    second = aws_s3(str(tmp_path), output_format)
+    assert second.dimensions.upsert('SolarEdge', 'sites', sites(), key='site_id') == 0
+    assert second.dimensions.writes == 0
+
+    changed = sites()
+    changed.loc[1, 'peakPower'] = 12
+    assert second.dimensions.upsert('SolarEdge', 'sites', changed, key='site_id') == 1
+    assert second.dimensions.writes == 1
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_zip_codes_keep_their_leading_zeros(tmp_path, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    run = aws_s3(str(tmp_path), output_format)
+    run.dimensions.upsert('SolarEdge', 'sites', sites(), key='site_id')
+    df = run.read_df_from_s3(object_key=run.dimensions.table_key('SolarEdge', 'sites'),
+                             bucket_name=run.dimensions.bucket, text=True)
+    assert list(df['location_zip']) == ['01001', '18001']
@@ -0,0 +1,61 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.dtypes import apply_contract, concat_frames, identifier
+from src.timestamps import UTC_DTYPE
+
+
+def test_contract_dtypes():
+    df = pd.DataFrame({'datetime': pd.date_range('2024-03-01', periods=3, freq='5min'),
+                       'power': [1.5, 2.5, np.nan],
+                       'voltage': ['230.1', '231.0', None],
+                       'totalEnergy': [1.0e6, 1.1e6, 1.2e6],
+                       'big': [1.0, 2.0, 2.0 ** 25],
+                       'mode': [0, 1, 2],
+                       'counter': [0, 1, 2 ** 40],
+                       'collectTime': [1709251200000, 1709251500000, 1709251800000],
+                       'devId': [1, 2, 3],
+                       'site_id': [123, 123, 124],
+                       'inverterMode': ['MPPT', 'SLEEPING', 'MPPT'],
+                       'flag': [True, False, True],
+                       'nested': [[1], [2], [3]]})
+    apply_contract(df)
+    dtypes = {c: str(t) for c, t in df.dtypes.items()}
+    assert dtypes == {'datetime': UTC_DTYPE,
+                      'power': 'float32',
+                      'voltage': 'float32',
+                      'totalEnergy': 'float64',
+                      'big': 'float64',
+                      'mode': 'int32',
+                      'counter': 'int64',
+                      'collectTime': 'int64',
+                      'devId': 'int64',
+                      'site_id': 'category',
+                      'inverterMode': 'category',
+                      'flag': 'bool',
+                      'nested': 'object'}
+    # Numeric identifiers keep their text, naive timestamps are read as UTC
+    assert list(df['site_id'].cat.categories) == [123, 124]
+    assert df['datetime'].iloc[0] == pd.Timestamp('2024-03-01', tz='UTC')
+    assert df['voltage'].iloc[0] == np.float32(230.1)
+
+
+def test_aware_timestamps_are_converted_to_utc():
+    df = pd.DataFrame({'datetime': pd.date_range('2024-03-01 10:00', periods=2, freq='h', tz='Europe/Madrid')})
+    apply_contract(df)
+    assert str(df['datetime'].dtype) == UTC_DTYPE
+    assert df['datetime'].iloc[0] == pd.Timestamp('2024-03-01 09:00', tz='UTC')
+
+
+def test_concat_keeps_categoricals():
+    a = pd.DataFrame({'deviceId': identifier('DEV1', 2), 'power': np.float32(1.0)})
+    b = pd.DataFrame({'deviceId': identifier('DEV2', 3), 'power': np.float32(2.0)})
+    df = concat_frames([a, None, b])
+    assert isinstance(df['deviceId'].dtype, pd.CategoricalDtype)
+    assert list(df['deviceId']) == ['DEV1'] * 2 + ['DEV2'] * 3
+    assert str(df['power'].dtype) == 'float32'
+    assert len(concat_frames([])) == 0
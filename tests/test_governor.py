@@ -0,0 +1,162 @@
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.governor as governor
+from src.api_huaweii import HuaweiiExtractor
+from src.governor import QuotaExceeded, QuotaStore, RequestGovernor, retry_after_seconds
+from src.http_session import HTTPExtractor
+from src.metrics import metrics
+
+
+def response(status:int, body:dict = None, headers:dict = None) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status
+    res._content = json.dumps(body or {}).encode('utf-8')
+    res.headers.update(headers or {})
+    return res
+
+
+class StubSession(object):
+    # Answers with the given responses in turn, the last one from then on
+    def __init__(self, responses:list) -> None:
+        self.responses = list(responses)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def request(self, method:str, url:str, **kwargs) -> requests.Response:
+        with self._lock:
+            self.calls += 1
+            return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+    def close(self) -> None:
+        pass
+
+
+class FakeTime(object):
+    # Clock of the governor module, sleeping moves it forward at once
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds:float) -> None:
+        self.sleeps.append(seconds)
+        self.now += max(seconds, 0)
+
+
+class StubExtractor(HTTPExtractor):
+    vendor = 'stub'
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeTime:
+    fake = FakeTime()
+    monkeypatch.setattr(governor, 'time', fake)
+    return fake
+
+
+def test_retry_after_seconds(clock):
+    extractor = StubExtractor(session=StubSession([response(429, headers={'Retry-After': '7'}), response(200, {'ok': 1})]),
+                              governor=RequestGovernor('stub'))
+    res = extractor._get('https://stub/data')
+    assert res.status_code == 200
+    assert extractor.governor.retries == 1
+    assert extractor.governor.requests == 2
+    # The delay is Retry-After, and the bucket kept every caller waiting as long
+    assert sum(clock.sleeps) == pytest.approx(7.0)
+    assert extractor.governor.bucket.take() == 0.0
+
+
+def test_retry_after_http_date(clock):
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    throttled = response(429, headers={'Retry-After': format_datetime(retry_at, usegmt=True)})
+    assert 28.0 <= retry_after_seconds(throttled) <= 30.0
+    assert retry_after_seconds(response(429, headers={'Retry-After': 'soon'})) is None
+
+    extractor = StubExtractor(session=StubSession([throttled, response(200)]), governor=RequestGovernor('stub'))
+    assert extractor._get('https://stub/data').status_code == 200
+    assert 28.0 <= sum(clock.sleeps) <= 30.0
+
+
+def test_throttling_in_the_body(clock, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    session = StubSession([response(200, {'success': False, 'failCode': 407}),
+                           response(200, {'success': True, 'data': [1]})])
+    extractor = HuaweiiExtractor({'USER': 'user', 'PASSWORD': None}, session=session,
+                                 governor=RequestGovernor('huaweii', backoff_base=4.0))
+    res = extractor._post(extractor.api + 'getStationList', json={})
+    assert session.calls == 2
+    assert extractor.governor.retries == 1
+    assert extractor.decode(res) == {'success': True, 'data': [1]}
+    assert 0.0 <= sum(clock.sleeps) <= 4.0
+
+
+def test_retries_are_used_up(clock):
+    extractor = StubExtractor(session=StubSession([response(503)]), governor=RequestGovernor('stub', max_retries=3))
+    assert extractor._get('https://stub/data').status_code == 503
+    assert extractor.governor.requests == 4
+    assert extractor.governor.retries == 3
+
+
+def test_token_bucket_paces_calls(clock):
+    extractor = StubExtractor(session=StubSession([response(200)]), governor=RequestGovernor('stub', rate=2, burst=1))
+    for _ in range(5):
+        extractor._get('https://stub/data')
+    # The first call uses the burst, the other four wait half a second each
+    assert sum(clock.sleeps) == pytest.approx(2.0)
+
+
+def test_quota_is_kept_across_a_restart(clock, tmp_path):
+    state_file = str(tmp_path / 'quota.json')
+    session = StubSession([response(200)])
+    first_run = RequestGovernor('solaredge', '1', daily=3, quota=QuotaStore(state_file=state_file))
+    extractor = StubExtractor(session=session, governor=first_run)
+    for _ in range(3):
+        extractor._get('https://stub/data')
+    with pytest.raises(QuotaExceeded):
+        extractor._get('https://stub/data')
+    # Fewer calls than QUOTA_SAVE_CALLS are written at exit
+    first_run.quota.save()
+
+    second_run = RequestGovernor('solaredge', '1', daily=3, quota=QuotaStore(state_file=state_file))
+    assert second_run.remaining() == 0
+    with pytest.raises(QuotaExceeded):
+        StubExtractor(session=session, governor=second_run)._get('https://stub/data')
+    assert session.calls == 3
+
+
+def test_counters_under_threads(tmp_path):
+    metrics().reset()
+    quota = QuotaStore(state_file=str(tmp_path / 'quota.json'))
+    shared = RequestGovernor('stub', 'key', daily=10000, quota=quota, backoff_base=0.0)
+    n_threads, n_calls = 8, 100
+
+    def work(_) -> None:
+        for _ in range(n_calls):
+            # Every call is answered 503 once, then 200
+            StubExtractor(session=StubSession([response(503), response(200)]), governor=shared)._get('https://stub/data')
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    attempts = n_threads * n_calls * 2
+    assert shared.requests == attempts
+    assert shared.retries == n_threads * n_calls
+    assert metrics().counters[('retries', 'stub', '')] == n_threads * n_calls
+    assert quota.used('stub/key') == attempts
+    quota.save()
+    assert QuotaStore(state_file=quota.state_file).used('stub/key') == attempts
+    metrics().reset()
@@ -0,0 +1,57 @@
+import os
+import sys
+from datetime import datetime
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.governor import RequestGovernor
+from src.http_session import HTTPExtractor
+from src.metrics import metrics
+from src.scheduler import IngestionScheduler, IngestionTask
+
+
+def response(status:int) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status
+    res._content = b'{}'
+    return res
+
+
+class StubSession(object):
+    # Answers 503 once per URL, then 200
+    def __init__(self) -> None:
+        self.seen = set()
+
+    def request(self, method:str, url:str, **kwargs) -> requests.Response:
+        if url in self.seen:
+            return response(200)
+        self.seen.add(url)
+        return response(503)
+
+    def close(self) -> None:
+        pass
+
+
+class StubExtractor(HTTPExtractor):
+    vendor = 'stub'
+
+
+def fetch(site:str, device:str, start_time:datetime, end_time:datetime, extractor:StubExtractor) -> None:
+    extractor._get(f'https://stub/{site}')
+
+
+def test_http_and_retries_are_labelled_per_site():
+    metrics().reset()
+    extractor = StubExtractor(session=StubSession(), governor=RequestGovernor('stub', backoff_base=0.0))
+    tasks = [IngestionTask('stub', site, None, datetime(2024, 1, 1), datetime(2024, 1, 2), fetch, extractor=extractor)
+             for site in ('A', 'B')]
+    with IngestionScheduler(vendor_limits={'stub': 2}) as scheduler:
+        assert scheduler.run(tasks) == []
+
+    for site in ('A', 'B'):
+        assert metrics().histograms[('http', 'stub', site)].count == 1
+        assert metrics().counters[('retries', 'stub', site)] == 1
+        assert metrics().counters[('http_requests', 'stub', site)] == 1
+    assert ('http', 'stub', '') not in metrics().histograms
+    metrics().reset()
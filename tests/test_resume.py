@@ -0,0 +1,139 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import timedelta
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_pipelines import START, STEP, synthetic_vendor
+from src.api_aws import AWS3Extractor
+from src.api_solared import SolarEdgeExtractor
+from src.checkpoints import CheckpointJournal
+from src.governor import RequestGovernor
+from src.http_session import set_transport
+from src.local_s3 import LocalS3Client
+from src.pipeline_common import run_ingestion_tasks
+from src.pipeline_solaredge import store_solaredge_window
+from src.replay import StubAdapter, StubServer
+from src.scheduler import IngestionScheduler, IngestionTask, split_windows
+from src.timestamps import as_utc
+from src.watermarks import WatermarkStore
+from src.window_planner import WindowPlanner, naive
+
+
+SITE = 'site0'
+DEVICE = 'SE-0'
+FOLDER = f'SolarEdge/{SITE.upper()}/PlantData'
+END = START + timedelta(days=40)
+# The crashed run dies in its second window, once this many later windows finished
+CRASH_WINDOW = 1
+FINISHED_BEFORE_CRASH = 4
+
+
+class Run(object):
+    def __init__(self, tmp:str, server:StubServer) -> None:
+        # State of one process, kept under tmp like cache/ and the bucket
+        client = LocalS3Client(os.path.join(tmp, 's3'))
+        self.watermarks = WatermarkStore(None, None,
+                                         cache_file=os.path.join(tmp, 'watermarks.json'),
+                                         client_factory=lambda: client)
+        self.aws_s3 = AWS3Extractor(None, None, watermarks=self.watermarks, client=client)
+        self.journal = CheckpointJournal(db_file=os.path.join(tmp, 'checkpoints.db'))
+        self.planner = WindowPlanner(state_file=os.path.join(tmp, 'windows.json'))
+        self.extractor = SolarEdgeExtractor({'SITE_ID': 0, 'API_KEY': None}, governor=RequestGovernor('solaredge'))
+        self.df_site_details = self.extractor.site_details_to_df({'id': 0, 'name': SITE, 'installationDate': '2020-01-01',
+                                                                  'location': {'city': 'Granada', 'timeZone': 'UTC'}})
+        self.df_components = pd.DataFrame([{'component_id': DEVICE, 'component_name': 'Inverter 1', 'site_id': 0}])
+
+    def plan(self, step:timedelta) -> list:
+        # As plan_solaredge_tasks: from the resume point to the end, in windows of step
+        last_date = self.aws_s3.get_last_data_date(folder=FOLDER, device=DEVICE)
+        start_time = naive(as_utc(last_date, 'UTC')) if last_date is not None else START
+        return [IngestionTask('solaredge', SITE, DEVICE, window_start, min(window_end, END), store_solaredge_window,
+                              folder=FOLDER,
+                              solaredge_extr=self.extractor,
+                              aws_s3=self.aws_s3,
+                              df_site_details=self.df_site_details,
+                              df_components=self.df_components,
+                              planner=self.planner)
+                for window_start, window_end in split_windows(start_time, END, step) if window_start < END]
+
+    def run(self, tasks:list) -> list:
+        with IngestionScheduler(vendor_limits={'solaredge': 4}, journal=self.journal) as scheduler:
+            return run_ingestion_tasks(tasks, self.aws_s3, scheduler)
+
+
+def crash(tmp:str) -> None:
+    # Runs a backfill in 7 day windows and kills the process while its second
+    # window is still running and later ones have finished
+    finished = []
+    lock = threading.Lock()
+
+    def window(func, index:int):
+        def run(**kwargs):
+            if index == CRASH_WINDOW:
+                while len(finished) < FINISHED_BEFORE_CRASH:
+                    time.sleep(0.01)
+                os._exit(1)
+            func(**kwargs)
+            with lock:
+                finished.append(index)
+        return run
+
+    with StubServer(fallback=synthetic_vendor) as server:
+        set_transport(lambda pool_size: StubAdapter(server.url, pool_size=pool_size))
+        run = Run(tmp, server)
+        tasks = run.plan(timedelta(days=7))
+        for i, task in enumerate(tasks):
+            task.func = window(task.func, i)
+        run.run(tasks)
+
+
+def stored_times(tmp:str) -> set:
+    times = set()
+    for root, _, names in os.walk(os.path.join(tmp, 's3')):
+        for name in names:
+            if name.startswith('inverter_details_') and name.endswith('.csv'):
+                df = pd.read_csv(os.path.join(root, name))
+                times.update(pd.to_datetime(df['datetime'], utc=True).dt.tz_localize(None))
+    return times
+
+
+def test_killed_run_resumes_without_gaps(tmp_path):
+    tmp = str(tmp_path)
+    killed = subprocess.run([sys.executable, os.path.abspath(__file__), 'crash', tmp], cwd=tmp)
+    assert killed.returncode == 1
+
+    with StubServer(fallback=synthetic_vendor) as server:
+        set_transport(lambda pool_size: StubAdapter(server.url, pool_size=pool_size))
+        try:
+            run = Run(tmp, server)
+            crashed_window = split_windows(START, END, timedelta(days=7))[CRASH_WINDOW]
+            # The windows finished after the crashed one didn't move the resume point past it
+            last_date = run.aws_s3.get_last_data_date(folder=FOLDER, device=DEVICE)
+            assert last_date is None or naive(as_utc(last_date, 'UTC')) <= crashed_window[0]
+
+            # The restarted run plans other windows, the journal still skips
+            # the ones the killed run covered
+            tasks = run.plan(timedelta(days=5))
+            todo, done = run.journal.pending(tasks)
+            assert len(done) > 0
+            assert any([t.start_time <= crashed_window[0] < t.end_time for t in todo])
+
+            failed = run.run(tasks)
+            assert failed == []
+        finally:
+            set_transport(None)
+
+    expected = set(pd.date_range(START, END - STEP, freq=STEP))
+    assert expected - stored_times(tmp) == set()
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == 'crash':
+        crash(sys.argv[2])
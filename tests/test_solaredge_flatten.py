@@ -0,0 +1,54 @@
+import os
+import sys
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_solaredge_flatten import legacy_inverter_data_to_df, synthetic_telemetries
+from src.api_solared import SolarEdgeExtractor, flatten_telemetries
+from src.governor import RequestGovernor
+
+
+def flattened(inv_data:list) -> pd.DataFrame:
+    extractor = SolarEdgeExtractor({'SITE_ID': 1, 'API_KEY': None}, governor=RequestGovernor('solaredge'))
+    return extractor.inverter_data_to_df(inv_data)
+
+
+def assert_legacy(inv_data:list) -> None:
+    df_old = legacy_inverter_data_to_df(inv_data)
+    df_new = flattened(inv_data)
+    assert list(df_new.columns) == list(df_old.columns)
+    pd.testing.assert_frame_equal(df_new, df_old)
+
+
+def test_columns_match_legacy():
+    assert_legacy(synthetic_telemetries(500))
+
+
+def test_optional_fields_nulls_and_single_phase():
+    inv_data = []
+    for i, record in enumerate(synthetic_telemetries(50, seed=1)):
+        # Fields in the order the API sends them
+        single = {'date': record['date'],
+                  'totalActivePower': record['totalActivePower'],
+                  'dcVoltage': record['dcVoltage'],
+                  'groundFaultResistance': 5000.0 if i % 3 else None,
+                  'powerLimit': record['powerLimit'],
+                  'totalEnergy': record['totalEnergy'],
+                  'temperature': record['temperature'],
+                  'inverterMode': record['inverterMode'],
+                  'operationMode': None if i == 5 else record['operationMode'],
+                  'vL1To2': 400.0}
+        if 'L1Data' in record:
+            single['L1Data'] = {k: v for k, v in record['L1Data'].items() if i % 4 or k != 'cosPhi'}
+        inv_data.append(single)
+    assert_legacy(inv_data)
+
+
+def test_unknown_fields_fall_back_to_json_normalize():
+    inv_data = synthetic_telemetries(20, seed=2)
+    inv_data[3]['newField'] = 1.5
+    assert flatten_telemetries(inv_data) is None
+    assert_legacy(inv_data)
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.api_fronius import FroniusExtractor
+from src.api_metomatics import MeteoExtractor
+from src.governor import RequestGovernor
+
+
+@pytest.fixture
+def madrid_server(monkeypatch, tmp_path):
+    # Naive planner windows are server local times, the server runs in Madrid
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('TZ', 'Europe/Madrid')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_fronius_window_is_requested_in_utc(madrid_server):
+    extractor = FroniusExtractor({'API_VALUE': None, 'API_KEY': None}, governor=RequestGovernor('fronius'))
+    # Summer time starts at 02:00 on 2024-03-31: the local day is 23 hours long
+    url = extractor.device_data_url('pv', 'dev', datetime(2024, 3, 31), datetime(2024, 4, 1))
+    assert url == ('https://api.solarweb.com/swqapi/pvsystems/pv/devices/dev/histdata?'
+                   'from=2024-03-30T23:00:00&to=2024-03-31T22:00:00')
+    # Aware bounds are UTC already
+    url = extractor.device_data_url('pv', 'dev',
+                                    datetime(2024, 3, 31, 1, tzinfo=timezone.utc),
+                                    datetime(2024, 3, 31, 2, tzinfo=timezone.utc))
+    assert url.endswith('from=2024-03-31T01:00:00&to=2024-03-31T02:00:00')
+
+
+def test_weather_dates_are_site_days(madrid_server):
+    extractor = MeteoExtractor({'API_KEY': None}, governor=RequestGovernor('meteosource'))
+    # 23:30 UTC is already the next day in Madrid
+    dates = extractor.weather_dates(datetime(2024, 3, 1, 6, tzinfo=timezone.utc),
+                                    datetime(2024, 3, 2, 23, 30, tzinfo=timezone.utc),
+                                    timezone='Europe/Madrid')
+    assert dates == ['2024-03-01', '2024-03-02', '2024-03-03']
+    # The last day is kept when the end time of day is earlier than the start's
+    dates = extractor.weather_dates(datetime(2024, 3, 1, 18, tzinfo=timezone.utc),
+                                    datetime(2024, 3, 3, 5, tzinfo=timezone.utc),
+                                    timezone='Europe/Madrid')
+    assert dates == ['2024-03-01', '2024-03-02', '2024-03-03']
+    # Naive bounds are server local windows
+    assert extractor.weather_dates(datetime(2024, 3, 31), datetime(2024, 3, 31, 23, 59),
+                                   timezone='Atlantic/Canary') == ['2024-03-30', '2024-03-31']
@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.api_aws import AWS3Extractor
+from src.local_s3 import LocalS3Client
+from src.pipeline_common import WatermarkHolds, rewind_failed_watermarks
+from src.scheduler import IngestionTask
+from src.watermarks import WatermarkStore, data_file_time
+
+
+FOLDER = 'SolarEdge/SITE/PlantData'
+DEVICE = 'INV1'
+START = datetime(2024, 3, 1, tzinfo=timezone.utc)
+DAY = timedelta(days=1)
+STEP = timedelta(minutes=5)
+
+
+def aws_s3(tmp:str, cache_name:str = 'watermarks.json') -> AWS3Extractor:
+    client = LocalS3Client(os.path.join(tmp, 's3'))
+    watermarks = WatermarkStore(None, None, cache_file=os.path.join(tmp, cache_name), client_factory=lambda: client)
+    return AWS3Extractor(None, None, watermarks=watermarks, client=client)
+
+
+def window(i:int) -> IngestionTask:
+    return IngestionTask('solaredge', 'SITE', DEVICE, START + i * DAY, START + (i + 1) * DAY, None, folder=FOLDER)
+
+
+def store(s3:AWS3Extractor, task:IngestionTask) -> datetime:
+    # Stores the window's rows as its pipeline does, returns its last instant
+    times = pd.date_range(task.start_time, task.end_time - STEP, freq=STEP)
+    df = pd.DataFrame({'datetime': times, 'value': 1.0})
+    s3.store_df_s3(df=df, folder=FOLDER, file_name=f'inverter_details_{data_file_time(task.start_time)}_{DEVICE}.csv',
+                   device=DEVICE)
+    return times[-1].to_pydatetime()
+
+
+def last_date(s3:AWS3Extractor, device:str = DEVICE) -> datetime:
+    return s3.watermarks.get(folder=FOLDER, device=device)
+
+
+def test_windows_finishing_out_of_order(tmp_path):
+    s3 = aws_s3(str(tmp_path))
+    holds = WatermarkHolds(s3.watermarks)
+    tasks = [window(i) for i in range(3)]
+    holds.planned(tasks)
+
+    # The last window finishes first, the manifest stops at the earliest unfinished one
+    store(s3, tasks[2])
+    holds.finished(tasks[2])
+    assert last_date(s3) == tasks[0].start_time
+    assert last_date(s3, device=None) == tasks[0].start_time
+
+    store(s3, tasks[0])
+    holds.finished(tasks[0])
+    assert last_date(s3) == tasks[1].start_time
+
+    # Once the gap is filled it moves to the newest stored row
+    end = store(s3, tasks[1])
+    holds.finished(tasks[1])
+    assert last_date(s3) == end + DAY
+    assert last_date(s3, device=None) == end + DAY
+
+
+def test_failed_window_blocks_and_is_rewound(tmp_path):
+    s3 = aws_s3(str(tmp_path))
+    holds = WatermarkHolds(s3.watermarks)
+    tasks = [window(i) for i in range(3)]
+    holds.planned(tasks)
+    for task in tasks[1:]:
+        store(s3, task)
+        holds.finished(task)
+    holds.finished(tasks[0], error=RuntimeError('HTTP 500'))
+    # Nothing after the failed window counts as done
+    assert last_date(s3) == tasks[0].start_time
+
+    # A manifest already past the failed window, e.g. from a run that
+    # stored later windows before, is pulled back to it
+    s3.watermarks.update(folder=FOLDER, device=DEVICE, last_date=START + 5 * DAY, last_key=None, force=True)
+    rewind_failed_watermarks(s3, [tasks[0]])
+    assert last_date(s3) == tasks[0].start_time
+    # Manifests earlier than the failed window are left alone
+    rewind_failed_watermarks(s3, [tasks[1]])
+    assert last_date(s3) == tasks[0].start_time
+
+
+def test_rebuild_fixes_a_stale_cache(tmp_path):
+    s3 = aws_s3(str(tmp_path))
+    end = None
+    for i in range(2):
+        end = store(s3, window(i))
+    assert last_date(s3) == end
+
+    # The local cache disagrees with the bucket, it is trusted until a rebuild
+    cache_file = s3.watermarks.cache_file
+    with open(cache_file) as f:
+        cache = json.load(f)
+    for manifest in cache.values():
+        manifest['last_date'] = '2024-04-01 00:00:00'
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f)
+    stale = aws_s3(str(tmp_path))
+    assert last_date(stale) == datetime(2024, 4, 1, tzinfo=timezone.utc)
+
+    rebuilt = stale.rebuild_watermarks(prefix='SolarEdge/')
+    assert rebuilt[stale.watermarks.manifest_key(FOLDER, DEVICE)] == end
+    assert last_date(stale) == end
+    assert last_date(stale, device=None) == end
+    # The bucket holds the same, as a run without the cache sees it
+    fresh = aws_s3(str(tmp_path), cache_name='other.json')
+    assert last_date(fresh) == end
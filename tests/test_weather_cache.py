@@ -0,0 +1,56 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.api_async import AsyncMeteoExtractor
+from src.governor import RequestGovernor
+from src.meteo_cache import WeatherCache
+
+
+DAY = [{'date': '2024-03-01T00:00:00', 'temperature': 11.5}]
+
+
+def test_threads_fetch_a_day_once(tmp_path):
+    cache = WeatherCache(cache_dir=str(tmp_path))
+    calls = []
+    lock = threading.Lock()
+
+    def fetch() -> list:
+        with lock:
+            calls.append(1)
+        time.sleep(0.05)
+        return DAY
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        days = list(executor.map(lambda _: cache.get_or_fetch('37.1N', '3.6W', '2024-03-01', 'Europe/Madrid', fetch),
+                                 range(8)))
+    assert days == [DAY] * 8
+    assert len(calls) == 1
+    assert cache._key_locks == {}
+
+
+def test_coroutines_fetch_a_day_once(tmp_path):
+    extractor = AsyncMeteoExtractor({'API_KEY': None}, governor=RequestGovernor('meteosource'),
+                                    cache=WeatherCache(cache_dir=str(tmp_path)))
+    calls = []
+
+    async def fetch_hist_data(lat:str, lon:str, date:str, timezone:str) -> list:
+        calls.append(date)
+        await asyncio.sleep(0.05)
+        return DAY
+
+    extractor.fetch_hist_data = fetch_hist_data
+
+    async def sites_sharing_coordinates() -> list:
+        return await asyncio.gather(*[extractor.get_hist_data('37.1N', '3.6W', date)
+                                      for date in ['2024-03-01'] * 8 + ['2024-03-02'] * 4])
+
+    days = asyncio.run(sites_sharing_coordinates())
+    assert days == [DAY] * 12
+    assert sorted(calls) == ['2024-03-01', '2024-03-02']
+    assert extractor._day_locks == {}
@@ -0,0 +1,82 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.window_planner import EMPTY_MARGIN, VENDOR_WINDOWS, WindowPlanner
+
+
+START = datetime(2024, 3, 1)
+DAY = timedelta(days=1)
+
+
+def planner(tmp_path) -> WindowPlanner:
+    return WindowPlanner(state_file=str(tmp_path / 'windows.json'))
+
+
+def steps(windows:list) -> list:
+    return [e - s for s, e in windows]
+
+
+def test_plans_the_vendor_maximum(tmp_path):
+    windows = planner(tmp_path).plan('solaredge', 'SITE', START, START + 20 * DAY, device='INV1')
+    assert steps(windows) == [7 * DAY, 7 * DAY, 6 * DAY]
+    assert windows[0][0] == START and windows[-1][1] == START + 20 * DAY
+
+
+def test_clips_to_the_data_period_and_whole_windows(tmp_path):
+    p = planner(tmp_path)
+    windows = p.plan('solaredge', 'SITE', START, START + 20 * DAY, device='INV1',
+                     data_start=START + 2 * DAY, data_end=START + 18 * DAY)
+    assert windows == [(START + 2 * DAY, START + 9 * DAY), (START + 9 * DAY, START + 16 * DAY),
+                       (START + 16 * DAY, START + 18 * DAY)]
+    windows = p.plan('solaredge', 'SITE', START, START + 20 * DAY, device='INV1', whole=True)
+    assert steps(windows) == [7 * DAY, 7 * DAY]
+
+
+def test_large_windows_halve_the_step_and_light_ones_grow_it(tmp_path):
+    p = planner(tmp_path)
+    limits = VENDOR_WINDOWS['solaredge']
+    for _ in range(5):
+        p.record('solaredge', 'SITE', START, START + DAY, rows=limits['large_rows'] + 1, device='INV1')
+    # Halved down to the minimum and no further
+    assert steps(p.plan('solaredge', 'SITE', START, START + 3 * DAY, device='INV1')) == [DAY] * 3
+
+    p.record('solaredge', 'SITE', START, START + DAY, rows=10, device='INV1')
+    assert steps(p.plan('solaredge', 'SITE', START, START + 4 * DAY, device='INV1')) == [2 * DAY] * 2
+    for _ in range(5):
+        p.record('solaredge', 'SITE', START, START + DAY, rows=10, device='INV1')
+    assert steps(p.plan('solaredge', 'SITE', START, START + 14 * DAY, device='INV1')) == [7 * DAY] * 2
+
+    # Rows in between keep the step, and it is kept across runs
+    p.record('solaredge', 'SITE', START, START + DAY, rows=limits['large_rows'], device='INV1')
+    p.save()
+    assert steps(planner(tmp_path).plan('solaredge', 'SITE', START, START + 14 * DAY, device='INV1')) == [7 * DAY] * 2
+
+
+def test_empty_ranges_are_skipped(tmp_path):
+    p = planner(tmp_path)
+    p.record('solaredge', 'SITE', START + 3 * DAY, START + 5 * DAY, rows=0, device='INV1')
+    p.record('solaredge', 'SITE', START + 5 * DAY, START + 6 * DAY, rows=0, device='INV1')
+    # Touching ranges are merged
+    assert p.empty_ranges('solaredge', 'SITE', device='INV1') == [(START + 3 * DAY, START + 6 * DAY)]
+    assert p.is_empty('solaredge', 'SITE', START + 4 * DAY, START + 5 * DAY, device='INV1')
+
+    # A window stops where an empty range starts, the next one starts after it
+    windows = p.plan('solaredge', 'SITE', START, START + 10 * DAY, device='INV1')
+    assert windows == [(START, START + 3 * DAY), (START + 6 * DAY, START + 10 * DAY)]
+
+    # A range empty for the whole site is skipped for every device
+    p.mark_empty('solaredge', 'SITE', START, START + 3 * DAY)
+    assert p.plan('solaredge', 'SITE', START, START + 10 * DAY, device='INV2') == [(START + 3 * DAY, START + 10 * DAY)]
+
+
+def test_recent_windows_are_never_marked_empty(tmp_path):
+    p = planner(tmp_path)
+    now = datetime.now().replace(microsecond=0)
+    p.mark_empty('fronius', 'SITE', now - DAY, now, device='DEV1')
+    assert p.empty_ranges('fronius', 'SITE', device='DEV1') == []
+    p.mark_empty('fronius', 'SITE', now - EMPTY_MARGIN - DAY, now, device='DEV1')
+    [(s, e)] = p.empty_ranges('fronius', 'SITE', device='DEV1')
+    assert s == now - EMPTY_MARGIN - DAY and e <= now - EMPTY_MARGIN